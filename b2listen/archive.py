@@ -0,0 +1,230 @@
+import atexit
+import base64
+import json
+import logging
+import time
+from pathlib import Path
+from threading import Condition, Thread
+from typing import Dict, Iterator, List, Tuple
+
+from b2listen.loadgen import DEFAULT_CONCURRENCY, DEFAULT_TIMEOUT, HttpLoad, Message
+from b2listen.signature import EVENT_NOTIFICATION_SIGNATURE_HEADER
+from b2listen.spool import HOP_BY_HOP_HEADERS
+
+logging.basicConfig()
+logger = logging.getLogger('b2listen.archive')
+
+DEFAULT_MEMBER_RECORDS = 1000
+DEFAULT_FLUSH_INTERVAL = 1.0
+INDEX_SUFFIX = '.idx'
+
+
+def encode_record(received_at: float, status: int, path: str, headers: List[Tuple[str, str]], body: bytes) -> bytes:
+    """
+    Encode a received message as a line of JSON with the time it was received, in seconds since the epoch, the response
+    status, the request path and headers, and the body, as text, or, if it is not UTF-8, base64-encoded with
+    bodyEncoding set to "base64"
+    """
+    record = {'time': round(received_at, 6), 'status': int(status), 'path': path, 'headers': headers}
+    try:
+        record['body'] = body.decode('utf-8')
+    except UnicodeDecodeError:
+        record['body'] = base64.b64encode(body).decode('ascii')
+        record['bodyEncoding'] = 'base64'
+    return bytes(json.dumps(record, separators=(',', ':')), 'utf-8') + b'\n'
+
+
+def record_body(record: Dict) -> bytes:
+    if record.get('bodyEncoding') == 'base64':
+        return base64.b64decode(record['body'])
+    return bytes(record['body'], 'utf-8')
+
+
+class ArchiveWriter:
+    """
+    Record the messages received by the embedded webserver in a compressed NDJSON archive.
+
+    The archive is a series of gzip members, each containing up to member_records records, so the whole file can be
+    read with gunzip or zcat. A member is written by a background thread when it is full, or at least every
+    flush_interval seconds, so request threads only encode their record. For each member, a line is appended to the
+    index file, path + '.idx', recording the member's offset, length, number of records and time range, so that
+    readers can count the records and skip to a point in the recording without decompressing the whole archive.
+    """
+
+    def __init__(self, path: str, member_records: int = DEFAULT_MEMBER_RECORDS,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL):
+        self.path = Path(path)
+        self.member_records = member_records
+        self.flush_interval = flush_interval
+        self.condition = Condition()
+        self.pending: List[bytes] = []
+        self.pending_times: List[float] = []
+        self.closed = False
+        self.records = 0
+
+        self.file = open(self.path, 'ab')
+        self.index = open(f'{self.path}{INDEX_SUFFIX}', 'a')
+        logger.info(f'Recording received messages to {self.path}')
+
+        self.writer = Thread(target=self._write_periodically, daemon=True, name='b2listen-archive')
+        self.writer.start()
+        atexit.register(self.close)
+
+    def record(self, path: str, headers: List[Tuple[str, str]], body: bytes, status: int):
+        received_at = time.time()
+        line = encode_record(received_at, status, path, headers, body)
+        with self.condition:
+            if self.closed:
+                return
+            self.pending.append(line)
+            self.pending_times.append(received_at)
+            if len(self.pending) >= self.member_records:
+                self.condition.notify_all()
+
+    def _write_member(self, lines: List[bytes], times: List[float]):
+        import gzip
+        member = gzip.compress(b''.join(lines))
+        offset = self.file.tell()
+        self.file.write(member)
+        self.file.flush()
+        self.index.write(json.dumps({'offset': offset, 'length': len(member), 'records': len(lines),
+                                     'start': min(times), 'end': max(times)}) + '\n')
+        self.index.flush()
+        self.records += len(lines)
+
+    def _take(self) -> Tuple[List[bytes], List[float]]:
+        lines, times = self.pending[:self.member_records], self.pending_times[:self.member_records]
+        del self.pending[:self.member_records]
+        del self.pending_times[:self.member_records]
+        return lines, times
+
+    def _write_periodically(self):
+        while True:
+            with self.condition:
+                if self.closed:
+                    return
+                if len(self.pending) < self.member_records:
+                    self.condition.wait(self.flush_interval)
+                if self.closed or not self.pending:
+                    continue
+                lines, times = self._take()
+            self._write_member(lines, times)
+
+    def close(self):
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify_all()
+        self.writer.join()
+        while self.pending:
+            self._write_member(*self._take())
+        self.file.close()
+        self.index.close()
+        atexit.unregister(self.close)
+        logger.info(f'Recorded {self.records} messages to {self.path}')
+
+
+class ArchiveReader:
+    """
+    Read the records in an archive, in order, using its index, if it has one, to skip members recorded before start,
+    a time in seconds since the epoch
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.members = self._read_index()
+
+    def _read_index(self) -> List[Dict] | None:
+        index_path = Path(f'{self.path}{INDEX_SUFFIX}')
+        if not index_path.exists():
+            return None
+        members = []
+        with open(index_path) as f:
+            for line in f:
+                try:
+                    members.append(json.loads(line))
+                except ValueError:
+                    # A partial line written as b2listen exited
+                    break
+        size = self.path.stat().st_size
+        if not members or members[-1]['offset'] + members[-1]['length'] != size:
+            logger.warning(f'Index {index_path} does not match {self.path}; reading the whole archive')
+            return None
+        return members
+
+    def count(self) -> int | None:
+        """
+        :return: the number of records, if the archive has a valid index
+        """
+        return sum(member['records'] for member in self.members) if self.members is not None else None
+
+    def first_time(self) -> float | None:
+        for record in self.records():
+            return record['time']
+        return None
+
+    def records(self, start: float | None = None) -> Iterator[Dict]:
+        import gzip
+        if self.members is None:
+            with gzip.open(self.path, 'rb') as f:
+                for line in f:
+                    record = json.loads(line)
+                    if start is None or record['time'] >= start:
+                        yield record
+            return
+
+        with open(self.path, 'rb') as f:
+            for member in self.members:
+                if start is not None and member['end'] < start:
+                    continue
+                f.seek(member['offset'])
+                for line in gzip.decompress(f.read(member['length'])).splitlines():
+                    record = json.loads(line)
+                    if start is None or record['time'] >= start:
+                        yield record
+
+
+class Replayer(HttpLoad):
+    """
+    Re-deliver the messages in an archive to a URL, at speed times the rate at which they were recorded, or, if speed
+    is None, as fast as the URL accepts them. Skip the first start seconds of the recording. If signing_secret is set,
+    messages are signed with it; otherwise, they are sent with their original signatures.
+    """
+
+    def __init__(self, reader: ArchiveReader, url: str, speed: float | None = 1.0, start: float = 0,
+                 concurrency: int = DEFAULT_CONCURRENCY, signing_secret: str | None = None,
+                 timeout: float = DEFAULT_TIMEOUT):
+        super().__init__(url, concurrency=concurrency, signing_secret=signing_secret, timeout=timeout)
+        self.reader = reader
+        self.speed = speed
+        self.offset = start
+        self.records: Iterator[Dict] | None = None
+        self.first_time: float | None = None
+
+    def next_message(self) -> Message | None:
+        with self.lock:
+            record = next(self.records, None)
+        if record is None:
+            return None
+        if self.speed:
+            send_at = self.start + (record['time'] - self.first_time) / self.speed
+        else:
+            send_at = time.perf_counter()
+        headers = [(name, value) for name, value in record['headers']
+                   if name.lower() not in HOP_BY_HOP_HEADERS
+                   and not (self.signing_secret and name.lower() == EVENT_NOTIFICATION_SIGNATURE_HEADER)]
+        return Message(send_at, record['path'], headers, record_body(record))
+
+    def run(self) -> Dict:
+        recording_start = self.reader.first_time()
+        if recording_start is None:
+            raise ValueError(f'{self.reader.path} contains no messages')
+        self.first_time = recording_start + self.offset
+        self.records = self.reader.records(start=self.first_time)
+        count = self.reader.count() if not self.offset else None
+        logger.info(f'Replaying {count if count is not None else "the"} messages from {self.reader.path} to '
+                    f'{self.url} from {self.concurrency} threads ' +
+                    (f'at {self.speed}x speed' if self.speed else 'as fast as possible') +
+                    (f', starting {self.offset} seconds in' if self.offset else ''))
+        return super().run()
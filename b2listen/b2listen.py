@@ -1,35 +1,61 @@
+# Third-party libraries, which take much longer to import than the rest of b2listen, and the modules that need slow
+# standard library modules, such as http.server and sqlite3, are imported where they are used, so that commands such as
+# version and --help, which don't need them, start quickly. See benchmarks/import_time.py.
+from __future__ import annotations
+
 import argparse
 import datetime
 import json
 import logging
 import os
 import re
-
 import subprocess
+import time
 import traceback
-import warnings
-from importlib import metadata
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Callable, Dict
-
-import psutil
-from b2sdk.v2 import AuthInfoCache, B2Api, B2HttpApiConfig, Bucket, InMemoryAccountInfo, NotificationRule
-from b2sdk.v2.exception import BadRequest, NonExistentBucket
-from dotenv import load_dotenv
-
-from b2listen.server import Server
-from b2listen.subscription import Subscription
+from typing import TYPE_CHECKING, List, Callable, Dict, NamedTuple, Tuple
+
+from b2listen import metrics
+from b2listen.archive import ArchiveReader, ArchiveWriter, Replayer
+from b2listen.cloudflared import CloudflaredOutput
+from b2listen.dedup import DEFAULT_CAPACITY, DedupIndex
+from b2listen.defaults import DEFAULT_CONCURRENCY, DEFAULT_DRAIN_TIMEOUT, DEFAULT_ENGINE, DEFAULT_KEEP_ALIVE_TIMEOUT, \
+    ENGINE_SIMPLE, ENGINES
+from b2listen.forwarder import DEFAULT_BATCH_LINGER, DEFAULT_BATCH_MAX_EVENTS, DEFAULT_MAX_IN_FLIGHT, Forwarder
+from b2listen.loadgen import DEFAULT_CONCURRENCY as DEFAULT_BENCH_CONCURRENCY, DEFAULT_EVENTS_PER_REQUEST, \
+    DEFAULT_REQUESTS, LoadGenerator, format_report
+from b2listen.metrics import DEFAULT_METRICS_INTERFACE
+from b2listen.multi import Listener, PathRouter, load_config
+from b2listen.ratelimit import RateLimiter, parse_path_limit, parse_processing_latency
+from b2listen.requestlog import DEFAULT_MODE as DEFAULT_REQUEST_LOG_MODE, MODE_FULL, MODES as REQUEST_LOG_MODES, \
+    RequestLog
+from b2listen.registry import Entry, Session, default_runtime_dir, read_entries
+from b2listen.router import EventRouter, parse_route
+from b2listen.rules import RuleNotFound, RuleSet
+from b2listen.sink import DEFAULT_BATCH_INTERVAL as DEFAULT_SINK_BATCH_INTERVAL, \
+    DEFAULT_BATCH_SIZE as DEFAULT_SINK_BATCH_SIZE, DEFAULT_MAX_FILE_SIZE, NdjsonSink, SqliteSink, format_event, query
+from b2listen.spool import DEFAULT_FSYNC_INTERVAL, DEFAULT_SEGMENT_SIZE, Spool, SpoolForwarder
+from b2listen.timing import timer
+
+if TYPE_CHECKING:
+    from b2sdk.v2 import AbstractAccountInfo, B2Api, Bucket, NotificationRule
+    from b2listen.server import Server
 
 logging.basicConfig()
 logger = logging.getLogger('b2listen')
 
 SIGNING_SECRET_LENGTH = 32
 EVENT_NOTIFICATION_RULE_PREFIX = '--autocreated-b2listen-'
+DEFAULT_CLEANUP_WORKERS = 8
+DEFAULT_EVENT_TYPES = ['b2:ObjectCreated:*', 'b2:ObjectDeleted:*', 'b2:HideMarkerCreated:*']
 
 NAME = 'b2listen'
 
 
 def version(_args: argparse.Namespace | None = None):
+    from importlib import metadata
     v = metadata.version(NAME)
     print(f'{NAME} version {v}')
 
@@ -77,14 +103,13 @@ def check_and_get_env_vars(env_vars: List[str]) -> List[str]:
     return values
 
 
-def create_rule(b2bucket: Bucket, url: str, name: str, args: argparse.Namespace, signing_secret: str):
-    custom_headers = parse_custom_headers(args.custom_headers)
-
-    new_rule: NotificationRule = {
-        'eventTypes': args.event_types,
+def make_rule(url: str, name: str, event_types: List[str], prefix: str,
+              custom_headers: List[Dict[str, str]] | None, signing_secret: str) -> NotificationRule:
+    return {
+        'eventTypes': event_types,
         'isEnabled': True,
         'name': name,
-        'objectNamePrefix': args.prefix,
+        'objectNamePrefix': prefix,
         'targetConfiguration': {
             'targetType': 'webhook',
             'url': url,
@@ -93,70 +118,116 @@ def create_rule(b2bucket: Bucket, url: str, name: str, args: argparse.Namespace,
         }
     }
 
-    # Suppress FeaturePreviewWarning for Event Notifications
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        old_rules = b2bucket.get_notification_rules()
-        new_rules = old_rules + [new_rule]
-        try:
-            logger.info(f'Creating rule with name "{name}"')
-            logger.debug(f'Rule is {json.dumps(new_rule, indent=2)}')
-            # Suppress warnings about incompatible types - NotificationRule != NotificationRuleResponse
-            # noinspection PyTypeChecker
-            b2bucket.set_notification_rules(new_rules)
-        except BadRequest as e:
-            found = False
-            if e.message.startswith('More than one event notification rule has overlapping prefixes'):
-                for rule in old_rules:
-                    if rule['name'].startswith(EVENT_NOTIFICATION_RULE_PREFIX):
-                        found = True
-                        break
-
-            if found:
-                exit_with_error('Error creating event notification rule - an overlapping rule already exists.\n\n'
-                                'Either another instance of this app is running, or the app was terminated and '
-                                'failed to clean up. You can run the app again with the "cleanup" command and '
-                                'your bucket name.\n', exc_info=e)
-            else:
-                exit_with_error(f'Error setting event notification rule: {e.message}', exc_info=e)
 
+@timer.timed
+def create_rule(rule_set: RuleSet, url: str, name: str, args: argparse.Namespace, signing_secret: str):
+    from b2sdk.v2.exception import BadRequest
+
+    custom_headers = parse_custom_headers(args.custom_headers)
 
-def modify_rule(b2bucket: Bucket, url: str, name: str) -> str:
-    # Suppress FeaturePreviewWarning for Event Notifications
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        rules = b2bucket.get_notification_rules()
-        rule = next((rule for rule in rules if rule['name'] == name), None)
-        if not rule:
-            exit_with_error(f'Cannot find rule "{name}"')
-        old_url = rule['targetConfiguration']['url']
-        rule['targetConfiguration']['url'] = url
+    new_rule = make_rule(url, name, args.event_types, args.prefix, custom_headers, signing_secret)
 
-        try:
-            # Suppress warnings about incompatible types - NotificationRule != NotificationRuleResponse
-            # noinspection PyTypeChecker
-            b2bucket.set_notification_rules(rules)
-            logger.info(f'Modified rule with name "{name}"')
-            logger.info(f'Old URL was {old_url}; new URL is {url}')
-            logger.debug(f'Rule is {json.dumps(rule, indent=2)}')
-        except BadRequest as e:
-            exit_with_error(f'Error setting event notification rule {e.message}', exc_info=e)
-        return old_url
-
-
-def delete_rule(b2bucket: Bucket, name: str):
-    # Suppress FeaturePreviewWarning for Event Notifications
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        logger.info(f'Deleting rule with name "{name}"')
-        old_rules = b2bucket.get_notification_rules()
-        new_rules = [rule for rule in old_rules if rule['name'] != name]
-        if len(new_rules) == len(old_rules):
-            logger.warning(f'Could not find rule "{name}" - did you delete it manually?')
+    try:
+        logger.info(f'Creating rule with name "{name}"')
+        logger.debug(f'Rule is {json.dumps(new_rule, indent=2)}')
+        rule_set.create(new_rule)
+        rule_set.commit()
+    except BadRequest as e:
+        found = False
+        if e.message.startswith('More than one event notification rule has overlapping prefixes'):
+            for rule in rule_set.get_rules():
+                if rule['name'].startswith(EVENT_NOTIFICATION_RULE_PREFIX):
+                    found = True
+                    break
+
+        if found:
+            exit_with_error('Error creating event notification rule - an overlapping rule already exists.\n\n'
+                            'Either another instance of this app is running, or the app was terminated and '
+                            'failed to clean up. You can run the app again with the "cleanup" command and '
+                            'your bucket name. If the rule was created on another machine or in a Docker container, '
+                            'add --full-scan, since cleanup only looks for sessions recorded on this machine.\n',
+                            exc_info=e)
         else:
-            # Suppress warnings about incompatible types - NotificationRule != NotificationRuleResponse
-            # noinspection PyTypeChecker
-            b2bucket.set_notification_rules(new_rules)
+            exit_with_error(f'Error setting event notification rule: {e.message}', exc_info=e)
+
+
+@timer.timed
+def modify_rule(rule_set: RuleSet, url: str, name: str) -> str:
+    from b2sdk.v2.exception import BadRequest
+
+    try:
+        old_url = rule_set.modify_url(name, url)
+        rule_set.commit()
+        logger.info(f'Modified rule with name "{name}"')
+        logger.info(f'Old URL was {old_url}; new URL is {url}')
+        logger.debug(f'Rule is {json.dumps(rule_set.find(name), indent=2)}')
+    except RuleNotFound:
+        exit_with_error(f'Cannot find rule "{name}"')
+    except BadRequest as e:
+        exit_with_error(f'Error setting event notification rule {e.message}', exc_info=e)
+    return old_url
+
+
+@timer.timed
+def delete_rule(rule_set: RuleSet, name: str):
+    logger.info(f'Deleting rule with name "{name}"')
+    if not rule_set.delete(name):
+        logger.warning(f'Could not find rule "{name}" - did you delete it manually?')
+    else:
+        rule_set.commit()
+
+
+@timer.timed
+def set_listener_rules(rule_set: RuleSet, listeners: List[Listener], tunnel_url: str, label: str,
+                       signing_secret: str | None) -> Dict[str, str | None]:
+    """
+    Point a rule for each of a bucket's listeners at the listener's path on the tunnel, modifying existing rules and
+    creating temporary rules, in a single update of the bucket's rules.
+    :return: map of rule name to the rule's previous URL, or None for a temporary rule
+    """
+    from b2sdk.v2.exception import BadRequest
+
+    bucket_name = rule_set.bucket.name
+    changes = {}
+    try:
+        for listener in listeners:
+            url = f'{tunnel_url}/{listener.name}'
+            if listener.rule_name:
+                logger.info(f'Modifying rule with name "{listener.rule_name}" in bucket "{bucket_name}"')
+                changes[listener.rule_name] = rule_set.modify_url(listener.rule_name, url)
+            else:
+                name = f'{label}{listener.name}'
+                logger.info(f'Creating rule with name "{name}" in bucket "{bucket_name}"')
+                rule_set.create(make_rule(url, name, listener.event_types or DEFAULT_EVENT_TYPES, listener.prefix,
+                                          listener.custom_headers, signing_secret))
+                changes[name] = None
+            logger.info(f'Listener "{listener.name}": {url} -> {listener.url}')
+        rule_set.commit()
+    except RuleNotFound as e:
+        exit_with_error(str(e))
+    except BadRequest as e:
+        exit_with_error(f'Error setting event notification rules for bucket "{bucket_name}": {e.message}', exc_info=e)
+    return changes
+
+
+@timer.timed
+def restore_listener_rules(rule_set: RuleSet, changes: Dict[str, str | None]):
+    """
+    Undo set_listener_rules(), restoring the URLs of existing rules and deleting temporary rules
+    """
+    bucket_name = rule_set.bucket.name
+    for name, old_url in changes.items():
+        if old_url is None:
+            logger.info(f'Deleting rule with name "{name}" in bucket "{bucket_name}"')
+            if not rule_set.delete(name):
+                logger.warning(f'Could not find rule "{name}" - did you delete it manually?')
+        else:
+            logger.info(f'Restoring URL of rule with name "{name}" in bucket "{bucket_name}" to {old_url}')
+            try:
+                rule_set.modify_url(name, old_url)
+            except RuleNotFound:
+                logger.warning(f'Could not find rule "{name}" - did you delete it manually?')
+    rule_set.commit()
 
 
 def validate_signing_secret(s: str) -> str:
@@ -165,43 +236,165 @@ def validate_signing_secret(s: str) -> str:
     raise argparse.ArgumentTypeError("Signing secret must be 32 alphanumeric characters")
 
 
-def parse_args() -> argparse.Namespace:
-    parser = argparse.ArgumentParser(
-        prog=NAME,
-        description='Deliver Event Notifications for a given bucket to a local service.\n\n'
-                    'For more details on one command:\n\n'
-                    f'{NAME} <command> --help',
-        formatter_class=argparse.RawDescriptionHelpFormatter)
-    parser.add_argument('--loglevel', type=str, choices=['debug', 'info', 'warn', 'error', 'critical'],
-                        required=False, default='info',
-                        help='Application logging level. (default: "info")')
-    parser.add_argument('--cloudflared-command', type=str, required=False, default='cloudflared',
-                        help='Command to run for cloudflared. (default: "cloudflared")')
-
-    common_parser = argparse.ArgumentParser(add_help=False)
-    common_parser.add_argument('bucket_name', type=str, metavar='bucket-name',
-                               help='Name of the bucket')
-
-    subparsers = parser.add_subparsers(help='Sub-command help', dest='cmd', required=True)
-
+def make_server_parser() -> argparse.ArgumentParser:
+    """
+    Options for the embedded webserver, shared by listen, multi-listen and bench
+    """
+    server_parser = argparse.ArgumentParser(add_help=False)
+    embedded_server = server_parser.add_argument_group(description='To configure the embedded webserver:')
+    embedded_server.add_argument('--server-engine', type=str, choices=ENGINES, required=False,
+                                 default=DEFAULT_ENGINE,
+                                 help='"threaded" serves keep-alive connections, each on its own thread, handling '
+                                      'several requests concurrently; "simple" serves one request at a time. '
+                                      f'(default: "{DEFAULT_ENGINE}")')
+    embedded_server.add_argument('--server-concurrency', type=int, required=False, default=DEFAULT_CONCURRENCY,
+                                 help='Maximum number of requests the threaded engine handles concurrently. Idle '
+                                      'keep-alive connections do not count against this. '
+                                      f'(default: {DEFAULT_CONCURRENCY})')
+    embedded_server.add_argument('--keep-alive-timeout', type=float, required=False,
+                                 default=DEFAULT_KEEP_ALIVE_TIMEOUT,
+                                 help='Seconds the threaded engine keeps an idle connection open. '
+                                      f'(default: {DEFAULT_KEEP_ALIVE_TIMEOUT})')
+    embedded_server.add_argument('--drain-timeout', type=float, required=False, default=DEFAULT_DRAIN_TIMEOUT,
+                                 metavar='SECONDS',
+                                 help='On exit, after removing the rule or subscription, wait up to this long for '
+                                      'messages that are being handled, or spooled, to be delivered before stopping '
+                                      f'the tunnel. (default: {DEFAULT_DRAIN_TIMEOUT})')
+    embedded_server.add_argument('--verify-signatures', action='store_true',
+                                 help='Reject, with "401 Unauthorized", messages that are not signed with the '
+                                      'SIGNING_SECRET environment variable, before deduplicating, spooling or '
+                                      'forwarding them')
+
+    request_log = server_parser.add_argument_group(
+        description='To configure logging of messages received by the embedded webserver:')
+    request_log.add_argument('--request-log', type=str, choices=REQUEST_LOG_MODES, required=False,
+                             default=DEFAULT_REQUEST_LOG_MODE,
+                             help='"full": headers and body of each message; "summary": one line per message; '
+                                  '"ndjson": one JSON object per message; "off": nothing. Messages are logged on a '
+                                  f'background thread. (default: "{DEFAULT_REQUEST_LOG_MODE}")')
+    request_log.add_argument('--request-log-sample', type=float, required=False, default=1.0, metavar='FRACTION',
+                             help='Fraction of messages to log, between 0 and 1. (default: 1)')
+    request_log.add_argument('--request-log-max-body', type=int, required=False, metavar='BYTES',
+                             help='Summarize, rather than show, bodies larger than this. (default: show all bodies)')
+    request_log.add_argument('--request-log-file', type=str, required=False, metavar='FILE',
+                             help='Write the message log to this file rather than stderr')
+
+    request_log.add_argument('--record', type=str, required=False, metavar='FILE',
+                             help='Record every message received, with its headers and the time it was received, in '
+                                  'a compressed archive, for the replay command')
+
+    sink = server_parser.add_argument_group(description='To store the events received by the embedded webserver:')
+    sink_type = sink.add_mutually_exclusive_group()
+    sink_type.add_argument('--sink-ndjson', type=str, required=False, metavar='DIR',
+                           help='Append accepted events, as lines of JSON, to files in this directory')
+    sink_type.add_argument('--sink-sqlite', type=str, required=False, metavar='FILE',
+                           help='Insert accepted events into this SQLite database, for the query command')
+    sink.add_argument('--sink-max-file-size', type=int, required=False, default=DEFAULT_MAX_FILE_SIZE, metavar='BYTES',
+                      help=f'Start a new --sink-ndjson file at this size. (default: {DEFAULT_MAX_FILE_SIZE})')
+    sink.add_argument('--sink-batch-size', type=int, required=False, default=DEFAULT_SINK_BATCH_SIZE, metavar='N',
+                      help=f'Write events in batches of up to this many. (default: {DEFAULT_SINK_BATCH_SIZE})')
+    sink.add_argument('--sink-batch-interval', type=float, required=False, default=DEFAULT_SINK_BATCH_INTERVAL,
+                      metavar='SECONDS',
+                      help=f'Maximum time, in seconds, between batches. (default: {DEFAULT_SINK_BATCH_INTERVAL})')
+
+    dedup = server_parser.add_argument_group(description='To drop duplicate events in the embedded webserver:')
+    dedup.add_argument('--dedup', action='store_true',
+                       help='Drop events whose eventId has recently been accepted')
+    dedup.add_argument('--dedup-capacity', type=int, required=False, default=DEFAULT_CAPACITY,
+                       help=f'Maximum number of event IDs to remember. (default: {DEFAULT_CAPACITY})')
+    dedup.add_argument('--dedup-ttl', type=float, required=False,
+                       help='Forget event IDs this many seconds after they are first seen. (default: remember the '
+                            'most recently seen event IDs, up to --dedup-capacity)')
+    dedup.add_argument('--dedup-bloom', action='store_true',
+                       help='Use a Bloom filter to speed up lookups of new event IDs')
+    return server_parser
+
+
+def make_forwarding_parser() -> argparse.ArgumentParser:
+    """
+    Options for forwarding, shared by listen and multi-listen
+    """
+    forwarding_parser = argparse.ArgumentParser(add_help=False)
+    forwarding = forwarding_parser.add_argument_group(
+        description='To configure forwarding to the local service (with --forward or multi-listen):')
+    forwarding.add_argument('--max-in-flight', type=int, required=False, default=DEFAULT_MAX_IN_FLIGHT,
+                            help='Maximum number of concurrent requests to each local service. '
+                                 f'(default: {DEFAULT_MAX_IN_FLIGHT})')
+    forwarding.add_argument('--batch-max-events', type=int, required=False, default=DEFAULT_BATCH_MAX_EVENTS,
+                            help='Coalesce the events from multiple event notifications into a single request of up '
+                                 'to this many events. A request coalesces at most --server-concurrency '
+                                 f'notifications. (default: {DEFAULT_BATCH_MAX_EVENTS}, no coalescing)')
+    forwarding.add_argument('--batch-linger', type=float, required=False, default=DEFAULT_BATCH_LINGER,
+                            help='Maximum time, in seconds, to wait for more events before sending a request. A '
+                                 'request is sent without waiting once every server thread is waiting for its '
+                                 'notification to be delivered. '
+                                 f'(default: {DEFAULT_BATCH_LINGER})')
+    return forwarding_parser
+
+
+def make_rate_limit_parser() -> argparse.ArgumentParser:
+    """
+    Options for simulating rate limiting, shared by listen and bench
+    """
+    rate_limit_parser = argparse.ArgumentParser(add_help=False)
+    rate_limit = rate_limit_parser.add_argument_group(
+        description='To simulate rate limiting in the embedded webserver:')
+    rate_limit.add_argument('--rate-limit-frequency', type=int, required=False,
+                            help='Respond with "429 Too Many Requests" for this percentage of notifications.')
+    rate_limit.add_argument('--retry-after', type=int, required=False,
+                            help='Value for the "Retry-After" header in a --rate-limit-frequency response.')
+    rate_limit.add_argument('--rate-limit-rps', type=float, required=False, metavar='RPS',
+                            help='Accept this many notifications per second, sustained, responding to the rest with '
+                                 '"429 Too Many Requests" and a "Retry-After" header of the time until the next '
+                                 'would be accepted')
+    rate_limit.add_argument('--rate-limit-burst', type=int, required=False, metavar='N',
+                            help='Accept bursts of up to this many notifications above --rate-limit-rps. '
+                                 '(default: one second\'s worth)')
+    rate_limit.add_argument('--rate-limit-path', type=str, nargs='+', action='append', metavar=('PATH', 'RPS BURST'),
+                            help='Also limit notifications whose path starts with PATH to RPS per second, with bursts '
+                                 'of up to BURST. Repeat for several paths.')
+    rate_limit.add_argument('--processing-latency', type=str, required=False, metavar='DISTRIBUTION',
+                            help='Hold each accepted notification for a time drawn from DISTRIBUTION, in seconds, '
+                                 'before responding: constant:SECONDS, uniform:MIN,MAX, normal:MEAN,STDDEV, '
+                                 'exponential:MEAN or lognormal:MEDIAN,SIGMA')
+    return rate_limit_parser
+
+
+def add_listen_parser(subparsers, parents: List[argparse.ArgumentParser]):
     parser_listen = subparsers.add_parser(
         'listen',
         help='Listen for event notifications and deliver them to a local webserver.\n\n'
              'You can use an existing Event Notification rule or specify the configuration '
              'of a new, temporary rule.',
-        parents=[common_parser])
+        parents=parents)
 
     group = parser_listen.add_mutually_exclusive_group(required=True)
     group.add_argument('--url', type=str,
                        help=f'Local webserver URL, for example: "http://localhost:8080")')  # noqa
     group.add_argument('--run-server', action='store_true',
                        help=f'Run the embedded webserver')
-
-    run_server = parser_listen.add_argument_group(description='To simulate rate limiting in the embedded webserver:')
-    run_server.add_argument('--rate-limit-frequency', type=int, required=False,
-                            help='Respond with "429 Too Many Requests" for this percentage of notifications.')
-    run_server.add_argument('--retry-after', type=int, required=False,
-                            help='Value for the "Retry-After" header in a rate limit response.')
+    group.add_argument('--route', type=str, nargs='+', action='append', metavar=('URL', 'PREFIX EVENT-TYPE'),
+                       help='Deliver events whose object name starts with PREFIX, and whose event type matches '
+                            'EVENT-TYPE, for example, "b2:ObjectCreated:*", to the local webserver at URL, via the '
+                            'embedded webserver. PREFIX and EVENT-TYPE are optional. Repeat to route events to '
+                            'several local webservers; each event is delivered to every route it matches.')
+
+    spool = parser_listen.add_argument_group(
+        description='To acknowledge event notifications immediately, and spool them to disk for delivery to --url:')
+    spool.add_argument('--spool-dir', type=str, required=False,
+                       help='Directory for the spool. Spooled messages survive restarts of the local service and '
+                            'b2listen.')
+    spool.add_argument('--spool-segment-size', type=int, required=False, default=DEFAULT_SEGMENT_SIZE,
+                       help=f'Size, in bytes, at which to start a new spool segment. (default: {DEFAULT_SEGMENT_SIZE})')
+    spool.add_argument('--spool-fsync-interval', type=float, required=False, default=DEFAULT_FSYNC_INTERVAL,
+                       help='Maximum time, in seconds, between flushes of the spool to disk. '
+                            f'(default: {DEFAULT_FSYNC_INTERVAL})')
+
+    forward = parser_listen.add_argument_group(
+        description='To forward event notifications to --url via a pool of persistent connections:')
+    forward.add_argument('--forward', action='store_true',
+                         help='Forward event notifications via the embedded webserver rather than directly from '
+                              'cloudflared')
 
     use_existing = parser_listen.add_argument_group(description='To use an existing Event Notification rule:')
     use_existing.add_argument('--rule-name', type=str, required=False,
@@ -212,10 +405,13 @@ def parse_args() -> argparse.Namespace:
                             help='Event broker URL, for example: https://event-broker.acme.workers.dev.')
     use_broker.add_argument('--poll-interval', type=float, required=False, default=30,
                             help='Poll interval for checking subscription is live')
+    use_broker.add_argument('--event-broker-push', action='store_true',
+                            help='Ask the event broker to notify b2listen immediately if it removes the subscription, '
+                                 'falling back to polling if the event broker does not support it')
 
     create_temporary = parser_listen.add_argument_group(description='To create a temporary Event Notification rule:')
+    # No default, so we can tell if the user explicitly set it; validate_listen_args() fills in DEFAULT_EVENT_TYPES
     create_temporary.add_argument('--event-types', type=str, nargs='*',
-                                  default=['b2:ObjectCreated:*', 'b2:ObjectDeleted:*', 'b2:HideMarkerCreated:*'],
                                   help='Event type(s)')
     create_temporary.add_argument('--prefix', type=str, required=False, default='',
                                   help='Object name prefix. For example, "images/pets"')
@@ -227,31 +423,294 @@ def parse_args() -> argparse.Namespace:
                                choices=['debug', 'info', 'warn', 'error', 'fatal'], required=False, default='info',
                                help='cloudflared logging level. (default: "info")')
 
-    subparsers.add_parser(
+
+def add_multi_listen_parser(subparsers, parents: List[argparse.ArgumentParser]):
+    parser_multi_listen = subparsers.add_parser(
+        'multi-listen',
+        help='Listen for event notifications from several buckets through a single tunnel, delivering each '
+             'bucket/prefix\'s events to its own local webserver, as configured in a JSON file',
+        parents=parents)
+    parser_multi_listen.add_argument('config', type=str,
+                                     help='Config file listing the bucket, local webserver URL, and, optionally, '
+                                          'prefix, event types and custom headers or existing rule name for each '
+                                          'listener')
+    parser_multi_listen.add_argument('--cloudflared-loglevel', type=str,
+                                     choices=['debug', 'info', 'warn', 'error', 'fatal'], required=False,
+                                     default='info',
+                                     help='cloudflared logging level. (default: "info")')
+    parser_multi_listen.set_defaults(rate_limit_frequency=None, retry_after=None, rate_limit_rps=None,
+                                     rate_limit_burst=None, rate_limit_path=None, processing_latency=None)
+
+
+def add_cleanup_parser(subparsers):
+    parser_cleanup = subparsers.add_parser(
         'cleanup',
-        help='Remove event notification rules and kill cloudflared processes left over from previous invocations',
-        parents=[common_parser]
+        help='Remove event notification rules and kill cloudflared processes left over from previous invocations'
     )
+    parser_cleanup.add_argument('bucket_names', type=str, nargs='*', metavar='bucket-name',
+                                help='Name of a bucket to clean up')
+    parser_cleanup.add_argument('--all-buckets', action='store_true',
+                                help='Clean up every bucket the application key can access')
+    parser_cleanup.add_argument('--workers', type=int, required=False, default=DEFAULT_CLEANUP_WORKERS,
+                                help='Maximum number of buckets to clean up concurrently. '
+                                     f'(default: {DEFAULT_CLEANUP_WORKERS})')
+    parser_cleanup.add_argument('--full-scan', action='store_true',
+                                help='Rather than cleaning up after the sessions recorded in the runtime directory, '
+                                     'kill every cloudflared process started by b2listen, and delete every temporary '
+                                     'rule in the bucket')
+
+
+def add_bench_parser(subparsers, parents: List[argparse.ArgumentParser]):
+    parser_bench = subparsers.add_parser(
+        'bench',
+        help='Send generated, signed, event notification messages to a webserver and report throughput and latency',
+        parents=parents)
+    target = parser_bench.add_mutually_exclusive_group(required=True)
+    target.add_argument('--url', type=str,
+                        help='Webserver URL, for example: "http://localhost:8080"')
+    target.add_argument('--run-server', action='store_true',
+                        help='Run the embedded webserver and send messages to it')
+    load = parser_bench.add_argument_group(description='Load:')
+    load.add_argument('--events-per-request', type=int, required=False, default=DEFAULT_EVENTS_PER_REQUEST,
+                      help=f'Number of events in each message. (default: {DEFAULT_EVENTS_PER_REQUEST})')
+    load.add_argument('--concurrency', type=int, required=False, default=DEFAULT_BENCH_CONCURRENCY,
+                      help='Number of connections sending messages concurrently. '
+                           f'(default: {DEFAULT_BENCH_CONCURRENCY})')
+    load.add_argument('--rate', type=float, required=False,
+                      help='Target rate, in messages per second, across all connections. (default: as fast as '
+                           'the webserver responds)')
+    load.add_argument('--requests', type=int, required=False,
+                      help=f'Number of messages to send. (default: {DEFAULT_REQUESTS}, unless --duration is set)')
+    load.add_argument('--duration', type=float, required=False,
+                      help='Maximum time, in seconds, to send messages for')
+    parser_bench.add_argument('--json', action='store_true',
+                              help='Print the report as JSON')
+
+
+def add_replay_parser(subparsers):
+    parser_replay = subparsers.add_parser(
+        'replay',
+        help='Deliver the messages in an archive recorded with --record to a webserver')
+    parser_replay.add_argument('archive', type=str,
+                               help='Archive file')
+    parser_replay.add_argument('--url', type=str, required=True,
+                               help='Webserver URL, for example: "http://localhost:8080". Each message is sent to '
+                                    'its recorded path, relative to this URL.')
+    speed = parser_replay.add_mutually_exclusive_group()
+    speed.add_argument('--speed', type=float, required=False, default=1.0,
+                       help='Replay the messages this many times faster than they were recorded. (default: 1)')
+    speed.add_argument('--max-speed', action='store_true',
+                       help='Replay the messages as fast as the webserver accepts them')
+    parser_replay.add_argument('--start', type=float, required=False, default=0,
+                               help='Skip this many seconds from the start of the recording. (default: 0)')
+    parser_replay.add_argument('--concurrency', type=int, required=False, default=DEFAULT_BENCH_CONCURRENCY,
+                               help='Number of connections sending messages concurrently. '
+                                    f'(default: {DEFAULT_BENCH_CONCURRENCY})')
+    parser_replay.add_argument('--json', action='store_true',
+                               help='Print the report as JSON')
+
+
+def add_query_parser(subparsers):
+    parser_query = subparsers.add_parser(
+        'query',
+        help='Show the events stored in a database written with --sink-sqlite, in order of event timestamp')
+    parser_query.add_argument('database', type=str,
+                              help='Database file')
+    parser_query.add_argument('--object-prefix', type=str, required=False,
+                              help='Only show events for objects whose names start with this prefix')
+    parser_query.add_argument('--event-type', type=str, required=False,
+                              help='Only show events whose type matches this pattern, for example, "b2:ObjectCreated:*"')
+    parser_query.add_argument('--since', type=str, required=False, metavar='TIME',
+                              help='Only show events at or after this ISO 8601 time, in UTC unless it includes an '
+                                   'offset, for example, "2024-07-22T16:00"')
+    parser_query.add_argument('--until', type=str, required=False, metavar='TIME',
+                              help='Only show events before this ISO 8601 time')
+    parser_query.add_argument('--limit', type=int, required=False,
+                              help='Show at most this many events')
+    parser_query.add_argument('--json', action='store_true',
+                              help='Show each event as a line of JSON')
+
+
+def validate_server_args(args: argparse.Namespace):
+    if not 0 <= args.request_log_sample <= 1:
+        exit_with_error('--request-log-sample must be between 0 and 1')
+
+
+def validate_forwarding_args(args: argparse.Namespace):
+    if args.batch_max_events < 1:
+        exit_with_error('--batch-max-events must be at least 1')
+    if args.batch_max_events > 1 and args.server_engine == ENGINE_SIMPLE:
+        exit_with_error('You cannot specify --batch-max-events with --server-engine simple, which handles one '
+                        'message at a time')
+
+
+def validate_rate_limit_args(args: argparse.Namespace):
+    """
+    Check the rate limiting options, and parse --rate-limit-path and --processing-latency in place
+    """
+    if args.rate_limit_rps is not None and args.rate_limit_rps <= 0:
+        exit_with_error('--rate-limit-rps must be greater than 0')
+    if args.rate_limit_burst is not None:
+        if not args.rate_limit_rps:
+            exit_with_error('You must specify --rate-limit-rps with --rate-limit-burst')
+        if args.rate_limit_burst < 1:
+            exit_with_error('--rate-limit-burst must be at least 1')
+    try:
+        if args.rate_limit_path:
+            args.rate_limit_path = [parse_path_limit(values) for values in args.rate_limit_path]
+        if args.processing_latency:
+            args.processing_latency = parse_processing_latency(args.processing_latency)
+    except ValueError as e:
+        exit_with_error(str(e))
+
+
+def validate_listen_target_args(args: argparse.Namespace):
+    """
+    Check the options that select where listen delivers messages
+    """
+    if args.spool_dir and not args.url:
+        exit_with_error('You must specify --url with --spool-dir')
+    if args.forward:
+        if not args.url:
+            exit_with_error('You must specify --url with --forward')
+        if args.spool_dir:
+            exit_with_error('You cannot specify both --spool-dir and --forward')
+    if not (args.run_server or args.spool_dir or args.forward or args.route):
+        # Each of these options configures the embedded webserver
+        for options, is_set in (('--dedup', args.dedup), ('--record', args.record),
+                                ('--sink-ndjson or --sink-sqlite', args.sink_ndjson or args.sink_sqlite),
+                                ('--verify-signatures', args.verify_signatures)):
+            if is_set:
+                exit_with_error(f'You must specify --run-server, --spool-dir, --forward or --route with {options}')
+
+
+def validate_listen_args(args: argparse.Namespace):
+    if args.rule_name and (args.event_types or args.prefix or args.custom_headers):
+        exit_with_error('You cannot specify an existing rule name and configuration for a temporary rule')
+    if args.event_types is None:
+        args.event_types = DEFAULT_EVENT_TYPES
+    if args.route:
+        try:
+            args.route = [parse_route(values) for values in args.route]
+        except ValueError as e:
+            exit_with_error(str(e))
+    validate_listen_target_args(args)
+    validate_forwarding_args(args)
+    validate_server_args(args)
+    validate_rate_limit_args(args)
+
+
+def validate_multi_listen_args(args: argparse.Namespace):
+    validate_forwarding_args(args)
+    validate_server_args(args)
+
+
+def validate_cleanup_args(args: argparse.Namespace):
+    if args.all_buckets == bool(args.bucket_names):
+        exit_with_error('You must specify either one or more bucket names or --all-buckets')
 
+
+def validate_bench_args(args: argparse.Namespace):
+    validate_server_args(args)
+    if args.url and (args.rate_limit_frequency or args.retry_after or args.dedup):
+        exit_with_error('You must specify --run-server with --rate-limit-frequency, --retry-after or --dedup')
+    if args.url and (args.rate_limit_rps or args.rate_limit_path or args.processing_latency):
+        exit_with_error('You must specify --run-server with --rate-limit-rps, --rate-limit-path or '
+                        '--processing-latency')
+    validate_rate_limit_args(args)
+    if args.url and (args.record or args.verify_signatures):
+        exit_with_error('You must specify --run-server with --record or --verify-signatures')
+    if args.url and (args.sink_ndjson or args.sink_sqlite):
+        exit_with_error('You must specify --run-server with --sink-ndjson or --sink-sqlite')
+
+
+def validate_replay_args(args: argparse.Namespace):
+    if args.speed <= 0:
+        exit_with_error('--speed must be greater than 0; use --max-speed to replay as fast as possible')
+
+
+def validate_query_args(args: argparse.Namespace):
+    """
+    Parse --since and --until in place
+    """
+    for name in ('since', 'until'):
+        value = getattr(args, name)
+        if value:
+            try:
+                time_ = datetime.datetime.fromisoformat(value)
+            except ValueError:
+                exit_with_error(f'--{name} must be an ISO 8601 time, for example, "2024-07-22T16:00"; got {value}')
+            setattr(args, name, time_ if time_.tzinfo else time_.replace(tzinfo=datetime.timezone.utc))
+
+
+# Checks, beyond those argparse makes, of each command's arguments
+validators: Dict[str, Callable[[argparse.Namespace], None]] = {
+    'listen': validate_listen_args,
+    'multi-listen': validate_multi_listen_args,
+    'cleanup': validate_cleanup_args,
+    'bench': validate_bench_args,
+    'replay': validate_replay_args,
+    'query': validate_query_args,
+}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog=NAME,
+        description='Deliver Event Notifications for a given bucket to a local service.\n\n'
+                    'For more details on one command:\n\n'
+                    f'{NAME} <command> --help',
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--loglevel', type=str, choices=['debug', 'info', 'warn', 'error', 'critical'],
+                        required=False, default='info',
+                        help='Application logging level. (default: "info")')
+    parser.add_argument('--cloudflared-command', type=str, required=False, default='cloudflared',
+                        help='Command to run for cloudflared. (default: "cloudflared")')
+    parser.add_argument('--timing-report', type=str, required=False, metavar='FILE',
+                        help='On exit, write a JSON report of the time taken by each phase of startup and shutdown '
+                             'to this file, or "-" for stdout')
+    parser.add_argument('--auth-cache', type=str, nargs='?', const=default_auth_cache_dir(), required=False,
+                        metavar='DIR',
+                        help='Cache B2 authorization and bucket IDs on disk, so that subsequent runs can skip '
+                             f'authorizing with B2. (default directory: "{default_auth_cache_dir()}")')
+
+    parser.add_argument('--metrics-port', type=int, required=False, metavar='PORT',
+                        help='Serve Prometheus metrics at http://localhost:PORT/metrics')
+    parser.add_argument('--metrics-interface', type=str, required=False, default=DEFAULT_METRICS_INTERFACE,
+                        help='Interface on which to serve metrics; in Docker, use 0.0.0.0 and publish the port. '
+                             f'(default: "{DEFAULT_METRICS_INTERFACE}")')
+
+    parser.add_argument('--runtime-dir', type=str, required=False, default=default_runtime_dir(), metavar='DIR',
+                        help='Directory in which to record running sessions, so that the cleanup command can find '
+                             f'them. (default: "{default_runtime_dir()}")')
+
+    common_parser = argparse.ArgumentParser(add_help=False)
+    common_parser.add_argument('bucket_name', type=str, metavar='bucket-name',
+                               help='Name of the bucket')
+
+    server_parser = make_server_parser()
+    forwarding_parser = make_forwarding_parser()
+    rate_limit_parser = make_rate_limit_parser()
+
+    subparsers = parser.add_subparsers(help='Sub-command help', dest='cmd', required=True)
+    add_listen_parser(subparsers, [common_parser, server_parser, forwarding_parser, rate_limit_parser])
+    add_multi_listen_parser(subparsers, [server_parser, forwarding_parser])
+    add_cleanup_parser(subparsers)
+    add_bench_parser(subparsers, [server_parser, rate_limit_parser])
+    add_replay_parser(subparsers)
+    add_query_parser(subparsers)
     subparsers.add_parser(
         'version',
         help='Show the version number'
     )
 
     args = parser.parse_args()
-
-    # Remove default for event types, so we can tell if the user explicitly set it
-    create_temporary.set_defaults(event_types=None)
-
-    user_set_args = parser.parse_args()
-
-    if (args.cmd == 'listen'
-            and args.rule_name
-            and (user_set_args.event_types or args.prefix or args.custom_headers)):
-        exit_with_error('You cannot specify an existing rule name and configuration for a temporary rule')
+    if args.cmd in validators:
+        validators[args.cmd](args)
     return args
 
 
+@timer.timed
 def check_bucket_allowed(b2_api: B2Api, bucket_name: str):
     allowed = b2_api.account_info.get_allowed()
     allowed_bucket_name = allowed['bucketName']
@@ -262,22 +721,113 @@ def check_bucket_allowed(b2_api: B2Api, bucket_name: str):
         exit_with_error(f'Application key {application_key} is not authorized for {bucket_name}')
 
 
-def authorize_b2() -> B2Api:
+def default_auth_cache_dir() -> str:
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), NAME)
+
+
+def cached_account_info(auth_cache_dir: str, application_key_id: str) -> AbstractAccountInfo:
+    """
+    Account info persisted in auth_cache_dir, keyed by application key ID, or, if it cannot be opened, in memory
+    """
+    from b2sdk.v2 import InMemoryAccountInfo, SqliteAccountInfo
+
+    try:
+        os.makedirs(auth_cache_dir, mode=0o700, exist_ok=True)
+        return SqliteAccountInfo(file_name=os.path.join(auth_cache_dir, f'account-info-{application_key_id}.sqlite'))
+    except Exception as e:  # noqa
+        logger.warning(f'Cannot use authorization cache in {auth_cache_dir}: {e}')
+        return InMemoryAccountInfo()
+
+
+@contextmanager
+def quiet_account_info():
+    """
+    SqliteAccountInfo logs an error whenever it is asked for account data it doesn't have, as it will be for a new
+    cache, so silence it while we find out
+    """
+    from b2sdk.v2 import SqliteAccountInfo
+
+    sqlite_logger = logging.getLogger(SqliteAccountInfo.__module__)
+    level = sqlite_logger.level
+    sqlite_logger.setLevel(logging.CRITICAL)
+    try:
+        yield
+    finally:
+        sqlite_logger.setLevel(level)
+
+
+def get_credentials() -> Tuple[str, str]:
+    """
+    :return: the application key ID and application key, exiting with an error if either is not set
+    """
     application_key_id, application_key = check_and_get_env_vars(['B2_APPLICATION_KEY_ID', 'B2_APPLICATION_KEY'])
+    return application_key_id, application_key
+
+
+@timer.timed
+def authorize_b2(auth_cache_dir: str | None = None, credentials: Tuple[str, str] | None = None) -> B2Api:
+    """
+    Authorize with B2. If auth_cache_dir is set, reuse a cached authorization for the application key if there is one.
+    B2Api reauthorizes automatically if the cached auth token has expired.
+    :param credentials: the application key ID and application key; if not set, they are read from the environment
+    """
+    from b2sdk.v2 import AuthInfoCache, B2Api, B2HttpApiConfig, InMemoryAccountInfo
+
+    application_key_id, application_key = credentials or get_credentials()
     logger.debug(f'Application Key ID = {application_key_id}')
     # First 4 chars of application key are the cluster - not secret, and helpful for debugging!
     logger.debug(f'Application Key = {application_key[:4] + ("*" * 27)}')
 
-    info = InMemoryAccountInfo()
+    info = cached_account_info(auth_cache_dir, application_key_id) if auth_cache_dir else InMemoryAccountInfo()
     api_config = B2HttpApiConfig(user_agent_append=f'{NAME}/{version()}')
     b2_api = B2Api(info, cache=AuthInfoCache(info), api_config=api_config)
-    b2_api.authorize_account("production", application_key_id, application_key)
+    with quiet_account_info():
+        if (auth_cache_dir and info.is_same_key(application_key_id, 'production')
+                and info.get_application_key() == application_key):
+            logger.debug(f'Using cached authorization from {info.filename}')
+        else:
+            b2_api.authorize_account("production", application_key_id, application_key)
 
     return b2_api
 
 
+def get_bucket(bucket_name: str, auth_cache_dir: str | None = None,
+               credentials: Tuple[str, str] | None = None) -> Bucket:
+    """
+    Authorize with B2 and get the bucket, checking that the application key is allowed to access it
+    """
+    return get_buckets([bucket_name], auth_cache_dir, credentials)[bucket_name]
+
+
+def get_buckets(bucket_names: List[str], auth_cache_dir: str | None = None,
+                credentials: Tuple[str, str] | None = None) -> Dict[str, Bucket]:
+    """
+    Authorize with B2 once and get each of the buckets, checking that the application key is allowed to access them
+    """
+    from b2sdk.v2.exception import NonExistentBucket
+
+    b2_api: B2Api = authorize_b2(auth_cache_dir, credentials)
+
+    buckets = {}
+    for bucket_name in bucket_names:
+        check_bucket_allowed(b2_api, bucket_name)
+
+        with timer.phase('get_bucket_by_name'):
+            try:
+                buckets[bucket_name] = b2_api.get_bucket_by_name(bucket_name)
+            except NonExistentBucket as e:
+                exit_with_error(f'Bucket "{bucket_name}" does not exist', exc_info=e)
+    return buckets
+
+
 def run_cloudflared(command: str, loglevel: str, service_url: str, label: str, url_handler: Callable[[str], None],
-                    exit_handler: Callable[[], None]):
+                    exit_handler: Callable[[], None], session: Session | None = None,
+                    drain: Callable[[], None] | None = None):
+    """
+    Run cloudflared until it exits or we are interrupted, then shut down in order: run exit_handler, so that no new
+    events are sent to the tunnel, then drain, to finish delivering the events already on their way, and only then
+    stop cloudflared
+    """
     cmd = [command,
            '--no-autoupdate',
            'tunnel',
@@ -287,32 +837,55 @@ def run_cloudflared(command: str, loglevel: str, service_url: str, label: str, u
     process = None
     found_url = False
     try:
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            bufsize=1,
-            text=True
-        )
+        with timer.phase('cloudflared_spawn'):
+            process = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                bufsize=1,
+                text=True,
+                # In its own session, so that Ctrl-C in the terminal doesn't stop the tunnel before we have drained it
+                start_new_session=True
+            )
+        if session:
+            session.started(process)
+
+        output = CloudflaredOutput(process)
 
         url_line_regex = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z\sINF\s\|\s+(https://[a-z0-9.\-]+)\s+\|$')
         reg_tunnel_regex = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z\sINF\s(Registered tunnel connection .+)$')
-        while True:
-            line = process.stderr.readline().strip()
-            logger.debug(line)
+        cloudflared_version_regex = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z\sINF\sVersion\s(\S+)')
+        while (line := output.next_line()) is not None:
             if not found_url:
                 match = url_line_regex.match(line)
                 if match:
                     tunnel_url = match.group(1)
+                    timer.mark('tunnel_url')
                     logger.info(f'Tunnel URL: {tunnel_url}')
-                    url_handler(tunnel_url)
+                    with timer.phase('url_handler'):
+                        url_handler(tunnel_url)
                     found_url = True
             else:
                 match = reg_tunnel_regex.match(line)
                 if match:
                     reg_line = match.group(1)
+                    timer.mark('tunnel_registered')
                     logger.info(reg_line)
                     logger.info(f'Ready to deliver events to {service_url}')
+                    timer.mark('ready')
+                    metrics.tunnel_up.set(1)
+                    break
+
+        version_match = next(filter(None, (cloudflared_version_regex.match(line) for line in output.recent())), None)
+        if version_match:
+            timer.info['cloudflared_version'] = version_match.group(1)
+
+        # Either the tunnel is up or cloudflared has exited - there's nothing more to look for in its output
+        output.stop_matching()
+        returncode = process.wait()
+        metrics.tunnel_up.set(0)
+        recent_output = '\n'.join(output.recent())
+        exit_with_error(f'cloudflared exited with status {returncode}. Recent output:\n{recent_output}')
 
     except FileNotFoundError:
         exit_with_error(f'Cannot find cloudflared executable at {command}')
@@ -322,86 +895,383 @@ def run_cloudflared(command: str, loglevel: str, service_url: str, label: str, u
         pass
 
     finally:
-        if process:
-            logger.info('Stopping cloudflared')
-            process.kill()
-        if exit_handler:
-            exit_handler()
-
+        timer.mark('shutdown')
+        with timer.phase('shutdown'):
+            try:
+                if exit_handler:
+                    with timer.phase('exit_handler'):
+                        exit_handler()
+                if drain:
+                    try:
+                        with timer.phase('drain'):
+                            drain()
+                    except KeyboardInterrupt:
+                        logger.warning('Interrupted while draining event notifications')
+            finally:
+                # However the exit handler or drain ended, the tunnel must not outlive us
+                if process:
+                    logger.info('Stopping cloudflared')
+                    with timer.phase('cloudflared_stop'):
+                        process.kill()
+                        process.wait()
+                metrics.tunnel_up.set(0)
+                if session:
+                    session.close()
+
+
+def start_server(args: argparse.Namespace, target=None, dedup: DedupIndex | None = None,
+                 log_requests: bool = True) -> Server:
+    """
+    Start the embedded webserver
+    """
+    import sqlite3
+    from b2listen.server import Server
 
-def listen(args: argparse.Namespace):
-    if args.run_server:
-        http_server = Server(interface='localhost', port=0, daemon=True,
-                             rate_limit_frequency=args.rate_limit_frequency, retry_after=args.retry_after)
-        http_server.start()
-        service_url = f'http://{http_server.interface}:{http_server.port}'  # noqa
+    signing_secret = os.environ.get('SIGNING_SECRET')
+    if args.verify_signatures:
+        if not signing_secret:
+            exit_with_error('You must set the SIGNING_SECRET environment variable to use --verify-signatures')
+        validate_signing_secret(signing_secret)
+    request_log = RequestLog(args.request_log, sample_rate=args.request_log_sample,
+                             max_body=args.request_log_max_body, path=args.request_log_file)
+    try:
+        recorder = ArchiveWriter(args.record) if args.record else None
+    except OSError as e:
+        exit_with_error(f'Cannot record messages to {args.record}: {e}')
+    try:
+        if args.sink_ndjson:
+            sink = NdjsonSink(args.sink_ndjson, max_file_size=args.sink_max_file_size,
+                              batch_size=args.sink_batch_size, batch_interval=args.sink_batch_interval)
+        elif args.sink_sqlite:
+            sink = SqliteSink(args.sink_sqlite, batch_size=args.sink_batch_size,
+                              batch_interval=args.sink_batch_interval)
+        else:
+            sink = None
+    except (OSError, sqlite3.Error) as e:
+        exit_with_error(f'Cannot store events in {args.sink_ndjson or args.sink_sqlite}: {e}')
+    rate_limiter = RateLimiter(args.rate_limit_rps, args.rate_limit_burst, args.rate_limit_path or []) \
+        if args.rate_limit_rps or args.rate_limit_path else None
+    http_server = Server(interface='localhost', port=0, daemon=True,
+                         rate_limit_frequency=args.rate_limit_frequency, retry_after=args.retry_after,
+                         engine=args.server_engine, concurrency=args.server_concurrency,
+                         keep_alive_timeout=args.keep_alive_timeout, target=target, dedup=dedup,
+                         log_requests=log_requests and args.request_log == MODE_FULL,
+                         signing_secret=signing_secret, request_log=request_log, recorder=recorder,
+                         verify_signatures=args.verify_signatures, rate_limiter=rate_limiter,
+                         processing_latency=args.processing_latency, sink=sink)
+    http_server.start()
+    return http_server
+
+
+def drain_server(http_server: Server, timeout: float, spool_forwarder: SpoolForwarder | None = None):
+    """
+    Wait up to timeout seconds for the embedded webserver to finish handling messages, and, if spool_forwarder is set,
+    for the spool to be forwarded, then stop the webserver
+    """
+    deadline = time.monotonic() + timeout
+    logger.info(f'Draining event notifications for up to {timeout} seconds')
+    report = http_server.drain(timeout)
+    message = f'Drained {report["drained_messages"]} messages ({report["drained_events"]} events)'
+    if report['abandoned_messages']:
+        logger.warning(f'{message}; abandoned {report["abandoned_messages"]} messages '
+                       f'({report["abandoned_events"]} events) still being handled after {timeout} seconds')
     else:
-        service_url = args.url
+        logger.info(message)
+    if spool_forwarder:
+        report['spool_forwarded'] = spool_forwarder.drain(max(0.0, deadline - time.monotonic()))
+        if not report['spool_forwarded']:
+            logger.warning(f'Spooled event notifications remain in {spool_forwarder.spool.directory}; they will be '
+                           f'forwarded the next time B2listen runs with this --spool-dir')
+    timer.info['drain'] = report
+
 
-    b2_api: B2Api = authorize_b2()
+def make_dedup(args: argparse.Namespace) -> DedupIndex | None:
+    if not args.dedup:
+        return None
+    dedup = DedupIndex(capacity=args.dedup_capacity, ttl=args.dedup_ttl, bloom=args.dedup_bloom)
+    metrics.duplicate_events.set_function(lambda: dedup.hits)
+    return dedup
 
-    check_bucket_allowed(b2_api, args.bucket_name)
 
-    b2bucket: Bucket = b2_api.get_bucket_by_name(args.bucket_name)
+def make_forwarder(args: argparse.Namespace, url: str, signing_secret: str | None) -> Forwarder:
+    # Each of the embedded webserver's request threads waits while its message is forwarded, so a batch can hold at
+    # most one message from each
+    return Forwarder(url, max_in_flight=args.max_in_flight, max_batch_events=args.batch_max_events,
+                     max_linger=args.batch_linger, signing_secret=signing_secret, max_callers=args.server_concurrency)
 
-    # Label for cloudflared, used as name for temporary rule
+
+class EmbeddedServer(NamedTuple):
+    """
+    The embedded webserver, with the spool and spool forwarder, or the forwarders, that deliver the messages it accepts
+    """
+    http_server: Server
+    spool: Spool | None = None
+    spool_forwarder: SpoolForwarder | None = None
+    forwarders: Tuple[Forwarder, ...] = ()
+
+    def drain(self, timeout: float):
+        drain_server(self.http_server, timeout, self.spool_forwarder)
+
+    def close(self):
+        for forwarder in self.forwarders:
+            forwarder.close()
+        if self.spool:
+            # fsync whatever the webserver spooled since the last periodic fsync
+            self.spool.close()
+
+
+def start_embedded_server(args: argparse.Namespace, dedup: DedupIndex | None = None,
+                          listeners: List[Listener] | None = None) -> EmbeddedServer | None:
+    """
+    Start the embedded webserver, and whatever delivers the messages it accepts, for listen or, given listeners, for
+    multi-listen
+    :return: None if listen delivers messages directly from cloudflared to --url
+    """
+    signing_secret = os.environ.get('SIGNING_SECRET')
+    if listeners is not None:
+        # Route each listener's path on the tunnel to a forwarder for its local service. Listeners that deliver to the
+        # same local service share a forwarder, and its connection pool.
+        forwarders: Dict[str, Forwarder] = {}
+        for listener in listeners:
+            if listener.url not in forwarders:
+                forwarders[listener.url] = make_forwarder(args, listener.url, signing_secret)
+        router = PathRouter({listener.name: forwarders[listener.url] for listener in listeners})
+        return EmbeddedServer(start_server(args, target=router, dedup=dedup), forwarders=tuple(forwarders.values()))
+    if args.run_server:
+        return EmbeddedServer(start_server(args, dedup=dedup))
+    if args.spool_dir:
+        # Accept messages into the spool via the embedded webserver, and forward them from there
+        spool = Spool(args.spool_dir, segment_size=args.spool_segment_size,
+                      fsync_interval=args.spool_fsync_interval)
+        http_server = start_server(args, target=spool, dedup=dedup)
+        spool_forwarder = SpoolForwarder(spool, args.url)
+        spool_forwarder.start()
+        return EmbeddedServer(http_server, spool=spool, spool_forwarder=spool_forwarder)
+    if args.forward:
+        forwarder = make_forwarder(args, args.url, signing_secret)
+        return EmbeddedServer(start_server(args, target=forwarder, dedup=dedup), forwarders=(forwarder,))
+    if args.route:
+        forwarders = {route.url: make_forwarder(args, route.url, signing_secret) for route in args.route}
+        router = EventRouter(args.route, forwarders, signing_secret=signing_secret,
+                             concurrency=args.server_concurrency)
+        return EmbeddedServer(start_server(args, target=router, dedup=dedup), forwarders=tuple(forwarders.values()))
+    return None
+
+
+def make_label() -> str:
+    """
+    Label for cloudflared, used as the name, or the start of the name, of temporary rules
+    """
     # 2020-03-20T14:28:23.382748 -> 2020-03-20-14-28-23-382748
     timestamp = (datetime.datetime.now().isoformat()
                  .replace(':', '-')
                  .replace('T', '-')
                  .replace('.', '-'))
-    label = f'{EVENT_NOTIFICATION_RULE_PREFIX}{timestamp}--'
+    return f'{EVENT_NOTIFICATION_RULE_PREFIX}{timestamp}--'
 
-    signing_secret: str = os.environ.get('SIGNING_SECRET')
 
-    if args.event_broker_url:
-        subscription: Subscription | None = None
-        if not signing_secret:
-            exit_with_error('You must set the SIGNING_SECRET environment variable')
-        validate_signing_secret(signing_secret)
+# Called with the tunnel's URL once it is up, and on exit, to point event notifications at the tunnel and back again
+Handlers = Tuple[Callable[[str], None], Callable[[], None]]
 
-        def url_handler(url):
-            nonlocal subscription
-            logger.info(f'Subscribing for updates from {args.event_broker_url}')
-            subscription = Subscription(args.event_broker_url, url, args.bucket_name, args.rule_name, signing_secret,
-                                        args.poll_interval)
 
-        def exit_handler():
-            nonlocal subscription
+def subscription_handlers(args: argparse.Namespace, signing_secret: str | None,
+                          wait_for_bucket: Callable[[], Bucket]) -> Handlers:
+    """
+    Subscribe to the event broker for the bucket's event notifications, and unsubscribe on exit
+    """
+    from b2listen.subscription import Subscription
+
+    subscription: Subscription | None = None
+    if not signing_secret:
+        exit_with_error('You must set the SIGNING_SECRET environment variable')
+    validate_signing_secret(signing_secret)
+
+    def url_handler(url):
+        nonlocal subscription
+        # Don't subscribe unless the application key is authorized for the bucket
+        wait_for_bucket()
+        logger.info(f'Subscribing for updates from {args.event_broker_url}')
+        with timer.phase('subscribe'):
+            subscription = Subscription(args.event_broker_url, url, args.bucket_name, args.rule_name,
+                                        signing_secret, args.poll_interval, push=args.event_broker_push)
+
+    def exit_handler():
+        nonlocal subscription
+        if subscription:
             logger.info(f'Unsubscribing from updates from {args.event_broker_url}')
             subscription.stop()
 
+    return url_handler, exit_handler
+
+
+def existing_rule_handlers(args: argparse.Namespace, session: Session,
+                           wait_for_bucket: Callable[[], Bucket]) -> Handlers:
+    """
+    Modify an existing rule to deliver to the tunnel, and restore its URL on exit
+    """
+    # We need to remember the old URL to restore it on exit
+    old_url: str | None = None
+    rule_set: RuleSet | None = None
+
+    def url_handler(url):
+        nonlocal old_url, rule_set
+        rule_set = RuleSet(wait_for_bucket())
+        old_url = modify_rule(rule_set, url, args.rule_name)
+        session.add_rule(args.bucket_name, args.rule_name, old_url)
+
+    def exit_handler():
+        nonlocal old_url
+        if old_url:
+            modify_rule(rule_set, old_url, args.rule_name)
+            session.remove_rules(args.bucket_name)
+
+    return url_handler, exit_handler
+
+
+def temporary_rule_handlers(args: argparse.Namespace, label: str, session: Session, signing_secret: str | None,
+                            wait_for_bucket: Callable[[], Bucket]) -> Handlers:
+    """
+    Create a temporary rule, using the label as its name, and delete it on exit
+    """
+    created_rule: bool = False
+    rule_set: RuleSet | None = None
+
+    def url_handler(url):
+        nonlocal created_rule, rule_set
+        if signing_secret:
+            validate_signing_secret(signing_secret)
+        rule_set = RuleSet(wait_for_bucket())
+        create_rule(rule_set, url, label, args, signing_secret)
+        created_rule = True
+        session.add_rule(args.bucket_name, label, None)
+
+    def exit_handler():
+        nonlocal created_rule
+        if created_rule:
+            delete_rule(rule_set, label)
+            session.remove_rules(args.bucket_name)
+
+    return url_handler, exit_handler
+
+
+def listener_rule_handlers(listeners_by_bucket: Dict[str, List[Listener]], buckets_future: Future[Dict[str, Bucket]],
+                           label: str, session: Session, signing_secret: str | None) -> Handlers:
+    """
+    Create or modify each listener's rule to deliver to its path on the tunnel, and undo the changes on exit
+    """
+    # Each bucket's rules, and the changes made to them, so that we can undo them on exit
+    rule_sets: Dict[str, RuleSet] = {}
+    changes: Dict[str, Dict[str, str | None]] = {}
+
+    def url_handler(url):
+        with timer.phase('wait_for_bucket'):
+            buckets = buckets_future.result()
+        for bucket_name, bucket_listeners in listeners_by_bucket.items():
+            rule_sets[bucket_name] = RuleSet(buckets[bucket_name])
+            changes[bucket_name] = set_listener_rules(rule_sets[bucket_name], bucket_listeners, url, label,
+                                                      signing_secret)
+            for name, old_url in changes[bucket_name].items():
+                session.add_rule(bucket_name, name, old_url)
+
+    def exit_handler():
+        for bucket_name, bucket_changes in changes.items():
+            try:
+                restore_listener_rules(rule_sets[bucket_name], bucket_changes)
+                session.remove_rules(bucket_name)
+            except Exception as e:  # noqa
+                # Carry on restoring the other buckets' rules
+                logger.error(f'Error restoring rules in bucket "{bucket_name}" - run the "cleanup" command for '
+                             f'this bucket: {e}')
+
+    return url_handler, exit_handler
+
+
+def listen(args: argparse.Namespace):
+    # Check for the credentials before starting anything, rather than on the thread that authorizes with B2
+    credentials = get_credentials()
+    dedup = make_dedup(args)
+
+    embedded_server = start_embedded_server(args, dedup=dedup)
+    service_url = embedded_server.http_server.url if embedded_server else args.url
+
+    # Authorize with B2 and get the bucket while cloudflared brings up the tunnel. The URL handler waits for the bucket.
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='b2listen-authorize')
+    bucket_future: Future[Bucket] = executor.submit(get_bucket, args.bucket_name, args.auth_cache, credentials)
+    executor.shutdown(wait=False)
+
+    def wait_for_bucket() -> Bucket:
+        with timer.phase('wait_for_bucket'):
+            return bucket_future.result()
+
+    # Label for cloudflared, used as name for temporary rule
+    label = make_label()
+    session = Session(args.runtime_dir, label, 'listen', [args.bucket_name])
+
+    signing_secret: str = os.environ.get('SIGNING_SECRET')
+
+    if args.event_broker_url:
+        url_handler, exit_handler = subscription_handlers(args, signing_secret, wait_for_bucket)
+    elif args.rule_name:
+        url_handler, exit_handler = existing_rule_handlers(args, session, wait_for_bucket)
     else:
-        # Did the user specify a rule name?
-        if args.rule_name:
-            # Yes - modify an existing rule
-            # We need to remember the old URL to restore it on exit
-            old_url: str | None = None
-
-            def url_handler(url):
-                nonlocal old_url, b2bucket
-                old_url = modify_rule(b2bucket, url, args.rule_name)
-
-            def exit_handler():
-                nonlocal old_url, b2bucket
-                modify_rule(b2bucket, old_url, args.rule_name)
-        else:
-            created_rule: bool = False
+        url_handler, exit_handler = temporary_rule_handlers(args, label, session, signing_secret, wait_for_bucket)
 
-            # No - create a temporary rule using the label as its name
-            def url_handler(url):
-                nonlocal created_rule
-                if signing_secret:
-                    validate_signing_secret(signing_secret)
-                create_rule(b2bucket, url, label, args, signing_secret)
-                created_rule = True
+    def drain():
+        # With --url, cloudflared delivers directly to the local service, so there is nothing for us to drain
+        if embedded_server:
+            embedded_server.drain(args.drain_timeout)
 
-            def exit_handler():
-                nonlocal created_rule
-                if created_rule:
-                    delete_rule(b2bucket, label)
+    try:
+        run_cloudflared(args.cloudflared_command, args.cloudflared_loglevel, service_url, label, url_handler,
+                        exit_handler, session, drain)
+    finally:
+        if embedded_server:
+            embedded_server.close()
 
-    run_cloudflared(args.cloudflared_command, args.cloudflared_loglevel, service_url, label, url_handler, exit_handler)
+    if dedup:
+        logger.info(f'Dedup index statistics: {json.dumps(dedup.stats())}')
+
+
+def multi_listen(args: argparse.Namespace):
+    credentials = get_credentials()
+    try:
+        listeners = load_config(args.config)
+    except (OSError, ValueError) as e:
+        exit_with_error(f'Cannot load config from {args.config}: {e}')
+
+    signing_secret: str = os.environ.get('SIGNING_SECRET')
+    if signing_secret:
+        validate_signing_secret(signing_secret)
+
+    dedup = make_dedup(args)
+
+    embedded_server = start_embedded_server(args, dedup=dedup, listeners=listeners)
+    service_url = embedded_server.http_server.url
+
+    # Group listeners by bucket, so that each bucket's rules are read and written once
+    listeners_by_bucket: Dict[str, List[Listener]] = {}
+    for listener in listeners:
+        listeners_by_bucket.setdefault(listener.bucket_name, []).append(listener)
+
+    # Authorize with B2 and get the buckets while cloudflared brings up the tunnel
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='b2listen-authorize')
+    buckets_future: Future[Dict[str, Bucket]] = executor.submit(get_buckets, list(listeners_by_bucket),
+                                                                args.auth_cache, credentials)
+    executor.shutdown(wait=False)
+
+    label = make_label()
+    session = Session(args.runtime_dir, label, 'multi-listen', list(listeners_by_bucket))
+
+    url_handler, exit_handler = listener_rule_handlers(listeners_by_bucket, buckets_future, label, session,
+                                                       signing_secret)
+
+    try:
+        run_cloudflared(args.cloudflared_command, args.cloudflared_loglevel, service_url, label, url_handler,
+                        exit_handler, session, lambda: embedded_server.drain(args.drain_timeout))
+    finally:
+        embedded_server.close()
+    if dedup:
+        logger.info(f'Dedup index statistics: {json.dumps(dedup.stats())}')
 
 
 def parse_custom_headers(custom_headers_arg: List[str] | None) -> List[Dict[str, str]] | None:
@@ -423,6 +1293,8 @@ def parse_custom_headers(custom_headers_arg: List[str] | None) -> List[Dict[str,
 
 
 def cleanup_processes(cloudflared_command: str):
+    import psutil
+
     killed_count = 0
     for process in psutil.process_iter():
         try:
@@ -444,39 +1316,218 @@ def cleanup_processes(cloudflared_command: str):
         logger.info(f'Could not find any processes with {EVENT_NOTIFICATION_RULE_PREFIX} in the command line')
 
 
-# Suppress warnings about incompatible types
-# noinspection PyTypeChecker
-def cleanup_rules(b2bucket: Bucket):
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        old_rules = b2bucket.get_notification_rules()
-        new_rules = []
-        for rule in old_rules:
-            if rule['name'].startswith(EVENT_NOTIFICATION_RULE_PREFIX):
-                logger.info(f'Deleting rule "{rule["name"]}"')
-            else:
-                new_rules.append(rule)
-        if len(new_rules) == len(old_rules):
-            logger.info(f'No rules to cleanup (prefix is "{EVENT_NOTIFICATION_RULE_PREFIX}").')
+def cleanup_rules(b2bucket: Bucket) -> Dict[str, int]:
+    rule_set = RuleSet(b2bucket)
+    deleted = rule_set.delete_matching(lambda rule: rule['name'].startswith(EVENT_NOTIFICATION_RULE_PREFIX))
+    for name in deleted:
+        logger.info(f'Deleting rule "{name}" in bucket "{b2bucket.name}"')
+    if not deleted:
+        logger.info(f'No rules to cleanup in bucket "{b2bucket.name}" (prefix is "{EVENT_NOTIFICATION_RULE_PREFIX}").')
+    else:
+        rule_set.commit()
+    return {'deleted': len(deleted)}
+
+
+def session_to_clean(entry: Entry, bucket_name: str, counts: Dict[str, int]) -> bool:
+    """
+    Kill the cloudflared process of a session in the bucket, unless its b2listen process is still running
+    :return: True if the session's rules in the bucket are to be deleted or restored
+    """
+    if bucket_name not in entry.buckets:
+        return False
+    if entry.owner_running():
+        logger.info(f'Skipping session "{entry.label}" - b2listen process {entry.record["owner_pid"]} is still '
+                    f'running')
+        counts['skipped'] += 1
+        return False
+    pid = entry.kill_cloudflared()
+    if pid:
+        logger.info(f'Killed process {pid} for session "{entry.label}"')
+        counts['killed'] += 1
+    return True
+
+
+def clean_session_rule(rule_set: RuleSet, bucket_name: str, rule: Dict, counts: Dict[str, int]):
+    """
+    Delete a rule that a session created, or restore the URL of a rule that it modified
+    """
+    if rule['old_url'] is None:
+        logger.info(f'Deleting rule "{rule["name"]}" in bucket "{bucket_name}"')
+        if rule_set.delete(rule['name']):
+            counts['deleted'] += 1
         else:
-            b2bucket.set_notification_rules(new_rules)
+            logger.info(f'Rule "{rule["name"]}" was already deleted')
+    else:
+        logger.info(f'Restoring URL of rule "{rule["name"]}" in bucket "{bucket_name}" to {rule["old_url"]}')
+        try:
+            rule_set.modify_url(rule['name'], rule['old_url'])
+            counts['restored'] += 1
+        except RuleNotFound:
+            logger.warning(f'Could not find rule "{rule["name"]}" - did you delete it manually?')
+
+
+def cleanup_sessions(b2bucket: Bucket, entries: List[Entry]) -> Dict[str, int]:
+    """
+    Kill the cloudflared processes, and delete or restore the rules in the bucket, recorded in the registry by sessions
+    whose b2listen process is no longer running
+    """
+    counts = {'deleted': 0, 'restored': 0, 'killed': 0, 'skipped': 0}
+    rule_set = RuleSet(b2bucket)
+    cleaned = [entry for entry in entries if session_to_clean(entry, b2bucket.name, counts)]
+    for entry in cleaned:
+        for rule in entry.rules:
+            if rule['bucket'] == b2bucket.name:
+                clean_session_rule(rule_set, b2bucket.name, rule, counts)
+
+    rule_set.commit()
+    for entry in cleaned:
+        entry.remove_rules(b2bucket.name)
+    if not cleaned and not counts['skipped']:
+        logger.info(f'No sessions to clean up for bucket "{b2bucket.name}". Use --full-scan to look for rules and '
+                    f'processes left by b2listen sessions that were not recorded in the runtime directory.')
+    return counts
+
+
+def format_counts(counts: Dict[str, int]) -> str:
+    return ', '.join(f'{key} {value}' for key, value in counts.items())
+
+
+def select_cleanup_buckets(b2_api: B2Api, args: argparse.Namespace) -> Tuple[Dict[str, Bucket], List[str]]:
+    """
+    :return: the buckets that were listed, by name, and the names of the buckets to clean up
+    """
+    if args.all_buckets:
+        with timer.phase('list_buckets'):
+            listed = {bucket.name: bucket for bucket in b2_api.list_buckets()}
+        return listed, sorted(listed)
+
+    # Remove duplicates, preserving order
+    bucket_names = list(dict.fromkeys(args.bucket_names))
+    for bucket_name in bucket_names:
+        check_bucket_allowed(b2_api, bucket_name)
+    return {}, bucket_names
+
+
+def cleanup_buckets(b2_api: B2Api, listed: Dict[str, Bucket], bucket_names: List[str], workers: int,
+                    clean: Callable[[Bucket], Dict[str, int]]) -> Dict[str, Dict[str, int] | str]:
+    """
+    Clean up the buckets concurrently
+    :return: the counts for each bucket, or a description of the error that prevented its cleanup
+    """
+    from b2sdk.v2.exception import NonExistentBucket
+
+    def cleanup_bucket(bucket_name: str) -> Dict[str, int]:
+        return clean(listed.get(bucket_name) or b2_api.get_bucket_by_name(bucket_name))
+
+    results: Dict[str, Dict[str, int] | str] = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='b2listen-cleanup') as executor:
+        futures = {bucket_name: executor.submit(cleanup_bucket, bucket_name) for bucket_name in bucket_names}
+        for bucket_name, future in futures.items():
+            try:
+                results[bucket_name] = future.result()
+            except NonExistentBucket:
+                results[bucket_name] = 'bucket does not exist'
+            except Exception as e:  # noqa
+                logger.debug(f'Error cleaning up bucket "{bucket_name}"', exc_info=e)
+                results[bucket_name] = f'error: {e}'
+    return results
 
 
 def cleanup(args: argparse.Namespace):
-    b2_api: B2Api = authorize_b2()
+    b2_api: B2Api = authorize_b2(args.auth_cache)
+    listed, bucket_names = select_cleanup_buckets(b2_api, args)
+
+    if args.full_scan:
+        clean = cleanup_rules
+    else:
+        # Read the registry once, so that the workers share the entries of sessions that span several buckets
+        entries = read_entries(args.runtime_dir)
+
+        def clean(b2bucket: Bucket) -> Dict[str, int]:
+            return cleanup_sessions(b2bucket, entries)
+
+    results = cleanup_buckets(b2_api, listed, bucket_names, args.workers, clean)
+
+    if args.full_scan:
+        cleanup_processes(args.cloudflared_command)
+
+    if len(results) > 1:
+        summary = '\n'.join(f'  {bucket_name}: {result if isinstance(result, str) else format_counts(result)}'
+                            for bucket_name, result in results.items())
+        logger.info(f'Cleaned up {len(results)} buckets:\n{summary}')
+    failures = [bucket_name for bucket_name, result in results.items() if isinstance(result, str)]
+    if failures:
+        exit_with_error(f'Could not clean up {", ".join(failures)}: '
+                        f'{"; ".join(results[bucket_name] for bucket_name in failures)}')
+
+
+def bench(args: argparse.Namespace):
+    if args.run_server:
+        # Logging every message would measure the logging rather than the webserver
+        verbose = logger.getEffectiveLevel() <= logging.DEBUG
+        if not verbose:
+            logging.getLogger('b2listen.server').setLevel(logging.WARNING)
+        dedup = make_dedup(args)
+        url = start_server(args, dedup=dedup, log_requests=verbose).url
+    else:
+        url = args.url
+
+    requests = args.requests if args.requests is not None or args.duration is not None else DEFAULT_REQUESTS
+    try:
+        generator = LoadGenerator(url, concurrency=args.concurrency, requests=requests, duration=args.duration,
+                                  rate=args.rate, events_per_request=args.events_per_request,
+                                  signing_secret=os.environ.get('SIGNING_SECRET'))
+    except ValueError as e:
+        exit_with_error(str(e))
+
+    with timer.phase('bench'):
+        report = generator.run()
+
+    print_report(report, args.json)
 
-    check_bucket_allowed(b2_api, args.bucket_name)
 
-    b2bucket: Bucket = b2_api.get_bucket_by_name(args.bucket_name)
+def print_report(report: Dict, as_json: bool):
+    if as_json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(format_report(report))
+
+
+def replay(args: argparse.Namespace):
+    try:
+        replayer = Replayer(ArchiveReader(args.archive), args.url, speed=None if args.max_speed else args.speed,
+                            start=args.start, concurrency=args.concurrency,
+                            signing_secret=os.environ.get('SIGNING_SECRET'))
+        with timer.phase('replay'):
+            report = replayer.run()
+    except (OSError, ValueError) as e:
+        exit_with_error(str(e))
 
-    cleanup_rules(b2bucket)
-    cleanup_processes(args.cloudflared_command)
+    print_report(report, args.json)
+
+
+def query_events(args: argparse.Namespace):
+    import sqlite3
+
+    try:
+        for event in query(args.database, object_prefix=args.object_prefix, event_type=args.event_type,
+                           since=args.since, until=args.until, limit=args.limit):
+            print(json.dumps(event.raw) if args.json else format_event(event))
+    except sqlite3.Error as e:
+        exit_with_error(f'Cannot read events from {args.database}: {e}')
+    except BrokenPipeError:
+        # For example, piped to head
+        pass
 
 
 # Map command names to functions
 commands = {
     'listen': listen,
+    'multi-listen': multi_listen,
     'cleanup': cleanup,
+    'bench': bench,
+    'replay': replay,
+    'query': query_events,
     'version': version
 }
 
@@ -489,9 +1540,20 @@ def main():
     logger.setLevel(args.loglevel.upper())
     logging.getLogger('subscription').setLevel(args.loglevel.upper())
 
-    load_dotenv()
+    if args.cmd != 'version':
+        from dotenv import load_dotenv
+        load_dotenv()
+
+    if args.metrics_port is not None:
+        try:
+            metrics.serve(args.metrics_port, args.metrics_interface)
+        except OSError as e:
+            exit_with_error(f'Cannot serve metrics on {args.metrics_interface}:{args.metrics_port}: {e}')
 
     try:
         commands[args.cmd](args)
-    except NonExistentBucket as e:
-        exit_with_error(f'Bucket "{args.bucket_name}" does not exist', exc_info=e)
+    finally:
+        if args.timing_report:
+            from importlib import metadata
+            timer.info.update({'b2listen_version': metadata.version(NAME), 'command': args.cmd})
+            timer.write(args.timing_report)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the Backblaze B2 Event Broker, for local testing of b2listen's event broker support.
+
+Usage::
+    ./broker.py [--no-push] [[<interface>:]<port>]
+
+Implements the broker's subscription API:
+
+    POST   /@subscriptions/<bucket>/<rule>              Subscribe; body is {"url": "<subscriber URL>"}
+    HEAD   /@subscriptions/<bucket>/<rule>/<id>         Check a subscription
+    DELETE /@subscriptions/<bucket>/<rule>/<id>         Remove a subscription
+    GET    /@subscriptions/<bucket>/<rule>/<id>/events  Push channel: a stream of server-sent events, including
+                                                        "removed" when the subscription is removed
+
+Any other POST is treated as an event notification message, and forwarded to the subscribers for each event's
+bucket and matched rule. As with the real broker, a subscription is removed after MAX_FAILURES consecutive failed
+deliveries. Requests must be signed with the SIGNING_SECRET environment variable, if it is set.
+
+Run with --no-push to simulate a broker that does not support the push channel.
+"""
+import argparse
+import json
+import logging
+import os
+import uuid
+from collections import defaultdict
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Empty, SimpleQueue
+from threading import Lock
+
+import requests
+
+from b2listen.signature import EVENT_NOTIFICATION_SIGNATURE_HEADER, create_message_signature, \
+    verify_message_signature
+from b2listen.subscription import PUSH_EVENT_REMOVED
+
+logging.basicConfig()
+logger = logging.getLogger('b2listen.broker')
+
+DEFAULT_INTERFACE = 'localhost'
+DEFAULT_PORT = 8081
+MAX_FAILURES = 5
+HEARTBEAT_SECONDS = 15
+SUBSCRIPTIONS_PREFIX = '/@subscriptions/'
+
+
+class Broker:
+    """
+    Subscriptions, and the push channels watching them
+    """
+
+    def __init__(self, signing_secret: str | None, push: bool):
+        self.signing_secret = signing_secret
+        self.push = push
+        self.lock = Lock()
+        self.subscriptions = {}
+        self.watchers = defaultdict(list)
+        self.session = requests.Session()
+
+    def subscribe(self, bucket_name: str, rule_name: str, url: str) -> str:
+        id_ = str(uuid.uuid4())
+        with self.lock:
+            self.subscriptions[id_] = {'bucket': bucket_name, 'rule': rule_name, 'url': url, 'failures': 0}
+        logger.info(f'Subscribed {url} to {bucket_name}/{rule_name}/{id_}')
+        return id_
+
+    def exists(self, id_: str) -> bool:
+        with self.lock:
+            return id_ in self.subscriptions
+
+    def unsubscribe(self, id_: str) -> bool:
+        with self.lock:
+            subscription = self.subscriptions.pop(id_, None)
+            watchers = self.watchers.pop(id_, [])
+        for watcher in watchers:
+            watcher.put(PUSH_EVENT_REMOVED)
+        if subscription:
+            logger.info(f'Removed subscription {subscription["bucket"]}/{subscription["rule"]}/{id_}')
+        return subscription is not None
+
+    def watch(self, id_: str) -> SimpleQueue | None:
+        queue = SimpleQueue()
+        with self.lock:
+            if id_ not in self.subscriptions:
+                return None
+            self.watchers[id_].append(queue)
+        return queue
+
+    def unwatch(self, id_: str, queue: SimpleQueue):
+        with self.lock:
+            if queue in self.watchers.get(id_, []):
+                self.watchers[id_].remove(queue)
+
+    def verify(self, body: bytes, signature: str | None) -> bool:
+        if not self.signing_secret:
+            return True
+        return verify_message_signature(self.signing_secret, body, signature)
+
+    def publish(self, body: bytes):
+        """
+        Forward an event notification message to the subscribers for its events' bucket and rule
+        """
+        keys = {(event.get('bucketName'), event.get('matchedRuleName')) for event in json.loads(body).get('events', [])}
+        with self.lock:
+            targets = [(id_, subscription['url']) for id_, subscription in self.subscriptions.items()
+                       if (subscription['bucket'], subscription['rule']) in keys]
+        headers = {EVENT_NOTIFICATION_SIGNATURE_HEADER: create_message_signature(self.signing_secret, body)} \
+            if self.signing_secret else {}
+        for id_, url in targets:
+            try:
+                ok = self.session.post(url, data=body, headers=headers, timeout=10).ok
+            except requests.RequestException:
+                ok = False
+            with self.lock:
+                subscription = self.subscriptions.get(id_)
+                if not subscription:
+                    continue
+                subscription['failures'] = 0 if ok else subscription['failures'] + 1
+                failures = subscription['failures']
+            if failures >= MAX_FAILURES:
+                logger.warning(f'Delivery to {url} failed {failures} times')
+                self.unsubscribe(id_)
+
+
+class BrokerHandler(BaseHTTPRequestHandler):
+    broker: Broker = None
+
+    def _set_response(self, status_code, body: bytes = b'', content_type='application/json'):
+        self.send_response(status_code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _subscription_path(self):
+        """
+        :return: [bucket, rule] or [bucket, rule, id] or [bucket, rule, id, 'events'], or None for other paths
+        """
+        if not self.path.startswith(SUBSCRIPTIONS_PREFIX):
+            return None
+        return self.path[len(SUBSCRIPTIONS_PREFIX):].split('/')
+
+    def _authorized(self, body: bytes) -> bool:
+        if self.broker.verify(body, self.headers.get(EVENT_NOTIFICATION_SIGNATURE_HEADER)):
+            return True
+        self._set_response(HTTPStatus.UNAUTHORIZED)
+        return False
+
+    # noinspection PyPep8Naming
+    def do_POST(self):
+        body = self._read_body()
+        if not self._authorized(body):
+            return
+        parts = self._subscription_path()
+        if parts is None:
+            self._set_response(HTTPStatus.OK)
+            self.broker.publish(body)
+        elif len(parts) == 2:
+            id_ = self.broker.subscribe(parts[0], parts[1], json.loads(body)['url'])
+            self._set_response(HTTPStatus.OK, bytes(json.dumps({'id': id_}), 'utf-8'))
+        else:
+            self._set_response(HTTPStatus.NOT_FOUND)
+
+    # noinspection PyPep8Naming
+    def do_HEAD(self):
+        parts = self._subscription_path()
+        if not self._authorized(bytes()):
+            return
+        self._set_response(HTTPStatus.OK if parts and len(parts) == 3 and self.broker.exists(parts[2])
+                           else HTTPStatus.NOT_FOUND)
+
+    # noinspection PyPep8Naming
+    def do_DELETE(self):
+        parts = self._subscription_path()
+        if not self._authorized(bytes()):
+            return
+        self._set_response(HTTPStatus.OK if parts and len(parts) == 3 and self.broker.unsubscribe(parts[2])
+                           else HTTPStatus.NOT_FOUND)
+
+    # noinspection PyPep8Naming
+    def do_GET(self):
+        parts = self._subscription_path()
+        if not self._authorized(bytes()):
+            return
+        if not self.broker.push or not parts or len(parts) != 4 or parts[3] != 'events':
+            self._set_response(HTTPStatus.NOT_FOUND)
+            return
+        queue = self.broker.watch(parts[2])
+        if not queue:
+            self._set_response(HTTPStatus.NOT_FOUND)
+            return
+
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        try:
+            while True:
+                try:
+                    event_type = queue.get(timeout=HEARTBEAT_SECONDS)
+                except Empty:
+                    self.wfile.write(b': heartbeat\n\n')
+                    self.wfile.flush()
+                    continue
+                self.wfile.write(bytes(f'event: {event_type}\ndata: {parts[2]}\n\n', 'utf-8'))
+                self.wfile.flush()
+                if event_type == PUSH_EVENT_REMOVED:
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.broker.unwatch(parts[2], queue)
+
+
+def main():
+    logger.setLevel(logging.INFO)
+    parser = argparse.ArgumentParser(description='Stand-in for the Backblaze B2 Event Broker')
+    parser.add_argument('--no-push', action='store_true', help='Do not support the push channel')
+    parser.add_argument('address', nargs='?', default=str(DEFAULT_PORT), help='[<interface>:]<port>')
+    args = parser.parse_args()
+
+    interface, _, port = args.address.rpartition(':')
+    BrokerHandler.broker = Broker(os.environ.get('SIGNING_SECRET'), push=not args.no_push)
+    httpd = ThreadingHTTPServer((interface or DEFAULT_INTERFACE, int(port)), BrokerHandler)
+    httpd.daemon_threads = True
+    logger.info(f'Starting event broker on {httpd.server_address[0]}:{httpd.server_address[1]}')
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()
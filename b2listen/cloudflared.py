@@ -0,0 +1,58 @@
+import logging
+import subprocess
+from collections import deque
+from queue import SimpleQueue
+from threading import Thread
+from typing import IO, List
+
+logging.basicConfig()
+logger = logging.getLogger('b2listen.cloudflared')
+
+DEFAULT_HISTORY_SIZE = 50
+
+
+class CloudflaredOutput:
+    """
+    Drain cloudflared's stdout and stderr on background threads, so that neither pipe can fill up and stall
+    cloudflared, keeping the most recent lines from both in a ring buffer for diagnostics.
+
+    Until stop_matching() is called, stderr lines, where cloudflared writes its log, are also queued for next_line().
+    """
+
+    def __init__(self, process: subprocess.Popen, history_size: int = DEFAULT_HISTORY_SIZE):
+        self.history = deque(maxlen=history_size)
+        self.lines = SimpleQueue()
+        self.matching = True
+        self.readers = [
+            Thread(target=self._drain, args=(process.stdout, False), daemon=True, name='cloudflared-stdout'),
+            Thread(target=self._drain, args=(process.stderr, True), daemon=True, name='cloudflared-stderr'),
+        ]
+        for reader in self.readers:
+            reader.start()
+
+    def _drain(self, stream: IO[str], queue_lines: bool):
+        for line in stream:
+            line = line.strip()
+            self.history.append(line)
+            logger.debug(line)
+            if queue_lines and self.matching:
+                self.lines.put(line)
+        if queue_lines:
+            # End of stream - cloudflared has exited
+            self.lines.put(None)
+
+    def next_line(self) -> str | None:
+        """
+        Wait for the next line of cloudflared's log
+        :return: the line, or None if cloudflared closed its log
+        """
+        return self.lines.get()
+
+    def stop_matching(self):
+        """
+        Stop queueing lines for next_line(); output is still drained and kept in the ring buffer
+        """
+        self.matching = False
+
+    def recent(self) -> List[str]:
+        return list(self.history)
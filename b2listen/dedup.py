@@ -0,0 +1,205 @@
+import hashlib
+import logging
+import math
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, List, Set, Tuple
+
+from b2listen.events import EventMessage
+
+logging.basicConfig()
+logger = logging.getLogger('b2listen.dedup')
+
+DEFAULT_CAPACITY = 100_000
+DEFAULT_BLOOM_ERROR_RATE = 0.01
+
+
+class EventsInFlight(Exception):
+    """
+    An event notification message contains an event that is being delivered as part of another message
+    """
+    pass
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter over strings, using double hashing of a single BLAKE2b digest
+    """
+
+    def __init__(self, capacity: int, error_rate: float = DEFAULT_BLOOM_ERROR_RATE):
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class DedupIndex:
+    """
+    Bounded index of recently delivered event IDs.
+
+    An event ID is claimed, as in flight, when a message containing it is accepted, and only added to the index once
+    the message has been delivered, so that, if delivery fails, B2's retry is not dropped as a duplicate. A message
+    containing an event that is still in flight is refused, so that the event is not delivered twice concurrently.
+
+    The index holds at most capacity IDs, evicting the least recently seen ID when it is full. If ttl is set, IDs are
+    also evicted ttl seconds after they were first seen, and the index acts as a time window rather than an LRU cache.
+
+    If bloom is set, a Bloom filter in front of the index answers most lookups for new IDs without touching the index.
+    Since IDs cannot be removed from a Bloom filter, it is rebuilt from the index once it has accumulated twice the
+    index's capacity.
+    """
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY, ttl: float | None = None, bloom: bool = False):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries: OrderedDict[str, float] = OrderedDict()
+        # IDs of events that are being delivered, which are added to the index once they have been
+        self.in_flight: Set[str] = set()
+        self.lock = Lock()
+        self.bloom = BloomFilter(capacity) if bloom else None
+        self.bloom_count = 0
+        self.hits = 0
+        self.misses = 0
+        self.bloom_negatives = 0
+        self.evictions = 0
+
+    def _expire(self, now: float):
+        if self.ttl is not None:
+            while self.entries:
+                event_id, seen = next(iter(self.entries.items()))
+                if now - seen < self.ttl:
+                    break
+                del self.entries[event_id]
+                self.evictions += 1
+
+    def _add(self, event_id: str, now: float):
+        self.entries[event_id] = now
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        if self.bloom is not None:
+            self.bloom.add(event_id)
+            self.bloom_count += 1
+            if self.bloom_count >= 2 * self.capacity:
+                self.bloom = BloomFilter(self.capacity)
+                for key in self.entries:
+                    self.bloom.add(key)
+                self.bloom_count = len(self.entries)
+
+    def _seen(self, event_id: str) -> bool:
+        """
+        Look up an event ID. Must be called with self.lock held.
+        :return: True if the event ID is in the index
+        """
+        if self.bloom is not None and event_id not in self.bloom:
+            self.bloom_negatives += 1
+        elif event_id in self.entries:
+            if self.ttl is None:
+                self.entries.move_to_end(event_id)
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def claim(self, event_ids: List[str]) -> List[bool]:
+        """
+        Look up the event IDs of a message, marking those that are not in the index as in flight until they are
+        committed or released
+        :return: for each event ID, True if it is a duplicate, either in the index or earlier in event_ids
+        :raise EventsInFlight: if any of the event IDs is in flight for another message; none are claimed
+        """
+        with self.lock:
+            self._expire(time.monotonic())
+            claimed = set()
+            duplicates = []
+            for event_id in event_ids:
+                if event_id in claimed:
+                    duplicates.append(True)
+                elif event_id in self.in_flight:
+                    self.in_flight -= claimed
+                    raise EventsInFlight(f'Event {event_id} is already being delivered')
+                elif self._seen(event_id):
+                    duplicates.append(True)
+                else:
+                    self.in_flight.add(event_id)
+                    claimed.add(event_id)
+                    duplicates.append(False)
+            return duplicates
+
+    def commit(self, event_ids: List[str]):
+        """
+        Add claimed event IDs to the index, once their events have been delivered
+        """
+        with self.lock:
+            now = time.monotonic()
+            for event_id in event_ids:
+                self.in_flight.discard(event_id)
+                self._add(event_id, now)
+
+    def release(self, event_ids: List[str]):
+        """
+        Release claimed event IDs without adding them to the index, for example, because their events could not be
+        delivered and will be retried
+        """
+        with self.lock:
+            self.in_flight.difference_update(event_ids)
+
+    def filter(self, body: bytes) -> Tuple[bytes | None, List[str]]:
+        """
+        Remove already seen events from an event notification message, claiming the IDs of the new events. The caller
+        must commit the IDs once the message has been delivered, or release them if it was not.
+        :return: (message body without duplicate events, or None if every event was a duplicate; IDs of new events)
+        :raise EventsInFlight: if any of the message's events is being delivered as part of another message
+        """
+        message = EventMessage(body)
+        event_ids = message.event_ids()
+        if event_ids is None:
+            # Not an event notification message - pass it through
+            return body, []
+
+        duplicates = self.claim(event_ids)
+        new_ids = [event_id for event_id, duplicate in zip(event_ids, duplicates) if not duplicate]
+        if not any(duplicates):
+            # The usual case, so the message is only parsed if it contains duplicates
+            return body, new_ids
+
+        events = message.events
+        if events is None or [event.event_id for event in events] != event_ids:
+            # The IDs read from the message don't match its events; let the local service decide
+            self.release(new_ids)
+            return body, []
+        new_events = []
+        for event, event_id, duplicate in zip(events, event_ids, duplicates):
+            if duplicate:
+                logger.debug(f'Dropping duplicate event {event_id}')
+            else:
+                new_events.append(event)
+
+        if not new_events:
+            return None, new_ids
+        return message.with_events(new_events), new_ids
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'in_flight': len(self.in_flight),
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'bloom_negatives': self.bloom_negatives,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,10 @@
+# Defaults for the embedded webserver's options. They live apart from b2listen.server, which imports http.server, so
+# that the CLI can build its argument parser without importing it.
+
+ENGINE_SIMPLE = 'simple'
+ENGINE_THREADED = 'threaded'
+ENGINES = [ENGINE_SIMPLE, ENGINE_THREADED]
+DEFAULT_ENGINE = ENGINE_THREADED
+DEFAULT_CONCURRENCY = 16
+DEFAULT_KEEP_ALIVE_TIMEOUT = 30
+DEFAULT_DRAIN_TIMEOUT = 10
@@ -0,0 +1,163 @@
+import json
+import re
+from typing import Any, Dict, List
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# JSON library used to parse and encode event notification messages. orjson is several times faster than the standard
+# library's json module, so it is used if it is installed.
+JSON_BACKEND = 'orjson' if orjson else 'json'
+
+# A message that looks like an event notification message, {"events": [...]}, as sent by B2
+EVENTS_MESSAGE_REGEX = re.compile(rb'\s*\{\s*"events"\s*:\s*\[')
+# The value of each eventId key, provided that it contains no escaped characters
+EVENT_ID_REGEX = re.compile(rb'"eventId"\s*:\s*"([^"\\]*)"')
+
+
+def loads(data: bytes | str) -> Any:
+    """
+    Parse JSON, using orjson if it is installed
+    :raise ValueError: if data is not valid JSON
+    """
+    if orjson:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson is stricter than json, for example, about integers larger than 64 bits; json decides whether
+            # data is valid
+            pass
+    return json.loads(data)
+
+
+def dumps(value: Any) -> bytes:
+    """
+    Encode a value as compact JSON, using orjson if it is installed
+    """
+    if orjson:
+        try:
+            return orjson.dumps(value)
+        except TypeError:
+            pass
+    return bytes(json.dumps(value, separators=(',', ':')), 'utf-8')
+
+
+def count_events(body: bytes) -> int:
+    """
+    The number of events in an event notification message. Counting occurrences of the key is much cheaper than
+    parsing the message.
+    """
+    return body.count(b'"eventId"')
+
+
+class Event:
+    """
+    A B2 event. Fields are read from the parsed event when they are accessed, so that routing or deduplicating an
+    event costs no more than the fields that are used.
+    """
+    __slots__ = ('raw',)
+
+    def __init__(self, raw: Dict):
+        self.raw = raw
+
+    @property
+    def event_id(self) -> str | None:
+        return self.raw.get('eventId')
+
+    @property
+    def event_type(self) -> str:
+        return str(self.raw.get('eventType', ''))
+
+    @property
+    def event_timestamp(self) -> int | None:
+        return self.raw.get('eventTimestamp')
+
+    @property
+    def bucket_name(self) -> str | None:
+        return self.raw.get('bucketName')
+
+    @property
+    def matched_rule_name(self) -> str | None:
+        return self.raw.get('matchedRuleName')
+
+    @property
+    def object_name(self) -> str:
+        return str(self.raw.get('objectName', ''))
+
+    @property
+    def object_size(self) -> int | None:
+        return self.raw.get('objectSize')
+
+    @property
+    def object_version_id(self) -> str | None:
+        return self.raw.get('objectVersionId')
+
+    def __repr__(self) -> str:
+        return f'Event({self.raw!r})'
+
+
+def encode_events(events: List[Event]) -> bytes:
+    """
+    Encode events as an event notification message
+    """
+    return dumps({'events': [event.raw for event in events]})
+
+
+class EventMessage:
+    """
+    An event notification message. The body is only parsed when the events are first accessed, and event_ids() reads
+    the event IDs from the body without parsing it, where it can.
+    """
+    __slots__ = ('body', '_payload', '_events', '_parsed')
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self._payload = None
+        self._events: List[Event] | None = None
+        self._parsed = False
+
+    def _parse(self):
+        if self._parsed:
+            return
+        self._parsed = True
+        try:
+            payload = loads(self.body)
+        except ValueError:
+            return
+        if isinstance(payload, dict) and isinstance(payload.get('events'), list) \
+                and all(isinstance(event, dict) for event in payload['events']):
+            self._payload = payload
+            self._events = [Event(event) for event in payload['events']]
+
+    @property
+    def events(self) -> List[Event] | None:
+        """
+        :return: the events in the message, or None if it is not an event notification message
+        """
+        self._parse()
+        return self._events
+
+    def event_ids(self) -> List[str] | None:
+        """
+        :return: the ID of each event in the message, in order, or None if it is not an event notification message,
+        or an event has no ID
+        """
+        if not self._parsed and EVENTS_MESSAGE_REGEX.match(self.body):
+            event_ids = EVENT_ID_REGEX.findall(self.body)
+            # If every eventId key was matched, these are the IDs of the events, since B2 events have no nested objects
+            if len(event_ids) == count_events(self.body):
+                return [event_id.decode('utf-8') for event_id in event_ids]
+        events = self.events
+        if events is None:
+            return None
+        event_ids = [event.event_id for event in events]
+        return None if None in event_ids else event_ids
+
+    def with_events(self, events: List[Event]) -> bytes:
+        """
+        :return: the body of a copy of the message containing only events
+        """
+        self._parse()
+        return dumps({**(self._payload or {}), 'events': [event.raw for event in events]})
@@ -0,0 +1,187 @@
+import logging
+import time
+from concurrent.futures import Future
+from queue import SimpleQueue
+from threading import Condition, Thread
+from typing import Dict, List, NamedTuple, Tuple
+
+from b2listen.events import Event, EventMessage, encode_events
+from b2listen.signature import EVENT_NOTIFICATION_SIGNATURE_HEADER, create_message_signature
+from b2listen.spool import HOP_BY_HOP_HEADERS
+
+logging.basicConfig()
+logger = logging.getLogger('b2listen.forwarder')
+
+DEFAULT_MAX_IN_FLIGHT = 8
+DEFAULT_BATCH_MAX_EVENTS = 1
+DEFAULT_BATCH_LINGER = 0.05
+DEFAULT_FORWARD_TIMEOUT = 30
+
+
+class ForwardingError(Exception):
+    pass
+
+
+class Request(NamedTuple):
+    path: str
+    headers: Dict[str, str]
+    body: bytes
+    futures: List[Future]
+
+
+class Batch:
+    """
+    Events from one or more event notification messages, waiting to be sent to the local service in a single request
+    """
+
+    def __init__(self, path: str, headers: Dict[str, str]):
+        self.path = path
+        self.headers = headers
+        self.events = []
+        self.futures = []
+        self.created = time.monotonic()
+
+
+class Forwarder:
+    """
+    Forward event notification messages to the local service over a pool of persistent connections, with at most
+    max_in_flight requests outstanding at any time.
+
+    If max_batch_events is greater than one, the events arrays of messages received within max_linger seconds of each
+    other are coalesced into a single message of up to max_batch_events events. Since coalescing changes the message
+    body, the original signature is removed, and, if signing_secret is set, the new message is signed with it.
+
+    max_callers is the number of threads that may call deliver() at once, for example, the embedded webserver's
+    concurrency. Once they are all waiting for their messages to be delivered, no more events can arrive, so the open
+    batches are sent without waiting out max_linger. A batch never holds more than max_callers messages.
+
+    deliver() blocks until the local service has accepted the message, so that the embedded webserver only
+    acknowledges messages that have been delivered.
+    """
+
+    def __init__(self, url: str, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+                 max_batch_events: int = DEFAULT_BATCH_MAX_EVENTS, max_linger: float = DEFAULT_BATCH_LINGER,
+                 signing_secret: str | None = None, timeout: float = DEFAULT_FORWARD_TIMEOUT,
+                 max_callers: int | None = None):
+        self.url = url.rstrip('/')
+        self.max_batch_events = max_batch_events
+        self.max_callers = max_callers
+        # Threads in deliver(), waiting for their messages to be delivered
+        self.callers = 0
+        self.max_linger = max_linger
+        self.signing_secret = signing_secret
+        self.timeout = timeout
+
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.pending = SimpleQueue()
+        self.senders = [Thread(target=self.send_requests, daemon=True, name=f'b2listen-forwarder-{i}')
+                        for i in range(max_in_flight)]
+        for sender in self.senders:
+            sender.start()
+
+        self.condition = Condition()
+        self.batches: Dict[str, Batch] = {}
+        if self.max_batch_events > 1:
+            Thread(target=self.flush_lingering_batches, daemon=True, name='b2listen-forwarder-batcher').start()
+
+        logger.info(f'Forwarding event notifications to {self.url} with up to {max_in_flight} requests in flight' +
+                    (f', coalescing up to {max_batch_events} events per request' if max_batch_events > 1 else ''))
+
+    def deliver(self, path: str, headers: List[Tuple[str, str]], body: bytes):
+        """
+        Delivery target interface for the embedded webserver
+        """
+        headers = {name: value for name, value in headers if name.lower() not in HOP_BY_HOP_HEADERS}
+        future = Future()
+
+        events = self.coalescable_events(body) if self.max_batch_events > 1 else None
+        with self.condition:
+            self.callers += 1
+            if events is None:
+                self.pending.put(Request(path, headers, body, [future]))
+            else:
+                self.add_to_batch(path, headers, events, future)
+            if self.max_callers and self.callers >= self.max_callers:
+                # Every caller is waiting, so there is nothing to linger for
+                for batch in list(self.batches.values()):
+                    self.flush(batch)
+        try:
+            future.result()
+        finally:
+            with self.condition:
+                self.callers -= 1
+
+    @staticmethod
+    def coalescable_events(body: bytes) -> List[Event] | None:
+        events = EventMessage(body).events
+        # Pass anything unexpected, such as the event broker's probe message, through unchanged
+        return events or None
+
+    def add_to_batch(self, path: str, headers: Dict[str, str], events: List[Event], future: Future):
+        """
+        Add events to the open batch for path, if any. Must be called with self.condition held.
+        """
+        batch = self.batches.get(path)
+        if batch and len(batch.events) + len(events) > self.max_batch_events:
+            self.flush(batch)
+            batch = None
+        if not batch:
+            batch = self.batches[path] = Batch(path, headers)
+            self.condition.notify()
+        batch.events.extend(events)
+        batch.futures.append(future)
+        if len(batch.events) >= self.max_batch_events:
+            self.flush(batch)
+
+    def flush(self, batch: Batch):
+        """
+        Queue a batch for sending. Must be called with self.condition held.
+        """
+        del self.batches[batch.path]
+        body = encode_events(batch.events)
+        headers = {name: value for name, value in batch.headers.items()
+                   if name.lower() != EVENT_NOTIFICATION_SIGNATURE_HEADER}
+        if self.signing_secret:
+            headers[EVENT_NOTIFICATION_SIGNATURE_HEADER] = create_message_signature(self.signing_secret, body)
+        logger.debug(f'Coalesced {len(batch.futures)} messages into one request of {len(batch.events)} events')
+        self.pending.put(Request(batch.path, headers, body, batch.futures))
+
+    def flush_lingering_batches(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                wait = None
+                for batch in list(self.batches.values()):
+                    remaining = batch.created + self.max_linger - now
+                    if remaining <= 0:
+                        self.flush(batch)
+                    elif wait is None or remaining < wait:
+                        wait = remaining
+                self.condition.wait(wait)
+
+    def send_requests(self):
+        import requests
+        while (request := self.pending.get()) is not None:
+            try:
+                res = self.session.post(f'{self.url}{request.path}', data=request.body, headers=request.headers,
+                                        timeout=self.timeout)
+                logger.debug(f'Received {res.status_code} for {self.url}{request.path}')
+                error = None if res.ok else ForwardingError(f'{self.url} responded with status {res.status_code}')
+            except requests.RequestException as e:
+                error = ForwardingError(f'Error forwarding event notification to {self.url}: {e}')
+
+            for future in request.futures:
+                if error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(None)
+
+    def close(self):
+        for _ in self.senders:
+            self.pending.put(None)
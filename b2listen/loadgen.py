@@ -0,0 +1,234 @@
+import json
+import logging
+import math
+import random
+import time
+import uuid
+from threading import Lock, Thread
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Tuple
+from urllib.parse import urlsplit
+
+from b2listen.events import count_events
+from b2listen.signature import EVENT_NOTIFICATION_SIGNATURE_HEADER, create_message_signature
+
+if TYPE_CHECKING:
+    import http.client
+
+logging.basicConfig()
+logger = logging.getLogger('b2listen.loadgen')
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_REQUESTS = 10_000
+DEFAULT_EVENTS_PER_REQUEST = 1
+DEFAULT_TIMEOUT = 30
+PERCENTILES = [50, 95, 99]
+MESSAGE_HEADERS = [('Content-Type', 'application/json'), ('User-Agent', 'b2listen-loadgen')]
+
+EVENT_TYPES = ['b2:ObjectCreated:Upload', 'b2:ObjectCreated:MultipartUpload', 'b2:ObjectCreated:Copy',
+               'b2:ObjectDeleted:Delete', 'b2:HideMarkerCreated:Hide']
+
+
+def make_event(bucket_name: str, rule_name: str) -> Dict:
+    """
+    A realistic, but fake, B2 event
+    """
+    return {
+        'accountId': 'e85c6a500333',
+        'bucketId': 'aea8c5bc362ef5cf8c4e0913',
+        'bucketName': bucket_name,
+        'eventId': uuid.uuid4().hex,
+        'eventTimestamp': int(time.time() * 1000),
+        'eventType': random.choice(EVENT_TYPES),
+        'eventVersion': 1,
+        'matchedRuleName': rule_name,
+        'objectName': f'loadgen/{uuid.uuid4().hex}.jpg',
+        'objectSize': random.randint(1, 10 * 1024 * 1024),
+        'objectVersionId': f'4_zaea8c5bc362ef5cf8c4e0913_f{random.getrandbits(64):016x}_d20240722_m160716_c004_v0402007_t0001',
+    }
+
+
+def make_payload(events_per_request: int, bucket_name: str = 'loadgen-bucket', rule_name: str = 'loadgen-rule') \
+        -> bytes:
+    return bytes(json.dumps({'events': [make_event(bucket_name, rule_name) for _ in range(events_per_request)]}),
+                 'utf-8')
+
+
+def percentile(sorted_values: List[float], p: float) -> float | None:
+    """
+    Nearest-rank percentile of an already sorted list
+    """
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def to_ms(seconds: float | None) -> float | None:
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+
+class Message(NamedTuple):
+    # Time at which to send the message, from time.perf_counter()
+    send_at: float
+    # Path, relative to the target URL
+    path: str
+    headers: List[Tuple[str, str]]
+    body: bytes
+
+
+class HttpLoad:
+    """
+    Send messages to a webhook URL from concurrency threads, each with its own persistent connection, and measure the
+    response status and latency of each. Subclasses supply the messages, and when to send them, via next_message().
+
+    Latency is measured from when each message was due to be sent, rather than when it was actually sent, so that a
+    server that falls behind is not flattered by the senders waiting for it.
+    """
+
+    def __init__(self, url: str, concurrency: int = DEFAULT_CONCURRENCY, signing_secret: str | None = None,
+                 timeout: float = DEFAULT_TIMEOUT):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError(f'Unsupported URL {url}')
+        self.url = url
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.base_path = parts.path.rstrip('/')
+        self.query = f'?{parts.query}' if parts.query else ''
+        self.concurrency = concurrency
+        self.signing_secret = signing_secret
+        self.timeout = timeout
+
+        self.lock = Lock()
+        self.latencies: List[float] = []
+        self.ok_latencies: List[float] = []
+        self.statuses: Dict[str, int] = {}
+        self.events = 0
+        self.start = 0.0
+
+    def next_message(self) -> Message | None:
+        """
+        Called from every sender thread, so must hold the lock while it updates shared state
+        :return: the next message to send, or None if the run is over
+        """
+        raise NotImplementedError
+
+    def _connect(self) -> 'http.client.HTTPConnection':
+        import http.client
+        connection_class = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+        return connection_class(self.netloc, timeout=self.timeout)
+
+    def _record(self, status: str, latency: float, events: int):
+        with self.lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.latencies.append(latency)
+            self.events += events
+            if status.startswith('2'):
+                self.ok_latencies.append(latency)
+
+    def _send(self):
+        import http.client
+        connection = self._connect()
+        while True:
+            message = self.next_message()
+            if message is None:
+                break
+            delay = message.send_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            headers = dict(message.headers)
+            if self.signing_secret:
+                headers[EVENT_NOTIFICATION_SIGNATURE_HEADER] = create_message_signature(self.signing_secret,
+                                                                                        message.body)
+            try:
+                path = f'{self.base_path}{message.path}' or '/'
+                connection.request('POST', f'{path}{self.query}', body=message.body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                status = str(response.status)
+                if response.will_close:
+                    connection.close()
+            except (OSError, http.client.HTTPException) as e:
+                logger.debug(f'Error sending request: {e}')
+                status = 'error'
+                connection.close()
+                connection = self._connect()
+            self._record(status, time.perf_counter() - message.send_at, count_events(message.body))
+        connection.close()
+
+    def run(self) -> Dict:
+        self.start = time.perf_counter()
+        threads = [Thread(target=self._send, daemon=True, name=f'b2listen-loadgen-{i}')
+                   for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.report(time.perf_counter() - self.start)
+
+    def report(self, elapsed: float) -> Dict:
+        latencies = sorted(self.latencies)
+        ok_latencies = sorted(self.ok_latencies)
+        completed = len(latencies)
+        return {
+            'requests': completed,
+            'events': self.events,
+            'elapsed': round(elapsed, 3),
+            'requests_per_second': round(completed / elapsed, 1) if elapsed else None,
+            'events_per_second': round(self.events / elapsed, 1) if elapsed else None,
+            'statuses': dict(sorted(self.statuses.items())),
+            'latency_ms': {
+                **{f'p{p}': to_ms(percentile(latencies, p)) for p in PERCENTILES},
+                'max': to_ms(latencies[-1] if latencies else None),
+            },
+            'ok_latency_ms': {f'p{p}': to_ms(percentile(ok_latencies, p)) for p in PERCENTILES},
+        }
+
+
+class LoadGenerator(HttpLoad):
+    """
+    Send generated, signed, event notification messages until requests messages have been sent or duration seconds
+    have passed. If rate is set, messages are paced to that many per second across all threads.
+    """
+
+    def __init__(self, url: str, concurrency: int = DEFAULT_CONCURRENCY, requests: int | None = DEFAULT_REQUESTS,
+                 duration: float | None = None, rate: float | None = None,
+                 events_per_request: int = DEFAULT_EVENTS_PER_REQUEST, signing_secret: str | None = None,
+                 timeout: float = DEFAULT_TIMEOUT):
+        super().__init__(url, concurrency=concurrency, signing_secret=signing_secret, timeout=timeout)
+        self.requests = requests
+        self.duration = duration
+        self.rate = rate
+        self.events_per_request = events_per_request
+        self.sent = 0
+
+    def next_message(self) -> Message | None:
+        # Generate the payload before taking a slot, so that other threads don't wait for it, and its time is not
+        # counted as latency
+        body = make_payload(self.events_per_request)
+        with self.lock:
+            if self.requests is not None and self.sent >= self.requests:
+                return None
+            send_at = self.start + self.sent / self.rate if self.rate else time.perf_counter()
+            if self.duration is not None and send_at - self.start >= self.duration:
+                return None
+            self.sent += 1
+        return Message(send_at, '', MESSAGE_HEADERS, body)
+
+    def run(self) -> Dict:
+        logger.info(f'Sending {self.requests if self.requests is not None else "as many"} requests of '
+                    f'{self.events_per_request} events to {self.url} from {self.concurrency} threads' +
+                    (f' for {self.duration} seconds' if self.duration is not None else '') +
+                    (f' at {self.rate} requests/second' if self.rate else ''))
+        return super().run()
+
+
+def format_report(report: Dict) -> str:
+    statuses = ', '.join(f'{status}: {count}' for status, count in report['statuses'].items())
+    latency = ', '.join(f'{key} {value} ms' for key, value in report['latency_ms'].items() if value is not None)
+    ok_latency = ', '.join(f'{key} {value} ms' for key, value in report['ok_latency_ms'].items()
+                           if value is not None)
+    return (f'Requests:   {report["requests"]} ({report["events"]} events) in {report["elapsed"]} s\n'
+            f'Throughput: {report["requests_per_second"]} requests/s, {report["events_per_second"]} events/s\n'
+            f'Statuses:   {statuses}\n'
+            f'Latency:    {latency or "-"}\n'
+            f'Latency (2xx only): {ok_latency or "-"}')
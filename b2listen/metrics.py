@@ -0,0 +1,271 @@
+import bisect
+import logging
+import threading
+import weakref
+from http import HTTPStatus
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Sequence, Tuple
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+logging.basicConfig()
+logger = logging.getLogger('b2listen.metrics')
+
+DEFAULT_METRICS_INTERFACE = 'localhost'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+EVENTS_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+Sample = Tuple[str, Dict[str, str], float]
+
+
+class CellHolder:
+    """
+    Holds a thread's cell in its thread-local storage, so that the cell can be retired when the thread exits and the
+    holder is released
+    """
+    __slots__ = ('__weakref__',)
+
+
+class PerThreadCells:
+    """
+    One list of numbers per thread, summed when read. Each thread only ever updates its own cell, so updates need no
+    lock; the lock is only taken the first time a thread updates a metric, and when the thread exits, when its cell is
+    added to the retired cell, so that short-lived threads, such as the webserver's per-connection threads, do not
+    each leave a cell behind.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # Cells of running threads, by id, since cells with equal numbers compare equal
+        self.cells: Dict[int, List[float]] = {}
+        self.retired: List[float] = [0] * size
+
+    def get(self) -> List[float]:
+        try:
+            return self.local.cell
+        except AttributeError:
+            cell = self.local.cell = [0] * self.size
+            self.local.holder = CellHolder()
+            finalizer = weakref.finalize(self.local.holder, self._retire, cell)
+            finalizer.atexit = False
+            with self.lock:
+                self.cells[id(cell)] = cell
+            return cell
+
+    def _retire(self, cell: List[float]):
+        with self.lock:
+            del self.cells[id(cell)]
+            self.retired = [retired + value for retired, value in zip(self.retired, cell)]
+
+    def totals(self) -> List[float]:
+        # Sum under the lock, so that a cell that is being retired is counted exactly once
+        with self.lock:
+            return [sum(values) for values in zip(self.retired, *self.cells.values())]
+
+
+class Metric:
+    """
+    A named metric, optionally with labels. labels() returns the child for a set of label values; a metric without
+    labels is its own only child.
+    """
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children = {}
+        self.function: Callable[[], float] | None = None
+
+    def labels(self, *values) -> 'Metric':
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self._child())
+        return child
+
+    def _child(self) -> 'Metric':
+        return type(self)(self.name, self.documentation)
+
+    def set_function(self, function: Callable[[], float] | None):
+        """
+        Read the metric's value from function when it is collected, for example, from statistics kept elsewhere
+        """
+        self.function = function
+
+    def _samples(self) -> Iterator[Sample]:
+        raise NotImplementedError
+
+    def samples(self) -> Iterator[Sample]:
+        if not self.labelnames:
+            yield from self._samples()
+            return
+        for values, child in sorted(self.children.items()):
+            for suffix, labels, value in child.samples():
+                yield suffix, {**dict(zip(self.labelnames, values)), **labels}, value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.cells = PerThreadCells(1)
+
+    def inc(self, amount: float = 1):
+        self.cells.get()[0] += amount
+
+    def value(self) -> float:
+        return self.function() if self.function else self.cells.totals()[0]
+
+    def _samples(self) -> Iterator[Sample]:
+        yield '', {}, self.value()
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.current = 0
+
+    def set(self, value: float):
+        self.current = value
+
+    def value(self) -> float:
+        return self.function() if self.function else self.current
+
+    def _samples(self) -> Iterator[Sample]:
+        yield '', {}, self.value()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float], labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = list(buckets)
+        # A count for each bucket, and for values above the largest bucket, then the sum of the values
+        self.cells = PerThreadCells(len(self.buckets) + 2)
+
+    def _child(self) -> 'Histogram':
+        return Histogram(self.name, self.documentation, self.buckets)
+
+    def observe(self, value: float):
+        cell = self.cells.get()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def _samples(self) -> Iterator[Sample]:
+        totals = self.cells.totals()
+        cumulative = 0
+        for bound, count in zip(self.buckets + [float('+inf')], totals[:-1]):
+            cumulative += count
+            yield '_bucket', {'le': format_value(bound)}, cumulative
+        yield '_sum', {}, totals[-1]
+        yield '_count', {}, cumulative
+
+
+def format_value(value: float) -> str:
+    if value == float('+inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def exposition(self) -> str:
+        """
+        :return: the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for suffix, labels, value in metric.samples():
+                label_text = ','.join(f'{name}="{value}"' for name, value in labels.items())
+                lines.append(f'{metric.name}{suffix}{{{label_text}}} {format_value(value)}' if label_text
+                             else f'{metric.name}{suffix} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics for this run of b2listen
+registry = Registry()
+
+messages_received = registry.register(Counter(
+    'b2listen_messages_received_total', 'Event notification messages received by the embedded webserver, by response '
+                                        'status', ['status']))
+events_received = registry.register(Counter(
+    'b2listen_events_received_total', 'Events in the messages received by the embedded webserver'))
+bytes_received = registry.register(Counter(
+    'b2listen_received_bytes_total', 'Size of the messages received by the embedded webserver'))
+signature_failures = registry.register(Counter(
+    'b2listen_signature_failures_total', 'Messages with a missing or incorrect signature, if SIGNING_SECRET is set'))
+duplicate_events = registry.register(Counter(
+    'b2listen_duplicate_events_total', 'Events dropped as duplicates'))
+handler_seconds = registry.register(Histogram(
+    'b2listen_handler_seconds', 'Time taken by the embedded webserver to handle a message', LATENCY_BUCKETS))
+events_per_message = registry.register(Histogram(
+    'b2listen_events_per_message', 'Number of events in each message', EVENTS_BUCKETS))
+tunnel_up = registry.register(Gauge(
+    'b2listen_tunnel_up', '1 if the cloudflared tunnel is registered'))
+subscription_active = registry.register(Gauge(
+    'b2listen_subscription_active', '1 if the event broker subscription is active'))
+resubscriptions = registry.register(Counter(
+    'b2listen_resubscriptions_total', 'Times b2listen resubscribed to the event broker after the subscription was '
+                                      'removed'))
+subscription_check_failures = registry.register(Counter(
+    'b2listen_subscription_check_failures_total', 'Failed checks of the event broker subscription'))
+
+
+def record_message(status: int, size: int, events: int, seconds: float):
+    messages_received.labels(str(status)).inc()
+    bytes_received.inc(size)
+    events_received.inc(events)
+    events_per_message.observe(events)
+    handler_seconds.observe(seconds)
+
+
+def serve(port: int, interface: str = DEFAULT_METRICS_INTERFACE) -> 'ThreadingHTTPServer':
+    """
+    Serve the metrics at /metrics on a daemon thread. The metrics are served on their own port, rather than by the
+    embedded webserver, so that they are not exposed through the tunnel.
+    """
+    # Every command records metrics, but few serve them
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        # noinspection PyPep8Naming
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(HTTPStatus.NOT_FOUND)
+                return
+            body = registry.exposition().encode('utf-8')
+            self.send_response(HTTPStatus.OK)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format_, *args):
+            # Scrapes are frequent, so don't log them unless debugging
+            logger.debug(format_, *args)
+
+    httpd = ThreadingHTTPServer((interface, port), MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True, name='b2listen-metrics').start()
+    logger.info(f'Serving metrics at http://{interface}:{httpd.server_address[1]}/metrics')
+    return httpd
@@ -0,0 +1,105 @@
+import json
+import logging
+import re
+from typing import Dict, List, NamedTuple, Tuple
+
+logging.basicConfig()
+logger = logging.getLogger('b2listen.multi')
+
+# Listener names are appended to the cloudflared label to name temporary rules, and rule names may be at most 63
+# letters, digits and "-"
+LISTENER_NAME_REGEX = re.compile(r'^[A-Za-z0-9\-]{1,12}$')
+ROUTE_PATH_REGEX = re.compile(r'^/([^/?]+)(.*)$')
+
+
+class Listener(NamedTuple):
+    """
+    One bucket/prefix, from the multi-listen config file, and the local service to deliver its events to
+    """
+    # Path segment on the tunnel for this listener's events
+    name: str
+    bucket_name: str
+    url: str
+    event_types: List[str] | None
+    prefix: str
+    custom_headers: List[Dict[str, str]] | None
+    # Existing rule to point at the tunnel, rather than creating a temporary rule
+    rule_name: str | None
+
+
+def load_config(path: str) -> List[Listener]:
+    """
+    Read the multi-listen config file, a JSON document of the form::
+
+        {
+          "listeners": [
+            {
+              "name": "images",
+              "bucketName": "my-bucket",
+              "url": "http://localhost:8080",
+              "objectNamePrefix": "images/",
+              "eventTypes": ["b2:ObjectCreated:*"],
+              "customHeaders": [{"name": "X-My-Header", "value": "red"}]
+            },
+            {
+              "bucketName": "my-other-bucket",
+              "url": "http://localhost:8081/events",
+              "ruleName": "my-existing-rule"
+            }
+          ]
+        }
+
+    bucketName and url are required. name defaults to the listener's index in the list.
+    :raise ValueError: if the config is invalid
+    """
+    with open(path) as f:
+        config = json.load(f)
+
+    if not isinstance(config, dict) or not isinstance(config.get('listeners'), list) or not config['listeners']:
+        raise ValueError('Config must contain a non-empty "listeners" list')
+
+    listeners = []
+    for index, entry in enumerate(config['listeners']):
+        if not isinstance(entry, dict):
+            raise ValueError(f'Listener {index} must be an object')
+        for key in ('bucketName', 'url'):
+            if not entry.get(key):
+                raise ValueError(f'Listener {index} must have a "{key}"')
+        name = str(entry.get('name', index))
+        if not LISTENER_NAME_REGEX.match(name):
+            raise ValueError(f'Listener name "{name}" must be 1-12 letters, digits or "-"')
+        if entry.get('ruleName') and any(key in entry for key in ('objectNamePrefix', 'eventTypes', 'customHeaders')):
+            raise ValueError(f'Listener "{name}" cannot specify an existing rule name and configuration for a '
+                             'temporary rule')
+        listeners.append(Listener(
+            name=name,
+            bucket_name=entry['bucketName'],
+            url=entry['url'],
+            event_types=entry.get('eventTypes'),
+            prefix=entry.get('objectNamePrefix', ''),
+            custom_headers=entry.get('customHeaders'),
+            rule_name=entry.get('ruleName'),
+        ))
+
+    names = [listener.name for listener in listeners]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f'Listener names must be unique; found {", ".join(duplicates)} more than once')
+    return listeners
+
+
+class PathRouter:
+    """
+    Delivery target that passes each message to the target for the first segment of its path, for example, a message
+    for /images/anything is delivered to the "images" target with path /anything
+    """
+
+    def __init__(self, routes: Dict[str, object]):
+        self.routes = routes
+
+    def deliver(self, path: str, headers: List[Tuple[str, str]], body: bytes):
+        match = ROUTE_PATH_REGEX.match(path)
+        target = self.routes.get(match.group(1)) if match else None
+        if not target:
+            raise LookupError(f'No listener for path {path}')
+        target.deliver(match.group(2), headers, body)
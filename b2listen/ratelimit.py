@@ -0,0 +1,164 @@
+import logging
+import math
+import random
+import time
+from threading import Lock
+from typing import Callable, Dict, List, NamedTuple, Tuple
+
+logging.basicConfig()
+logger = logging.getLogger('b2listen.ratelimit')
+
+
+class TokenBucket:
+    """
+    Token bucket holding up to burst tokens, refilled at rate tokens per second. Each request takes a token, so the
+    bucket admits bursts of up to burst requests, and rate requests per second, sustained.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def take(self) -> float:
+        """
+        Take a token, if there is one
+        :return: 0 if a token was taken; otherwise, the time, in seconds, until a token will be available
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def give_back(self):
+        """
+        Return a token taken for a request that was rejected by another bucket
+        """
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+
+
+def default_burst(rate: float) -> int:
+    """
+    By default, a bucket holds one second's worth of tokens
+    """
+    return max(1, math.ceil(rate))
+
+
+class PathLimit(NamedTuple):
+    """
+    Requests whose path starts with path are limited to rate per second, with bursts of up to burst requests
+    """
+    path: str
+    rate: float
+    burst: int
+
+
+def parse_path_limit(values: List[str]) -> PathLimit:
+    """
+    Parse the values of a --rate-limit-path argument: PATH RPS [BURST]
+    :raise ValueError: if there are too few or too many values, or they are not valid numbers
+    """
+    if not 2 <= len(values) <= 3:
+        raise ValueError(f'--rate-limit-path takes a path, a rate and, optionally, a burst size; got {" ".join(values)}')
+    path = values[0]
+    try:
+        rate = float(values[1])
+        burst = int(values[2]) if len(values) == 3 else default_burst(rate)
+    except ValueError:
+        raise ValueError(f'Invalid rate or burst size for --rate-limit-path {" ".join(values)}')
+    if rate <= 0 or burst < 1:
+        raise ValueError(f'--rate-limit-path rate must be greater than 0, and burst size at least 1; '
+                         f'got {" ".join(values)}')
+    return PathLimit(path, rate, burst)
+
+
+class RateLimiter:
+    """
+    Simulate a local service with limited capacity. Requests are admitted by a token bucket refilled at rate requests
+    per second, and, if their path starts with the path of one of path_limits, by that path's own bucket; where
+    several path limits match, the longest path wins. A request must be admitted by every bucket that applies to it.
+    """
+
+    def __init__(self, rate: float | None = None, burst: int | None = None, path_limits: List[PathLimit] = ()):
+        self.bucket = TokenBucket(rate, burst or default_burst(rate)) if rate else None
+        # Longest paths first, so the first match is the most specific
+        self.path_buckets: List[Tuple[str, TokenBucket]] = [
+            (limit.path, TokenBucket(limit.rate, limit.burst))
+            for limit in sorted(path_limits, key=lambda limit: len(limit.path), reverse=True)
+        ]
+        if self.bucket:
+            logger.info(f'Limiting requests to {rate} per second, with bursts of up to {self.bucket.burst}')
+        for limit in path_limits:
+            logger.info(f'Limiting requests for {limit.path} to {limit.rate} per second, with bursts of up to '
+                        f'{limit.burst}')
+
+    def _buckets(self, path: str) -> List[TokenBucket]:
+        buckets = [next((bucket for prefix, bucket in self.path_buckets if path.startswith(prefix)), None),
+                   self.bucket]
+        return [bucket for bucket in buckets if bucket]
+
+    def acquire(self, path: str) -> float:
+        """
+        Admit a request, if its buckets have capacity
+        :return: 0 if the request was admitted; otherwise, the time, in seconds, until it would be
+        """
+        taken = []
+        for bucket in self._buckets(path):
+            wait = bucket.take()
+            if wait:
+                for taken_bucket in taken:
+                    taken_bucket.give_back()
+                return wait
+            taken.append(bucket)
+        return 0
+
+
+# Processing latency distributions, with their parameters, in seconds, and a function that draws a value
+LATENCY_DISTRIBUTIONS: Dict[str, Tuple[str, Callable[..., float]]] = {
+    'constant': ('SECONDS', lambda seconds: seconds),
+    'uniform': ('MIN,MAX', random.uniform),
+    'normal': ('MEAN,STDDEV', random.gauss),
+    'exponential': ('MEAN', lambda mean: random.expovariate(1 / mean)),
+    'lognormal': ('MEDIAN,SIGMA', lambda median, sigma: random.lognormvariate(math.log(median), sigma)),
+}
+
+
+class ProcessingLatency(NamedTuple):
+    """
+    Artificial processing time, drawn from a distribution for each request
+    """
+    distribution: str
+    parameters: Tuple[float, ...]
+
+    def sample(self) -> float:
+        return max(0.0, LATENCY_DISTRIBUTIONS[self.distribution][1](*self.parameters))
+
+    def __str__(self) -> str:
+        return f'{self.distribution}:{",".join(str(parameter) for parameter in self.parameters)}'
+
+
+def parse_processing_latency(spec: str) -> ProcessingLatency:
+    """
+    Parse a processing latency distribution, such as "exponential:0.05"
+    :raise ValueError: if spec is not a known distribution with the right number of positive parameters
+    """
+    distribution, _, parameter_text = spec.partition(':')
+    if distribution not in LATENCY_DISTRIBUTIONS:
+        raise ValueError(f'Unknown processing latency distribution "{distribution}"; must be one of '
+                         f'{", ".join(f"{name}:{params}" for name, (params, _) in LATENCY_DISTRIBUTIONS.items())}')
+    expected = LATENCY_DISTRIBUTIONS[distribution][0]
+    try:
+        parameters = tuple(float(parameter) for parameter in parameter_text.split(','))
+    except ValueError:
+        parameters = ()
+    if len(parameters) != len(expected.split(',')) or any(parameter < 0 for parameter in parameters) \
+            or (distribution in ('exponential', 'lognormal') and parameters[0] == 0):
+        raise ValueError(f'Processing latency "{spec}" must be of the form {distribution}:{expected}, in seconds')
+    return ProcessingLatency(distribution, parameters)
@@ -0,0 +1,180 @@
+import getpass
+import json
+import logging
+import os
+import subprocess
+import tempfile
+from pathlib import Path
+from threading import Lock
+from typing import Dict, List
+
+logging.basicConfig()
+logger = logging.getLogger('b2listen.registry')
+
+# Tolerance, in seconds, when comparing a process's create time with the recorded create time
+CREATE_TIME_TOLERANCE = 0.01
+
+
+def default_runtime_dir() -> str:
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'b2listen')
+    return os.path.join(tempfile.gettempdir(), f'b2listen-{getpass.getuser()}')
+
+
+def is_running(pid: int | None, create_time: float | None) -> bool:
+    """
+    :return: True if the process with the given PID is running and is the same process that was recorded, rather than
+    a later process that has reused its PID
+    """
+    import psutil
+
+    if not pid or create_time is None:
+        return False
+    try:
+        return abs(psutil.Process(pid).create_time() - create_time) < CREATE_TIME_TOLERANCE
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        return False
+
+
+class Session:
+    """
+    Registry entry for one run of listen or multi-listen: a JSON file, named for the cloudflared label, in the runtime
+    directory, recording the b2listen and cloudflared processes and the rules the session created or modified, so that
+    cleanup can find what a session that did not exit cleanly left behind without scanning every process.
+    """
+
+    def __init__(self, runtime_dir: str, label: str, mode: str, bucket_names: List[str]):
+        self.path = Path(runtime_dir) / f'{label}.json'
+        self.lock = Lock()
+        import psutil
+        owner = psutil.Process()
+        self.record = {
+            'label': label,
+            'mode': mode,
+            'buckets': bucket_names,
+            'owner_pid': owner.pid,
+            'owner_create_time': owner.create_time(),
+            'pid': None,
+            'create_time': None,
+            'rules': [],
+        }
+
+    def _save(self):
+        try:
+            self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix('.tmp')
+            tmp_path.write_text(json.dumps(self.record, indent=2))
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f'Cannot write session registry entry {self.path}: {e}')
+
+    def started(self, process: subprocess.Popen):
+        """
+        Record the cloudflared process
+        """
+        import psutil
+
+        with self.lock:
+            self.record['pid'] = process.pid
+            try:
+                self.record['create_time'] = psutil.Process(process.pid).create_time()
+            except psutil.Error:
+                # cloudflared has already exited
+                pass
+            self._save()
+
+    def add_rule(self, bucket_name: str, rule_name: str, old_url: str | None):
+        """
+        Record a rule the session created, with old_url None, or modified, with its original URL
+        """
+        with self.lock:
+            self.record['rules'].append({'bucket': bucket_name, 'name': rule_name, 'old_url': old_url})
+            self._save()
+
+    def remove_rules(self, bucket_name: str):
+        """
+        Forget the rules in a bucket, once they have been deleted or restored
+        """
+        with self.lock:
+            self.record['rules'] = [rule for rule in self.record['rules'] if rule['bucket'] != bucket_name]
+            self._save()
+
+    def close(self):
+        """
+        Remove the session's entry, unless there are rules that were not deleted or restored
+        """
+        with self.lock:
+            if self.record['rules']:
+                logger.warning('Some rules were not cleaned up; run the "cleanup" command to remove them')
+                return
+            self.path.unlink(missing_ok=True)
+
+
+class Entry:
+    """
+    A session's registry entry, as read by cleanup
+    """
+
+    def __init__(self, path: Path, record: Dict):
+        self.path = path
+        self.record = record
+        self.lock = Lock()
+        # Sessions may span several buckets, each cleaned up by a different thread
+        self.killed = False
+
+    @property
+    def label(self) -> str:
+        return self.record['label']
+
+    @property
+    def buckets(self) -> List[str]:
+        return self.record.get('buckets', [])
+
+    @property
+    def rules(self) -> List[Dict]:
+        return self.record['rules']
+
+    def owner_running(self) -> bool:
+        return is_running(self.record.get('owner_pid'), self.record.get('owner_create_time'))
+
+    def kill_cloudflared(self) -> int | None:
+        """
+        Kill the session's cloudflared process, if it is still running
+        :return: the process ID, if the process was killed
+        """
+        import psutil
+
+        with self.lock:
+            pid = self.record.get('pid')
+            if self.killed or not is_running(pid, self.record.get('create_time')):
+                return None
+            try:
+                psutil.Process(pid).kill()
+            except psutil.NoSuchProcess:
+                return None
+            self.killed = True
+            return pid
+
+    def remove_rules(self, bucket_name: str):
+        """
+        Forget the rules in a bucket, once cleanup has deleted or restored them, removing the entry if none remain
+        """
+        with self.lock:
+            self.record['rules'] = [rule for rule in self.rules if rule['bucket'] != bucket_name]
+            if self.rules:
+                tmp_path = self.path.with_suffix('.tmp')
+                tmp_path.write_text(json.dumps(self.record, indent=2))
+                os.replace(tmp_path, self.path)
+            else:
+                self.path.unlink(missing_ok=True)
+
+
+def read_entries(runtime_dir: str) -> List[Entry]:
+    entries = []
+    for path in sorted(Path(runtime_dir).glob('*.json')):
+        try:
+            entries.append(Entry(path, json.loads(path.read_text())))
+        except (OSError, ValueError) as e:
+            logger.warning(f'Ignoring unreadable session registry entry {path}: {e}')
+    return entries
@@ -0,0 +1,151 @@
+import atexit
+import json
+import logging
+import random
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+
+from b2listen import events
+
+logging.basicConfig()
+logger = logging.getLogger('b2listen.server.requests')
+
+MODE_FULL = 'full'
+MODE_SUMMARY = 'summary'
+MODE_NDJSON = 'ndjson'
+MODE_OFF = 'off'
+MODES = [MODE_FULL, MODE_SUMMARY, MODE_NDJSON, MODE_OFF]
+DEFAULT_MODE = MODE_FULL
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener thread. QueueHandler.prepare() formats each record on the
+    thread that logs it, which is the work we want to move off the request thread. The arguments of request log
+    records are not modified after they are logged, so it is safe to format them later.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class Request:
+    """
+    A request received by the embedded webserver. Its string form is only built when the record is formatted, on the
+    listener thread.
+    """
+
+    def __init__(self, request_log: 'RequestLog', method: str, path: str, headers, body: bytes, status: int,
+                 seconds: float):
+        self.request_log = request_log
+        self.time = time.time()
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+        self.status = status
+        self.seconds = seconds
+
+    def events(self) -> int:
+        return events.count_events(self.body)
+
+    def body_shown(self) -> bool:
+        return self.request_log.max_body is None or len(self.body) <= self.request_log.max_body
+
+    def full(self) -> str:
+        body = self.body.decode('utf-8', errors='replace') if self.body_shown() \
+            else f'<{len(self.body)} bytes, {self.events()} events, not shown>'
+        return f'{self.method} request,\nPath: {self.path}\nHeaders:\n{self.headers}\nBody:\n{body}\n'
+
+    def summary(self) -> str:
+        return (f'{self.method} {self.path} {int(self.status)} {len(self.body)} bytes {self.events()} events '
+                f'{self.seconds * 1000:.3f} ms')
+
+    def ndjson(self) -> str:
+        entry = {
+            'time': round(self.time, 6),
+            'method': self.method,
+            'path': self.path,
+            'status': int(self.status),
+            'bytes': len(self.body),
+            'events': self.events(),
+            'ms': round(self.seconds * 1000, 3),
+            'headers': dict(self.headers.items()),
+        }
+        if self.body_shown():
+            try:
+                entry['body'] = events.loads(self.body)
+            except ValueError:
+                entry['body'] = self.body.decode('utf-8', errors='replace')
+        return json.dumps(entry, separators=(',', ':'))
+
+    def __str__(self) -> str:
+        return getattr(self, self.request_log.mode)()
+
+
+class RequestLog:
+    """
+    Log of the messages received by the embedded webserver. Records are passed, unformatted, to a queue, and
+    formatted and written by a background thread, so that the request thread does not wait for the console or a file.
+
+    Modes:
+
+    * full: the path, headers and body of each message, as multi-line text
+    * summary: one line per message, with the path, response status, size, number of events and handling time
+    * ndjson: one compact JSON object per message, including the headers and the parsed body
+    * off: nothing
+
+    sample_rate is the fraction of messages to log. In the full and ndjson modes, bodies larger than max_body bytes are
+    summarized rather than shown.
+    """
+
+    def __init__(self, mode: str = DEFAULT_MODE, sample_rate: float = 1.0, max_body: int | None = None,
+                 path: str | None = None):
+        if mode not in MODES:
+            raise ValueError(f'Unknown request log mode "{mode}"; must be one of {MODES}')
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.max_body = max_body
+        self.path = path
+        self.listener: QueueListener | None = None
+        self.queue_handler: QueueHandler | None = None
+
+    def start(self):
+        if self.mode == MODE_OFF or self.listener:
+            return
+        handler = logging.FileHandler(self.path) if self.path else logging.StreamHandler(sys.stderr)
+        # NDJSON lines must be valid JSON, so they are written without the level and logger name
+        handler.setFormatter(logging.Formatter('%(message)s' if self.mode == MODE_NDJSON else logging.BASIC_FORMAT))
+        queue = SimpleQueue()
+        self.listener = QueueListener(queue, handler)
+        self.queue_handler = DeferredQueueHandler(queue)
+        logger.addHandler(self.queue_handler)
+        logger.propagate = False
+        self.listener.start()
+        # Write out any queued records before exit
+        atexit.register(self.stop)
+
+    def stop(self):
+        if self.listener:
+            logger.removeHandler(self.queue_handler)
+            logger.propagate = True
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+            self.listener = None
+            atexit.unregister(self.stop)
+
+    def log(self, method: str, path: str, headers, body: bytes, status: int, seconds: float, delivered: bool):
+        """
+        Log a message. In full mode, messages passed to a delivery target are only logged, briefly, at debug level,
+        since the target is responsible for them.
+        """
+        if self.mode == MODE_OFF or (self.sample_rate < 1 and random.random() >= self.sample_rate):
+            return
+        if self.mode == MODE_FULL and delivered:
+            logger.debug('%s request, Path: %s, %d bytes', method, path, len(body))
+            return
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(Request(self, method, path, headers, body, status, seconds))
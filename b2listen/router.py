@@ -0,0 +1,150 @@
+import fnmatch
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Dict, FrozenSet, List, NamedTuple, Tuple
+
+from b2listen.defaults import DEFAULT_CONCURRENCY
+from b2listen.events import Event, EventMessage
+from b2listen.signature import EVENT_NOTIFICATION_SIGNATURE_HEADER, create_message_signature
+
+logging.basicConfig()
+logger = logging.getLogger('b2listen.router')
+
+ALL_EVENT_TYPES = '*'
+
+
+class Route(NamedTuple):
+    """
+    Events whose object name starts with prefix, and whose event type matches event_type, a pattern such as
+    "b2:ObjectCreated:*", are delivered to url
+    """
+    url: str
+    prefix: str = ''
+    event_type: str = ALL_EVENT_TYPES
+
+
+def parse_route(values: List[str]) -> Route:
+    """
+    Parse the values of a --route argument: URL [PREFIX [EVENT-TYPE]]
+    :raise ValueError: if there are too many values
+    """
+    if not 1 <= len(values) <= 3:
+        raise ValueError(f'--route takes a URL, and, optionally, an object name prefix and an event type; '
+                         f'got {" ".join(values)}')
+    return Route(*values)
+
+
+class PrefixTrie:
+    """
+    Map object name prefixes to the indexes of the routes with that prefix. Matching an object name walks the trie
+    once, one character at a time, collecting the routes at each node, so its cost depends on the length of the name
+    rather than the number of routes.
+    """
+
+    def __init__(self):
+        self.root: Dict = {}
+
+    def add(self, prefix: str, index: int):
+        node = self.root
+        for character in prefix:
+            node = node.setdefault(character, {})
+        # '' cannot be a child key, since keys are single characters
+        node.setdefault('', []).append(index)
+
+    def match(self, name: str) -> List[int]:
+        node = self.root
+        matches = list(node.get('', []))
+        for character in name:
+            node = node.get(character)
+            if node is None:
+                break
+            matches.extend(node.get('', []))
+        return matches
+
+
+class EventRouter:
+    """
+    Delivery target that splits the events array of each event notification message by route, delivering each
+    route's events to its target, concurrently, as a message of its own. An event is delivered to every route that it
+    matches; events that match no route are dropped.
+
+    targets maps each route's URL to a delivery target, such as a Forwarder. Messages without an events array, such as
+    the event broker's probe, are delivered to every target unchanged. If the events for a target are all the events
+    in the message, the original message is delivered, with its signature; otherwise, the signature is removed, and,
+    if signing_secret is set, the new message is signed with it.
+    """
+
+    def __init__(self, routes: List[Route], targets: Dict[str, object], signing_secret: str | None = None,
+                 concurrency: int = DEFAULT_CONCURRENCY):
+        self.routes = routes
+        self.targets = targets
+        self.signing_secret = signing_secret
+        self.trie = PrefixTrie()
+        for index, route in enumerate(routes):
+            self.trie.add(route.prefix, index)
+        self.type_patterns = [re.compile(fnmatch.translate(route.event_type)) for route in routes]
+        # There are only a handful of event types, so cache the routes that match each one
+        self.type_cache: Dict[str, FrozenSet[int]] = {}
+        self.lock = Lock()
+        # Each message may be split across every target, and the embedded webserver handles up to concurrency messages
+        # at once
+        self.executor = ThreadPoolExecutor(max_workers=max(1, concurrency * len(targets)),
+                                           thread_name_prefix='b2listen-router')
+        for route in routes:
+            logger.info(f'Routing events for prefix "{route.prefix}" and event type "{route.event_type}" to '
+                        f'{route.url}')
+
+    def _routes_for_type(self, event_type: str) -> FrozenSet[int]:
+        routes = self.type_cache.get(event_type)
+        if routes is None:
+            routes = frozenset(index for index, pattern in enumerate(self.type_patterns) if pattern.match(event_type))
+            with self.lock:
+                self.type_cache[event_type] = routes
+        return routes
+
+    def split(self, events: List[Event]) -> Dict[str, List[Event]]:
+        """
+        :return: the events for each target URL, in their original order
+        """
+        by_url: Dict[str, List[Event]] = {}
+        for event in events:
+            type_routes = self._routes_for_type(event.event_type)
+            urls = {self.routes[index].url for index in self.trie.match(event.object_name) if index in type_routes}
+            if not urls:
+                logger.debug(f'No route for event {event.event_id}')
+            for url in urls:
+                by_url.setdefault(url, []).append(event)
+        return by_url
+
+    def deliver(self, path: str, headers: List[Tuple[str, str]], body: bytes):
+        message = EventMessage(body)
+        events = message.events
+        if not events:
+            deliveries = [(url, headers, body) for url in self.targets]
+        else:
+            deliveries = []
+            for url, url_events in self.split(events).items():
+                if len(url_events) == len(events):
+                    deliveries.append((url, headers, body))
+                else:
+                    deliveries.append((url, *self._sub_message(message, headers, url_events)))
+
+        if len(deliveries) == 1:
+            url, url_headers, url_body = deliveries[0]
+            self.targets[url].deliver(path, url_headers, url_body)
+            return
+        futures = [self.executor.submit(self.targets[url].deliver, path, url_headers, url_body)
+                   for url, url_headers, url_body in deliveries]
+        # Raise the first error, if any, so that B2 retries the message
+        for future in futures:
+            future.result()
+
+    def _sub_message(self, message: EventMessage, headers: List[Tuple[str, str]], events: List[Event]) \
+            -> Tuple[List[Tuple[str, str]], bytes]:
+        body = message.with_events(events)
+        headers = [(name, value) for name, value in headers if name.lower() != EVENT_NOTIFICATION_SIGNATURE_HEADER]
+        if self.signing_secret:
+            headers.append((EVENT_NOTIFICATION_SIGNATURE_HEADER, create_message_signature(self.signing_secret, body)))
+        return headers, body
@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import copy
+import logging
+import time
+import warnings
+from typing import TYPE_CHECKING, Callable, List
+
+if TYPE_CHECKING:
+    from b2sdk.v2 import Bucket, NotificationRule
+
+logging.basicConfig()
+logger = logging.getLogger('b2listen.rules')
+
+# Rules read more than this many seconds ago are read again before they are changed, so that a long-running session
+# does not overwrite changes that were made while it was running
+DEFAULT_MAX_AGE = 30
+
+
+class RuleNotFound(LookupError):
+    pass
+
+
+class RuleSet:
+    """
+    A bucket's event notification rules, read from B2 once and cached, so that several create, modify and delete
+    operations can be applied locally and written to B2 in a single set_notification_rules() call by commit().
+
+    Operations are applied to the cached rules as they are made, so their results, such as a modified rule's old URL,
+    are available immediately. If B2 rejects the write, and the bucket's rules have changed since they were read, the
+    operations are replayed against the current rules and the write is retried once.
+    """
+
+    def __init__(self, b2bucket: Bucket, max_age: float = DEFAULT_MAX_AGE):
+        self.bucket = b2bucket
+        self.max_age = max_age
+        # Rules as last read from, or written to, B2
+        self.base: List[NotificationRule] | None = None
+        self.read_at = 0.0
+        # Rules with pending operations applied
+        self.rules: List[NotificationRule] | None = None
+        self.operations: List[Callable[[List[NotificationRule]], object]] = []
+
+    def _read(self) -> List[NotificationRule]:
+        # Suppress FeaturePreviewWarning for Event Notifications
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            rules = self.bucket.get_notification_rules()
+        self.read_at = time.monotonic()
+        logger.debug(f'Read {len(rules)} rules from bucket "{self.bucket.name}"')
+        return rules
+
+    def _write(self, rules: List[NotificationRule]) -> List[NotificationRule]:
+        # Suppress FeaturePreviewWarning for Event Notifications
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            # Suppress warnings about incompatible types - NotificationRule != NotificationRuleResponse
+            # noinspection PyTypeChecker
+            written = self.bucket.set_notification_rules(rules)
+        self.read_at = time.monotonic()
+        logger.debug(f'Wrote {len(rules)} rules to bucket "{self.bucket.name}"')
+        return written
+
+    def _reset(self, rules: List[NotificationRule]):
+        self.base = rules
+        self.rules = copy.deepcopy(rules)
+        self.operations = []
+
+    def get_rules(self) -> List[NotificationRule]:
+        """
+        :return: the rules, including any pending operations, reading them from B2 if they have not been read, or were
+        read more than max_age seconds ago and there are no pending operations
+        """
+        if self.rules is None or (not self.operations and time.monotonic() - self.read_at > self.max_age):
+            self._reset(self._read())
+        return self.rules
+
+    def find(self, name: str) -> NotificationRule | None:
+        return next((rule for rule in self.get_rules() if rule['name'] == name), None)
+
+    def _apply(self, operation: Callable[[List[NotificationRule]], object]):
+        result = operation(self.get_rules())
+        self.operations.append(operation)
+        return result
+
+    def create(self, rule: NotificationRule):
+        def operation(rules: List[NotificationRule]):
+            rules.append(copy.deepcopy(rule))
+
+        self._apply(operation)
+
+    def modify_url(self, name: str, url: str) -> str:
+        """
+        Set the target URL of a rule
+        :return: the rule's previous URL
+        :raise RuleNotFound: if there is no rule with the name
+        """
+        def operation(rules: List[NotificationRule]) -> str:
+            rule = next((rule for rule in rules if rule['name'] == name), None)
+            if not rule:
+                raise RuleNotFound(f'Cannot find rule "{name}" in bucket "{self.bucket.name}"')
+            old_url = rule['targetConfiguration']['url']
+            rule['targetConfiguration']['url'] = url
+            return old_url
+
+        return self._apply(operation)
+
+    def delete(self, name: str) -> bool:
+        """
+        :return: True if there was a rule with the name
+        """
+        return bool(self.delete_matching(lambda rule: rule['name'] == name))
+
+    def delete_matching(self, predicate: Callable[[NotificationRule], bool]) -> List[str]:
+        """
+        :return: the names of the deleted rules
+        """
+        if not any(predicate(rule) for rule in self.get_rules()):
+            # Nothing to write
+            return []
+
+        def operation(rules: List[NotificationRule]) -> List[str]:
+            deleted = [rule['name'] for rule in rules if predicate(rule)]
+            rules[:] = [rule for rule in rules if not predicate(rule)]
+            return deleted
+
+        return self._apply(operation)
+
+    def commit(self):
+        """
+        Write the rules, with pending operations applied, to B2. If B2 rejects them, the pending operations are
+        discarded, leaving the rules as they currently are in B2.
+        :raise BadRequest: if B2 rejects the rules
+        :raise RuleNotFound: if a rule that was to be modified has since been deleted
+        """
+        from b2sdk.v2.exception import BadRequest
+
+        if not self.operations:
+            return
+        operations = self.operations
+        try:
+            try:
+                self._reset(self._write(self.rules))
+            except BadRequest:
+                current = self._read()
+                if current == self.base:
+                    # The rules were up to date, so B2 rejected the operations themselves
+                    raise
+                logger.info(f'Rules in bucket "{self.bucket.name}" changed since they were read; retrying')
+                self._reset(current)
+                for operation in operations:
+                    operation(self.rules)
+                self._reset(self._write(self.rules))
+        except (BadRequest, RuleNotFound):
+            self.rules = copy.deepcopy(self.base)
+            self.operations = []
+            raise
@@ -9,12 +9,24 @@ Usage::
 
 From https://gist.github.com/mdonkers/63e115cc0c79b4f6b8b3a6b797e485c7
 """
+import math
 import random
+import time
 from http import HTTPStatus
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
 from sys import argv
 import logging
-from threading import Thread
+from threading import BoundedSemaphore, Condition, Thread
+from typing import Dict, List, Tuple
+
+from b2listen import metrics
+from b2listen.dedup import EventsInFlight
+from b2listen.defaults import DEFAULT_CONCURRENCY, DEFAULT_DRAIN_TIMEOUT, DEFAULT_ENGINE, DEFAULT_KEEP_ALIVE_TIMEOUT, \
+    ENGINE_SIMPLE, ENGINE_THREADED, ENGINES
+from b2listen.events import count_events
+from b2listen.requestlog import RequestLog
+from b2listen.signature import EVENT_NOTIFICATION_SIGNATURE_HEADER, create_message_signature, \
+    verify_message_signature
 
 RETRY_AFTER = 'Retry-After'
 
@@ -23,56 +35,326 @@ logger = logging.getLogger('b2listen.server')
 
 DEFAULT_INTERFACE = 'localhost'
 DEFAULT_PORT = 8080
+# How often, in seconds, serve_forever() checks whether it has been asked to stop. Once the drain timeout has expired,
+# drain() allows two poll intervals for it to stop.
+POLL_INTERVAL = 0.5
+
+
+class BoundedThreadingHTTPServer(ThreadingHTTPServer):
+    """
+    HTTPServer that serves each connection on its own thread, but handles at most max_requests requests at a time.
+    A connection waiting for its next request does not count against the limit, so idle keep-alive connections do
+    not hold up requests on other connections.
+    """
+    # So that idle keep-alive connections do not hold up exit
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class, max_requests=DEFAULT_CONCURRENCY):
+        super().__init__(server_address, handler_class)
+        self.request_slots = BoundedSemaphore(max_requests)
+
+
+class InFlight:
+    """
+    Count the messages, and their events, that the embedded webserver is handling, so that, on shutdown, it can finish
+    handling them before it stops
+    """
+
+    def __init__(self):
+        self.condition = Condition()
+        self.messages = 0
+        self.events = 0
+        self.draining = False
+        self.drained_messages = 0
+        self.drained_events = 0
+
+    def enter(self, events: int):
+        with self.condition:
+            self.messages += 1
+            self.events += events
+
+    def exit(self, events: int):
+        with self.condition:
+            self.messages -= 1
+            self.events -= events
+            if self.draining:
+                self.drained_messages += 1
+                self.drained_events += events
+                self.condition.notify_all()
+
+    def drain(self, timeout: float) -> Dict[str, int]:
+        """
+        Wait up to timeout seconds for the messages being handled, and any that arrive meanwhile, to be handled
+        :return: the number of messages and events handled while draining, and the number still being handled when
+        the timeout expired
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            self.draining = True
+            while self.messages and (remaining := deadline - time.monotonic()) > 0:
+                self.condition.wait(remaining)
+            return {
+                'drained_messages': self.drained_messages,
+                'drained_events': self.drained_events,
+                'abandoned_messages': self.messages,
+                'abandoned_events': self.events,
+            }
 
 
 class S(BaseHTTPRequestHandler):
     rate_limit_frequency = 0
     retry_after = 0
+    # Optional delivery target, for example, a spool. If set, accepted messages are passed to its
+    # deliver(path, headers, body) method rather than logged.
+    target = None
+    # Optional DedupIndex. If set, events that have already been accepted are dropped.
+    dedup = None
+    # If False, don't write a line to stderr for each request, for example, when benchmarking the server
+    log_requests = True
+    # Optional ArchiveWriter. If set, every message received is recorded.
+    recorder = None
+    # RequestLog for POST requests
+    request_log = RequestLog()
+    # Optional signing secret. If set, messages with a missing or incorrect signature are counted, and, if
+    # verify_signatures is set, rejected. Messages modified by the dedup stage are signed again.
+    signing_secret = None
+    verify_signatures = False
+    # Optional RateLimiter. If set, requests it does not admit receive a 429 response with a Retry-After header of the
+    # time until it would.
+    rate_limiter = None
+    # Optional EventSink. If set, the events in accepted messages are stored in it, after the dedup stage.
+    sink = None
+    # Messages being handled
+    in_flight = InFlight()
+    # Optional ProcessingLatency. If set, accepted messages are held for a time drawn from it before responding.
+    processing_latency = None
+    # The response headers and body are written separately, so, on a kept-alive connection, Nagle's algorithm would
+    # hold back the body until the client's delayed ACK for the headers, adding up to 40 ms to every response
+    disable_nagle_algorithm = True
+
+    def log_request(self, code='-', size='-'):
+        if self.log_requests:
+            super().log_request(code, size)
 
-    def _set_response(self, status_code):
+    def log_error(self, format, *args):  # noqa
+        if format.startswith('Request timed out'):
+            # A keep-alive connection that has been idle for the keep-alive timeout; cloudflared will open another
+            logger.debug(format, *args)
+            return
+        super().log_error(format, *args)
+
+    def parse_request(self):
+        # The request line has arrived, so, if the server limits concurrent requests, wait for a slot to handle it
+        slots = getattr(self.server, 'request_slots', None)
+        if slots:
+            slots.acquire()
+            self.request_slot = slots
+        return super().parse_request()
+
+    def handle_one_request(self):
+        self.request_slot = None
+        try:
+            super().handle_one_request()
+        finally:
+            if self.request_slot:
+                self.request_slot.release()
+
+    def _set_response(self, status_code, body: bytes = b'', retry_after: int | None = None):
         self.send_response(status_code)
         if status_code == HTTPStatus.TOO_MANY_REQUESTS:
-            self.send_header(RETRY_AFTER, str(self.retry_after))
+            self.send_header(RETRY_AFTER, str(self.retry_after if retry_after is None else retry_after))
+        # Always send Content-Length so that HTTP/1.1 clients can reuse the connection
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
+        self.wfile.write(body)
 
     # noinspection PyPep8Naming
     def do_GET(self):
         logger.info("GET request,\nPath: %s\nHeaders:\n%s\n", str(self.path), str(self.headers))
-        self._set_response(HTTPStatus.OK)
-        self.wfile.write("GET request for {}".format(self.path).encode('utf-8'))
+        self._set_response(HTTPStatus.OK, "GET request for {}".format(self.path).encode('utf-8'))
 
     # noinspection PyPep8Naming
     def do_POST(self):
+        start = time.perf_counter()
         content_length = int(self.headers['Content-Length'])  # <--- Gets the size of data
         post_data = self.rfile.read(content_length)  # <--- Gets the data itself
-        logger.info("POST request,\nPath: %s\nHeaders:\n%s\nBody:\n%s\n",
-                    str(self.path), str(self.headers), post_data.decode('utf-8'))
+        events = count_events(post_data)
+        self.in_flight.enter(events)
+        try:
+            self._handle_post(start, post_data, events)
+        finally:
+            self.in_flight.exit(events)
 
-        status_code = HTTPStatus.OK if random.random() > (self.rate_limit_frequency / 100) \
-            else HTTPStatus.TOO_MANY_REQUESTS
-        self._set_response(status_code)
-        self.wfile.write("POST request for {}".format(self.path).encode('utf-8'))
+    def _handle_post(self, start: float, post_data: bytes, events: int):
+        if self.signing_secret and not verify_message_signature(
+                self.signing_secret, post_data, self.headers.get(EVENT_NOTIFICATION_SIGNATURE_HEADER)):
+            metrics.signature_failures.inc()
+            status_code = HTTPStatus.UNAUTHORIZED if self.verify_signatures else HTTPStatus.OK
+        else:
+            status_code = HTTPStatus.OK
+
+        retry_after = None
+        if status_code == HTTPStatus.UNAUTHORIZED:
+            # Reject the message before parsing or delivering it
+            logger.warning(f'Rejected message for {self.path} with missing or incorrect signature')
+        elif self.rate_limiter and (wait := self.rate_limiter.acquire(self.path)):
+            status_code = HTTPStatus.TOO_MANY_REQUESTS
+            # Retry-After is in whole seconds
+            retry_after = math.ceil(wait)
+        elif random.random() < (self.rate_limit_frequency / 100):
+            status_code = HTTPStatus.TOO_MANY_REQUESTS
+        else:
+            status_code = self._accept(post_data)
+            if self.processing_latency and status_code == HTTPStatus.OK:
+                time.sleep(self.processing_latency.sample())
+        self._set_response(status_code, "POST request for {}".format(self.path).encode('utf-8'), retry_after)
+        elapsed = time.perf_counter() - start
+        if self.recorder:
+            self.recorder.record(self.path, self.headers.items(), post_data, status_code)
+        self.request_log.log(self.command, self.path, self.headers, post_data, status_code, elapsed,
+                             delivered=bool(self.target))
+        metrics.record_message(status_code, len(post_data), events, elapsed)
+
+    def _deduplicate(self, post_data: bytes, headers: List[Tuple[str, str]]) \
+            -> Tuple[bytes | None, List[Tuple[str, str]], List[str]]:
+        """
+        Remove the events that have already been delivered from a message, signing it again if it changed
+        :return: (message, or None if every event was a duplicate; its headers; IDs of the new events, which are
+        claimed until they are committed or released)
+        :raise EventsInFlight: if any of the message's events is being delivered as part of another message
+        """
+        deduped, new_ids = self.dedup.filter(post_data)
+        if deduped is not None and deduped is not post_data:
+            # The original signature does not match the modified message
+            headers = [(name, value) for name, value in headers
+                       if name.lower() != EVENT_NOTIFICATION_SIGNATURE_HEADER]
+            if self.signing_secret:
+                headers.append((EVENT_NOTIFICATION_SIGNATURE_HEADER,
+                                create_message_signature(self.signing_secret, deduped)))
+        return deduped, headers, new_ids
+
+    def _deliver(self, post_data: bytes, headers: List[Tuple[str, str]], new_ids: List[str]) -> bool:
+        """
+        Pass a message to the target, if any, then commit the IDs of its new events to the dedup index, if any, if it
+        was delivered, or release them if it was not
+        :return: whether the message was delivered
+        """
+        delivered = False
+        try:
+            if self.target:
+                self.target.deliver(self.path, headers, post_data)
+            delivered = True
+        except Exception as e:  # noqa
+            logger.error(f'Error delivering event notification message: {e}')
+        finally:
+            # Only events that have been delivered are duplicates when B2 sends them again
+            if self.dedup:
+                if delivered:
+                    self.dedup.commit(new_ids)
+                else:
+                    self.dedup.release(new_ids)
+        return delivered
+
+    def _accept(self, post_data: bytes) -> HTTPStatus:
+        """
+        Pass an accepted message through the dedup stage, if any, to the target, if any
+        """
+        headers = self.headers.items()
+        new_ids = []
+        if self.dedup:
+            try:
+                post_data, headers, new_ids = self._deduplicate(post_data, headers)
+            except EventsInFlight as e:
+                # B2 is retrying a message that is still being delivered; have it retry again later
+                logger.info(f'Refused message: {e}')
+                return HTTPStatus.SERVICE_UNAVAILABLE
+            if post_data is None:
+                logger.info('Dropped message containing only duplicate events')
+                return HTTPStatus.OK
+
+        if not self._deliver(post_data, headers, new_ids):
+            # Let B2 retry the message later
+            return HTTPStatus.SERVICE_UNAVAILABLE
+        if self.sink:
+            self.sink.record(self.path, post_data)
+        return HTTPStatus.OK
 
 
 class Server(Thread):
-    def __init__(self, server_class=HTTPServer, handler_class=S, interface=DEFAULT_INTERFACE, port=DEFAULT_PORT,
-                 daemon=False, rate_limit_frequency=0, retry_after=0):
+    def __init__(self, server_class=None, handler_class=S, interface=DEFAULT_INTERFACE, port=DEFAULT_PORT,
+                 daemon=False, rate_limit_frequency=0, retry_after=0, engine=DEFAULT_ENGINE,
+                 concurrency=DEFAULT_CONCURRENCY, keep_alive_timeout=DEFAULT_KEEP_ALIVE_TIMEOUT, target=None,
+                 dedup=None, log_requests=True, signing_secret=None, request_log=None,
+                 recorder=None, verify_signatures=False, rate_limiter=None, processing_latency=None,
+                 sink=None):
         super().__init__(daemon=daemon)
         server_address = (interface, port)
-        # noinspection PyTypeChecker
-        self.httpd = server_class(server_address, handler_class)
+        self.engine = engine
+        if engine == ENGINE_THREADED:
+            # Each connection has its own thread, so we can keep connections open between requests, closing them
+            # after they have been idle for keep_alive_timeout seconds, while handling at most concurrency requests
+            # at a time
+            handler_class.protocol_version = 'HTTP/1.1'
+            handler_class.timeout = keep_alive_timeout
+            # noinspection PyTypeChecker
+            self.httpd = (server_class or BoundedThreadingHTTPServer)(server_address, handler_class,
+                                                                      max_requests=concurrency)
+        elif engine == ENGINE_SIMPLE:
+            # A single thread serves all connections, so close each connection after responding
+            handler_class.protocol_version = 'HTTP/1.0'
+            handler_class.timeout = None
+            # noinspection PyTypeChecker
+            self.httpd = (server_class or HTTPServer)(server_address, handler_class)
+        else:
+            raise ValueError(f'Unknown server engine "{engine}"; must be one of {ENGINES}')
         self.interface = self.httpd.server_address[0]
         self.port = self.httpd.server_address[1]
-        S.rate_limit_frequency = rate_limit_frequency
-        S.retry_after = retry_after
+        handler_class.rate_limit_frequency = rate_limit_frequency or 0
+        handler_class.retry_after = retry_after or 0
+        handler_class.target = target
+        handler_class.dedup = dedup
+        handler_class.log_requests = log_requests
+        handler_class.signing_secret = signing_secret
+        handler_class.verify_signatures = verify_signatures
+        handler_class.recorder = recorder
+        handler_class.rate_limiter = rate_limiter
+        handler_class.processing_latency = processing_latency
+        handler_class.sink = sink
+        self.in_flight = InFlight()
+        handler_class.in_flight = self.in_flight
+        self.request_log = request_log or RequestLog()
+        handler_class.request_log = self.request_log
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.interface}:{self.port}'
+
+    def drain(self, timeout: float = DEFAULT_DRAIN_TIMEOUT) -> Dict[str, int]:
+        """
+        Wait up to timeout seconds for the messages being handled to be acknowledged, then stop serving
+        :return: the number of messages and events handled while draining, and abandoned when the timeout expired
+        """
+        deadline = time.monotonic() + timeout
+        report = self.in_flight.drain(timeout)
+        # The simple engine only checks for shutdown between connections, so a connection that never sends its
+        # request would block shutdown() forever
+        stopper = Thread(target=self.httpd.shutdown, daemon=True, name='b2listen-shutdown')
+        stopper.start()
+        stopper.join(max(deadline - time.monotonic(), 2 * POLL_INTERVAL))
+        if stopper.is_alive():
+            logger.warning(f'Abandoning the embedded webserver, which is still handling a connection after {timeout} '
+                           f'seconds')
+        return report
 
     def run(self):
-        logger.info(f'Starting HTTP server on {self.interface}:{self.port}')
+        logger.info(f'Starting HTTP server on {self.interface}:{self.port} ({self.engine} engine)')
+        self.request_log.start()
         try:
-            self.httpd.serve_forever()
+            self.httpd.serve_forever(POLL_INTERVAL)
         except KeyboardInterrupt:
             pass
         self.httpd.server_close()
+        self.request_log.stop()
         logger.info('Stopping httpd...\n')
 
 
@@ -0,0 +1,33 @@
+import hashlib
+import hmac
+from functools import lru_cache
+
+EVENT_NOTIFICATION_SIGNATURE_HEADER = 'x-bz-event-notification-signature'
+
+
+@lru_cache(maxsize=16)
+def hmac_template(signing_secret: str) -> hmac.HMAC:
+    """
+    HMAC object keyed with the signing secret. Copying it skips recomputing the key pads for every message.
+    """
+    return hmac.new(bytes(signing_secret, 'utf-8'), digestmod=hashlib.sha256)
+
+
+def create_message_signature(signing_secret: str, body: bytes) -> str:
+    """
+    Create the signature for an event notification message.
+    """
+    mac = hmac_template(signing_secret).copy()
+    mac.update(body)
+    return 'v1=' + mac.hexdigest().lower()
+
+
+def verify_message_signature(signing_secret: str, body: bytes, signature: str | None) -> bool:
+    """
+    Check the signature of an event notification message in constant time, so that response timing does not reveal
+    how much of a forged signature is correct.
+    """
+    if not signature:
+        return False
+    return hmac.compare_digest(bytes(signature.lower(), 'utf-8'),
+                               bytes(create_message_signature(signing_secret, body), 'utf-8'))
@@ -0,0 +1,273 @@
+import abc
+import atexit
+import datetime
+import logging
+import time
+from pathlib import Path
+from threading import Condition, Thread
+from typing import TYPE_CHECKING, Iterator, List, Tuple, Type
+
+from b2listen.events import Event, EventMessage, count_events, dumps, loads
+
+if TYPE_CHECKING:
+    import sqlite3
+
+logging.basicConfig()
+logger = logging.getLogger('b2listen.sink')
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_BATCH_INTERVAL = 1.0
+DEFAULT_MAX_FILE_SIZE = 100 * 1024 * 1024
+# Upper bound for strings that start with a prefix; U+10FFFF sorts after every other code point in UTF-8
+MAX_CHARACTER = '\U0010ffff'
+
+# (time received, in seconds since the epoch, request path, event)
+Row = Tuple[float, str, Event]
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    received REAL NOT NULL,
+    path TEXT NOT NULL,
+    event_id TEXT,
+    event_type TEXT,
+    event_timestamp INTEGER,
+    bucket_name TEXT,
+    matched_rule_name TEXT,
+    object_name TEXT,
+    object_size INTEGER,
+    object_version_id TEXT,
+    event TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_object_name ON events (object_name);
+CREATE INDEX IF NOT EXISTS events_event_type ON events (event_type, event_timestamp);
+CREATE INDEX IF NOT EXISTS events_event_timestamp ON events (event_timestamp);
+'''
+
+INSERT = '''
+INSERT INTO events (received, path, event_id, event_type, event_timestamp, bucket_name, matched_rule_name,
+                    object_name, object_size, object_version_id, event)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+
+class EventSink(abc.ABC):
+    """
+    Store the events in the messages accepted by the embedded webserver.
+
+    Request threads only queue each message. A background thread parses the queued messages and writes their events
+    in a single batch when batch_size events are waiting, or at least every batch_interval seconds, so that bursts of
+    messages do not wait for storage.
+    """
+    # Errors that _write() raises when the events cannot be stored
+    errors: Tuple[Type[Exception], ...] = (OSError,)
+
+    def __init__(self, batch_size: int = DEFAULT_BATCH_SIZE, batch_interval: float = DEFAULT_BATCH_INTERVAL):
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.condition = Condition()
+        self.pending: List[Tuple[float, str, bytes]] = []
+        self.pending_events = 0
+        self.closed = False
+        self.events = 0
+
+        self._open()
+
+        self.writer = Thread(target=self._write_periodically, daemon=True, name='b2listen-sink')
+        self.writer.start()
+        atexit.register(self.close)
+
+    @abc.abstractmethod
+    def _open(self):
+        """
+        Prepare the storage, before the writer thread starts
+        """
+
+    @abc.abstractmethod
+    def _write(self, rows: List[Row]):
+        """
+        Store a batch of events, on the writer thread
+        """
+
+    @abc.abstractmethod
+    def _close(self):
+        """
+        Release the storage, once the last batch has been written
+        """
+
+    def record(self, path: str, body: bytes):
+        events = count_events(body)
+        if not events:
+            # For example, the event broker's probe message
+            return
+        with self.condition:
+            if self.closed:
+                return
+            self.pending.append((time.time(), path, body))
+            self.pending_events += events
+            if self.pending_events >= self.batch_size:
+                self.condition.notify_all()
+
+    def _take(self) -> List[Tuple[float, str, bytes]]:
+        messages = self.pending
+        self.pending = []
+        self.pending_events = 0
+        return messages
+
+    def _write_messages(self, messages: List[Tuple[float, str, bytes]]):
+        rows = [(received, path, event) for received, path, body in messages
+                for event in EventMessage(body).events or []]
+        if rows:
+            try:
+                self._write(rows)
+                self.events += len(rows)
+            except self.errors as e:
+                logger.error(f'Error storing {len(rows)} events: {e}')
+
+    def _write_periodically(self):
+        while True:
+            with self.condition:
+                if self.closed:
+                    return
+                if self.pending_events < self.batch_size:
+                    self.condition.wait(self.batch_interval)
+                if self.closed or not self.pending:
+                    continue
+                messages = self._take()
+            self._write_messages(messages)
+
+    def close(self):
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify_all()
+        self.writer.join()
+        self._write_messages(self._take())
+        self._close()
+        atexit.unregister(self.close)
+
+
+class NdjsonSink(EventSink):
+    """
+    Append events, as lines of JSON with the time they were received, the request path and the event, to files in
+    directory, starting a new file when the current one reaches max_file_size bytes
+    """
+
+    def __init__(self, directory: str, max_file_size: int = DEFAULT_MAX_FILE_SIZE,
+                 batch_size: int = DEFAULT_BATCH_SIZE, batch_interval: float = DEFAULT_BATCH_INTERVAL):
+        self.directory = Path(directory)
+        self.max_file_size = max_file_size
+        self.file = None
+        super().__init__(batch_size, batch_interval)
+
+    def _open(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._rotate()
+        logger.info(f'Storing received events in {self.directory}')
+
+    def _rotate(self):
+        if self.file:
+            self.file.close()
+        name = datetime.datetime.now().strftime('events-%Y%m%d-%H%M%S-%f.ndjson')
+        self.file = open(self.directory / name, 'ab')
+
+    def _write(self, rows: List[Row]):
+        lines = b''.join(dumps({'time': round(received, 6), 'path': path, 'event': event.raw}) + b'\n'
+                         for received, path, event in rows)
+        if self.file.tell() and self.file.tell() + len(lines) > self.max_file_size:
+            self._rotate()
+        self.file.write(lines)
+        self.file.flush()
+
+    def _close(self):
+        self.file.close()
+        logger.info(f'Stored {self.events} events in {self.directory}')
+
+
+class SqliteSink(EventSink):
+    """
+    Insert events into the events table of an SQLite database, indexed by object name, event type and event
+    timestamp. Each batch is written in a single transaction.
+    """
+
+    def __init__(self, path: str, batch_size: int = DEFAULT_BATCH_SIZE,
+                 batch_interval: float = DEFAULT_BATCH_INTERVAL):
+        self.path = path
+        self.db: 'sqlite3.Connection | None' = None
+        super().__init__(batch_size, batch_interval)
+
+    def _open(self):
+        import sqlite3
+        # The connection is only used by the writer thread, once it has started, and by close(), once it has stopped
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.errors = (OSError, sqlite3.Error)
+        # Readers, such as the query command, don't block writes
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        logger.info(f'Storing received events in {self.path}')
+
+    def _write(self, rows: List[Row]):
+        with self.db:
+            self.db.executemany(INSERT, [
+                (received, path, event.event_id, event.event_type, event.event_timestamp, event.bucket_name,
+                 event.matched_rule_name, event.object_name, event.object_size, event.object_version_id,
+                 dumps(event.raw).decode('utf-8'))
+                for received, path, event in rows
+            ])
+
+    def _close(self):
+        self.db.close()
+        logger.info(f'Stored {self.events} events in {self.path}')
+
+
+def query(path: str, object_prefix: str | None = None, event_type: str | None = None,
+          since: datetime.datetime | None = None, until: datetime.datetime | None = None,
+          limit: int | None = None) -> Iterator[Event]:
+    """
+    Read events from a database written by SqliteSink, in event timestamp order
+    :param object_prefix: only events whose object name starts with this
+    :param event_type: only events whose type matches this pattern, for example, "b2:ObjectCreated:*"
+    :param since: only events at or after this time
+    :param until: only events before this time
+    :param limit: at most this many events
+    :raise sqlite3.Error: if the database cannot be read
+    """
+    conditions = []
+    parameters = []
+    if object_prefix:
+        # A range, rather than LIKE, so that the object name index is used
+        conditions.append('object_name >= ? AND object_name < ?')
+        parameters += [object_prefix, object_prefix + MAX_CHARACTER]
+    if event_type:
+        conditions.append('event_type GLOB ?')
+        parameters.append(event_type)
+    if since:
+        conditions.append('event_timestamp >= ?')
+        parameters.append(int(since.timestamp() * 1000))
+    if until:
+        conditions.append('event_timestamp < ?')
+        parameters.append(int(until.timestamp() * 1000))
+    sql = 'SELECT event FROM events'
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY event_timestamp, id'
+    if limit is not None:
+        sql += ' LIMIT ?'
+        parameters.append(limit)
+
+    import sqlite3
+    db = sqlite3.connect(f'{Path(path).absolute().as_uri()}?mode=ro', uri=True)
+    try:
+        for (event,) in db.execute(sql, parameters):
+            yield Event(loads(event))
+    finally:
+        db.close()
+
+
+def format_event(event: Event) -> str:
+    timestamp = datetime.datetime.fromtimestamp(event.event_timestamp / 1000, datetime.timezone.utc) \
+        .isoformat(timespec='milliseconds') if event.event_timestamp is not None else '-'
+    size = event.object_size if event.object_size is not None else '-'
+    return f'{timestamp}  {event.event_type:<32} {size:>12}  {event.object_name}'
@@ -0,0 +1,372 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from http import HTTPStatus
+from pathlib import Path
+from threading import Condition, Event, Lock, Thread
+from typing import List, NamedTuple, Tuple
+
+logging.basicConfig()
+logger = logging.getLogger('b2listen.spool')
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+DEFAULT_FSYNC_INTERVAL = 0.2
+DEFAULT_FSYNC_BATCH = 100
+# The active segment's file is extended this many bytes at a time
+SEGMENT_GROWTH = 1024 * 1024
+DEFAULT_FORWARD_TIMEOUT = 30
+INITIAL_BACKOFF = 0.5
+MAX_BACKOFF = 30
+# How often to check whether the spool has been forwarded, when draining it on shutdown
+DRAIN_POLL_INTERVAL = 0.1
+
+SEGMENT_SUFFIX = '.seg'
+CURSOR_FILE = 'cursor.json'
+
+# Each record is a header - CRC32 of metadata and body, metadata length, body length - followed by the metadata, a JSON
+# object containing the request path and headers, then the raw request body
+RECORD_HEADER = struct.Struct('<III')
+
+# Headers that describe the connection to b2listen, rather than the event notification message, so are not forwarded
+HOP_BY_HOP_HEADERS = {
+    'connection', 'content-length', 'host', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te',
+    'trailer', 'transfer-encoding', 'upgrade'
+}
+
+
+class SpoolRecord(NamedTuple):
+    path: str
+    headers: List[Tuple[str, str]]
+    body: bytes
+    segment: int
+    next_offset: int
+
+
+def parse_record(buffer, offset: int, end: int) -> Tuple[str, List[Tuple[str, str]], bytes, int] | None:
+    """
+    Parse the record at offset in buffer.
+    :return: (path, headers, body, offset of next record), or None if there is no complete, valid record at offset
+    """
+    if offset + RECORD_HEADER.size > end:
+        return None
+    crc, meta_length, body_length = RECORD_HEADER.unpack_from(buffer, offset)
+    if not meta_length:
+        # Every record has metadata, so this is the unused, zero-filled, end of a segment
+        return None
+    meta_start = offset + RECORD_HEADER.size
+    body_start = meta_start + meta_length
+    next_offset = body_start + body_length
+    if next_offset > end:
+        return None
+    meta = bytes(buffer[meta_start:body_start])
+    body = bytes(buffer[body_start:next_offset])
+    if zlib.crc32(body, zlib.crc32(meta)) != crc:
+        return None
+    meta = json.loads(meta)
+    return meta['path'], [(name, value) for name, value in meta['headers']], body, next_offset
+
+
+class Spool:
+    """
+    Append-only, segmented on-disk log of event notification messages.
+
+    Writers append records to the active segment, which is flushed to the operating system on every append and
+    fsync'ed after every fsync_batch records or fsync_interval seconds, whichever comes first. When the active segment
+    reaches segment_size bytes, the spool starts a new segment.
+
+    A single reader consumes records in order via memory-mapped segments, committing its position to a cursor file so
+    that it resumes where it left off after a restart. Fully consumed segments are deleted.
+    """
+
+    def __init__(self, directory: str, segment_size: int = DEFAULT_SEGMENT_SIZE,
+                 fsync_interval: float = DEFAULT_FSYNC_INTERVAL, fsync_batch: int = DEFAULT_FSYNC_BATCH):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        self.fsync_batch = fsync_batch
+        self.condition = Condition()
+        self.unsynced = 0
+        self.closed = False
+
+        segments = self._segments()
+        self.segment = segments[-1] if segments else 0
+        self.end = self._recover(self.segment)
+        self.file = self._open_segment(self.segment)
+        self.allocated = self.end
+
+        self.cursor_segment, self.cursor_offset = self._load_cursor(segments)
+        self._map: mmap.mmap | None = None
+        self._map_segment: int | None = None
+        # Held by the reader while it uses the memory map, so that close() does not unmap it from under the reader
+        self.read_lock = Lock()
+
+        logger.info(f'Opened spool at {self.directory}: segment {self.segment}, '
+                    f'cursor at {self.cursor_segment}:{self.cursor_offset}')
+
+        self.flusher = Thread(target=self._flush_periodically, daemon=True, name='b2listen-spool-fsync')
+        self.flusher.start()
+
+    def _segment_path(self, segment: int) -> Path:
+        return self.directory / f'{segment:020d}{SEGMENT_SUFFIX}'
+
+    def _open_segment(self, segment: int):
+        path = self._segment_path(segment)
+        path.touch()
+        return open(path, 'r+b')
+
+    def _segments(self) -> List[int]:
+        return sorted(int(path.stem) for path in self.directory.glob(f'*{SEGMENT_SUFFIX}'))
+
+    def _recover(self, segment: int) -> int:
+        """
+        Find the end of the last valid record in a segment, truncating any partially written record that follows it
+        """
+        path = self._segment_path(segment)
+        if not path.exists() or path.stat().st_size == 0:
+            return 0
+        with open(path, 'r+b') as f:
+            size = os.fstat(f.fileno()).st_size
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as buffer:
+                offset = 0
+                while (parsed := parse_record(buffer, offset, size)) is not None:
+                    offset = parsed[3]
+                # After a crash, the unused part of the segment's last extension is zero-filled
+                incomplete = buffer[offset:size].rstrip(b'\0')
+            if offset < size:
+                if incomplete:
+                    logger.warning(f'Truncating {len(incomplete)} bytes of incomplete data from {path}')
+                f.truncate(offset)
+        return offset
+
+    def _load_cursor(self, segments: List[int]) -> Tuple[int, int]:
+        path = self.directory / CURSOR_FILE
+        if path.exists():
+            cursor = json.loads(path.read_text())
+            return cursor['segment'], cursor['offset']
+        return (segments[0] if segments else 0), 0
+
+    def _save_cursor(self):
+        path = self.directory / CURSOR_FILE
+        tmp_path = path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps({'segment': self.cursor_segment, 'offset': self.cursor_offset}))
+        os.replace(tmp_path, path)
+
+    def _fsync(self):
+        if self.unsynced > 0:
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+
+    def _flush_periodically(self):
+        while True:
+            with self.condition:
+                if self.closed:
+                    return
+                self.condition.wait(self.fsync_interval)
+                if self.closed:
+                    return
+                self._fsync()
+
+    def _roll(self):
+        # The reader finds the end of a completed segment from its size
+        self.file.truncate(self.end)
+        self._fsync()
+        self.file.close()
+        self.segment += 1
+        self.end = 0
+        self.allocated = 0
+        self.file = self._open_segment(self.segment)
+        logger.debug(f'Started spool segment {self.segment}')
+
+    def append(self, path: str, headers: List[Tuple[str, str]], body: bytes):
+        """
+        Append an event notification message to the spool
+        """
+        meta = bytes(json.dumps({'path': path, 'headers': headers}), 'utf-8')
+        record = RECORD_HEADER.pack(zlib.crc32(body, zlib.crc32(meta)), len(meta), len(body)) + meta + body
+        with self.condition:
+            if self.closed:
+                raise ValueError('Spool is closed')
+            if self.end + len(record) > self.allocated:
+                self.allocated = self.end + len(record) + SEGMENT_GROWTH
+                self.file.truncate(self.allocated)
+            os.pwrite(self.file.fileno(), record, self.end)
+            self.end += len(record)
+            self.unsynced += 1
+            if self.unsynced >= self.fsync_batch:
+                self._fsync()
+            if self.end >= self.segment_size:
+                self._roll()
+            self.condition.notify_all()
+
+    def deliver(self, path: str, headers: List[Tuple[str, str]], body: bytes):
+        """
+        Delivery target interface for the embedded webserver
+        """
+        self.append(path, [(name, value) for name, value in headers if name.lower() not in HOP_BY_HOP_HEADERS], body)
+
+    def _mapped(self, segment: int, length: int) -> mmap.mmap:
+        """
+        Map at least length bytes of a segment. The whole file is mapped, so, since the active segment is extended
+        SEGMENT_GROWTH bytes at a time, it is only mapped again once records have been appended past the extension.
+        """
+        if self._map is None or self._map_segment != segment or len(self._map) < length:
+            self._unmap()
+            with open(self._segment_path(segment), 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._map_segment = segment
+        return self._map
+
+    def _unmap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self._map_segment = None
+
+    def next_record(self, timeout: float | None = None) -> SpoolRecord | None:
+        """
+        Read the record at the cursor, waiting up to timeout seconds for one to be appended. The cursor does not move
+        until the record is committed.
+        """
+        while True:
+            with self.condition:
+                while self.cursor_segment == self.segment and self.cursor_offset >= self.end:
+                    if self.closed or not self.condition.wait(timeout):
+                        return None
+                end = self.end if self.cursor_segment == self.segment else None
+
+            if end is None:
+                # The cursor is in a completed segment
+                end = self._segment_path(self.cursor_segment).stat().st_size
+                if self.cursor_offset >= end:
+                    self._advance_segment()
+                    continue
+
+            with self.read_lock:
+                if self.closed:
+                    return None
+                parsed = parse_record(self._mapped(self.cursor_segment, end), self.cursor_offset, end)
+            if parsed is None:
+                raise ValueError(f'Corrupt spool record at {self.cursor_segment}:{self.cursor_offset}')
+            path, headers, body, next_offset = parsed
+            return SpoolRecord(path, headers, body, self.cursor_segment, next_offset)
+
+    def _advance_segment(self):
+        self._unmap()
+        consumed = self._segment_path(self.cursor_segment)
+        self.cursor_segment += 1
+        self.cursor_offset = 0
+        self._save_cursor()
+        consumed.unlink(missing_ok=True)
+        logger.debug(f'Removed consumed spool segment {consumed}')
+
+    def commit(self, record: SpoolRecord):
+        """
+        Move the cursor past a record that has been successfully forwarded
+        """
+        self.cursor_segment = record.segment
+        self.cursor_offset = record.next_offset
+        self._save_cursor()
+
+    def empty(self) -> bool:
+        """
+        :return: True if every record has been committed
+        """
+        with self.condition:
+            return self.cursor_segment == self.segment and self.cursor_offset >= self.end
+
+    def close(self):
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.file.truncate(self.end)
+            self._fsync()
+            self.file.close()
+            self.condition.notify_all()
+        with self.read_lock:
+            self._unmap()
+
+
+class SpoolForwarder(Thread):
+    """
+    Drain a spool to the local service, one record at a time, in order. Failed deliveries are retried with exponential
+    backoff, honoring any Retry-After header, so the spool absorbs outages and slowdowns of the local service.
+    """
+
+    def __init__(self, spool: Spool, url: str, timeout: float = DEFAULT_FORWARD_TIMEOUT):
+        super().__init__(daemon=True, name='b2listen-spool-forwarder')
+        self.spool = spool
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        import requests
+        self.session = requests.Session()
+        self.stop_event = Event()
+
+    def forward(self, record: SpoolRecord) -> float | None:
+        """
+        POST a spooled message to the local service.
+        :return: None if the record is done with, otherwise the number of seconds to wait before retrying it
+        """
+        import requests
+        try:
+            res = self.session.post(f'{self.url}{record.path}', data=record.body, headers=dict(record.headers),
+                                    timeout=self.timeout)
+        except requests.RequestException as e:
+            logger.warning(f'Error forwarding event notification to {self.url}: {e}')
+            return 0
+
+        logger.debug(f'Received {res.status_code} for {self.url}{record.path}')
+        if res.ok:
+            return None
+        if res.status_code == HTTPStatus.TOO_MANY_REQUESTS or res.status_code >= HTTPStatus.INTERNAL_SERVER_ERROR \
+                or res.status_code == HTTPStatus.REQUEST_TIMEOUT:
+            retry_after = res.headers.get('Retry-After', '')
+            return float(retry_after) if retry_after.isdigit() else 0
+        # Any other client error will recur, so drop the record rather than block the spool
+        logger.error(f'Dropping event notification rejected by {self.url} with status {res.status_code}')
+        return None
+
+    def run(self):
+        logger.info(f'Forwarding spooled event notifications to {self.url}')
+        backoff = INITIAL_BACKOFF
+        record = None
+        while not self.stop_event.is_set():
+            try:
+                if record is None:
+                    record = self.spool.next_record(timeout=1)
+                    if record is None:
+                        continue
+                delay = self.forward(record)
+                if delay is None:
+                    self.spool.commit(record)
+                    record = None
+                    backoff = INITIAL_BACKOFF
+                    continue
+            except ValueError as e:
+                # A corrupt record fails in the same way however often it is read, so forwarding can go no further
+                logger.critical(f'Stopped forwarding spooled event notifications from {self.spool.directory}: {e}')
+                return
+            except OSError as e:
+                logger.error(f'Error reading spool {self.spool.directory}: {e}')
+                delay = 0
+            self.stop_event.wait(max(delay, backoff))
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+    def drain(self, timeout: float) -> bool:
+        """
+        Wait up to timeout seconds for the spool to be forwarded, then stop
+        :return: True if every spooled message was forwarded
+        """
+        deadline = time.monotonic() + timeout
+        while not (empty := self.spool.empty()) and self.is_alive() and time.monotonic() < deadline:
+            time.sleep(DRAIN_POLL_INTERVAL)
+        self.stop()
+        return empty
+
+    def stop(self):
+        self.stop_event.set()
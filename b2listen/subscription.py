@@ -1,24 +1,56 @@
-import hashlib
-import hmac
 import json
 import logging
+import random
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
 from threading import Thread, Event
+from typing import Iterable, Iterator, Tuple
 
 import requests
 
-EVENT_NOTIFICATION_SIGNATURE_HEADER = 'x-bz-event-notification-signature'
+from b2listen import metrics
+from b2listen.signature import EVENT_NOTIFICATION_SIGNATURE_HEADER, create_message_signature
+
+REQUEST_TIMEOUT_SECONDS = 10
+# Poll intervals vary randomly by up to this fraction, so that many instances don't poll the broker in lockstep
+POLL_JITTER = 0.1
+# On repeated failures, back off exponentially up to this multiple of the poll interval
+MAX_BACKOFF_MULTIPLIER = 8
+# The broker sends a heartbeat on the push channel more often than this
+PUSH_READ_TIMEOUT_SECONDS = 60
+PUSH_EVENT_REMOVED = 'removed'
 
 logging.basicConfig()
 logger = logging.getLogger('subscription')
 
 
+def server_sent_events(lines: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    """
+    Parse a text/event-stream into (event type, data) tuples, skipping comments such as heartbeats
+    """
+    event_type, data = '', []
+    for line in lines:
+        if not line:
+            if event_type or data:
+                yield event_type or 'message', '\n'.join(data)
+            event_type, data = '', []
+        elif not line.startswith(':'):
+            field, _, value = line.partition(':')
+            value = value[1:] if value.startswith(' ') else value
+            if field == 'event':
+                event_type = value
+            elif field == 'data':
+                data.append(value)
+
+
 class Subscription(Thread):
     """
     Manage a subscription to the event broker
     """
 
     def __init__(self, event_broker_url: str, tunnel_url: str, bucket_name: str, rule_name: str | None,
-                 signing_secret: str, interval_seconds: float):
+                 signing_secret: str, interval_seconds: float, push: bool = False):
         super().__init__()
         self.event_broker_url = event_broker_url
         self.tunnel_url = tunnel_url
@@ -26,9 +58,16 @@ class Subscription(Thread):
         self.rule_name = rule_name
         self.signing_secret = signing_secret
         self.interval_seconds = interval_seconds
+        self.push = push
+        self.stream: requests.Response | None = None
         self.stop_event = Event()
         self.id_ = None
+        self.failures = 0
+        # Reuse connections to the broker and tunnel across polls
+        self.session = requests.Session()
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='subscription')
         logger.info(f'Creating subscription object for {self.bucket_name}/{self.rule_name} with '
+                    f'{"push notifications, falling back to " if self.push else ""}'
                     f'{self.interval_seconds} polling interval')
         self.subscribe()
         self.start()
@@ -37,11 +76,7 @@ class Subscription(Thread):
         """
         Create the signature for the event notification message.
         """
-        return 'v1=' + hmac.new(
-            bytes(self.signing_secret, 'utf-8'),
-            msg=body,
-            digestmod=hashlib.sha256
-        ).hexdigest().lower()
+        return create_message_signature(self.signing_secret, body)
 
     def subscribe(self):
         """
@@ -52,14 +87,16 @@ class Subscription(Thread):
 
         signature = self.create_message_signature(body)
 
-        res = requests.post(
+        res = self.session.post(
             f'{self.event_broker_url}/@subscriptions/{self.bucket_name}/{self.rule_name}',
             data=body,
-            headers={EVENT_NOTIFICATION_SIGNATURE_HEADER: signature}
+            headers={EVENT_NOTIFICATION_SIGNATURE_HEADER: signature},
+            timeout=REQUEST_TIMEOUT_SECONDS
         )
         res.raise_for_status()
         res = res.json()
         self.id_ = res['id']
+        metrics.subscription_active.set(1)
         logger.info(f'Subscribed to {self.bucket_name}/{self.rule_name}/{self.id_}')
 
     def subscription(self):
@@ -69,9 +106,10 @@ class Subscription(Thread):
         """
         signature = self.create_message_signature(bytes())
 
-        res = requests.head(
+        res = self.session.head(
             f'{self.event_broker_url}/@subscriptions/{self.bucket_name}/{self.rule_name}/{self.id_}',
-            headers={EVENT_NOTIFICATION_SIGNATURE_HEADER: signature}
+            headers={EVENT_NOTIFICATION_SIGNATURE_HEADER: signature},
+            timeout=REQUEST_TIMEOUT_SECONDS
         )
         logger.debug(f'Received {res.status_code} for {self.bucket_name}/{self.rule_name}/{self.id_}')
         return res.ok
@@ -82,13 +120,15 @@ class Subscription(Thread):
         """
         signature = self.create_message_signature(bytes())
 
-        res = requests.delete(
+        res = self.session.delete(
             f'{self.event_broker_url}/@subscriptions/{self.bucket_name}/{self.rule_name}/{self.id_}',
-            headers={EVENT_NOTIFICATION_SIGNATURE_HEADER: signature}
+            headers={EVENT_NOTIFICATION_SIGNATURE_HEADER: signature},
+            timeout=REQUEST_TIMEOUT_SECONDS
         )
         res.raise_for_status()
         logger.info(f'Unsubscribed from {self.bucket_name}/{self.rule_name}/{self.id_}')
         self.id_ = None
+        metrics.subscription_active.set(0)
 
     def probe_tunnel_url(self):
         """
@@ -99,29 +139,152 @@ class Subscription(Thread):
 
         signature = self.create_message_signature(body)
 
-        res = requests.post(
+        res = self.session.post(
             f'{self.tunnel_url}',
             data=body,
-            headers={EVENT_NOTIFICATION_SIGNATURE_HEADER: signature}
+            headers={EVENT_NOTIFICATION_SIGNATURE_HEADER: signature},
+            timeout=REQUEST_TIMEOUT_SECONDS
         )
         logger.debug(f'Received {res.status_code} for {self.tunnel_url}')
         return res.ok
 
+    def backoff_seconds(self) -> float:
+        """
+        The poll interval, backed off exponentially after consecutive failures
+        """
+        return self.interval_seconds * min(2 ** self.failures, MAX_BACKOFF_MULTIPLIER)
+
+    def next_wait(self) -> float:
+        """
+        Time to wait before the next poll, with jitter
+        """
+        return self.backoff_seconds() * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+
+    def check(self) -> bool:
+        """
+        Check the subscription and probe the tunnel URL concurrently, resubscribing if the subscription is no longer
+        active, but the client is.
+        :return: True if the subscription is active, or was successfully renewed
+        """
+        subscription = self.executor.submit(self.subscription)
+        probe = self.executor.submit(self.probe_tunnel_url)
+        if subscription.result():
+            return True
+        if probe.result():
+            logger.info('Subscription is no longer active, but client is awake. Resubscribing.')
+            metrics.resubscriptions.inc()
+            self.subscribe()
+            return True
+        return False
+
+    def poll(self) -> bool:
+        """
+        Check the subscription once, tracking consecutive failures
+        :return: True if the subscription is active
+        """
+        try:
+            ok = self.check()
+            message = 'Subscription is no longer active, and client is not responding.'
+        except requests.RequestException as e:
+            ok = False
+            message = f'Error checking subscription: {e}.'
+        if ok:
+            self.failures = 0
+        else:
+            self.failures += 1
+            metrics.subscription_active.set(0)
+            metrics.subscription_check_failures.inc()
+            logger.warning(f'{message} Will try again in about {self.backoff_seconds():.0f} seconds')
+        return ok
+
+    def open_push_channel(self) -> requests.Response:
+        return self.session.get(
+            f'{self.event_broker_url}/@subscriptions/{self.bucket_name}/{self.rule_name}/{self.id_}/events',
+            headers={EVENT_NOTIFICATION_SIGNATURE_HEADER: self.create_message_signature(bytes()),
+                     'Accept': 'text/event-stream'},
+            stream=True,
+            timeout=(REQUEST_TIMEOUT_SECONDS, PUSH_READ_TIMEOUT_SECONDS)
+        )
+
+    def follow(self, stream: requests.Response) -> bool:
+        """
+        Read the push channel until the broker removes the subscription or the channel is closed
+        :return: False if the broker does not support push notifications
+        """
+        if stream.ok and stream.headers.get('Content-Type', '').startswith('text/event-stream'):
+            logger.debug(f'Connected to push channel for {self.bucket_name}/{self.rule_name}/{self.id_}')
+            for event_type, _data in server_sent_events(stream.iter_lines(decode_unicode=True)):
+                if event_type == PUSH_EVENT_REMOVED:
+                    if not self.stop_event.is_set():
+                        logger.info('Broker removed subscription')
+                    break
+        elif stream.status_code >= HTTPStatus.INTERNAL_SERVER_ERROR:
+            logger.debug(f'Received {stream.status_code} for push channel')
+            self.stop_event.wait(self.next_wait())
+        elif self.subscription():
+            # The subscription exists, so the broker doesn't know about push channels
+            logger.info(f'Event broker does not support push notifications; polling every '
+                        f'{self.interval_seconds} seconds')
+            return False
+        return True
+
+    def watch(self) -> bool:
+        """
+        Follow the broker's push channel, a stream of server-sent events for the subscription, so that we can
+        resubscribe as soon as the broker removes the subscription, rather than at the next poll.
+        :return: False if the broker does not support push notifications; True once the subscription is stopped
+        """
+        while not self.stop_event.is_set():
+            try:
+                self.stream = self.open_push_channel()
+            except requests.RequestException as e:
+                logger.debug(f'Error connecting to push channel: {e}')
+                self.recover()
+                continue
+
+            try:
+                if not self.follow(self.stream):
+                    return False
+            except requests.RequestException as e:
+                logger.debug(f'Lost connection to push channel: {e}')
+            finally:
+                self.stream.close()
+
+            # The subscription was removed, or we lost the push channel and might have missed its removal
+            self.recover()
+        return True
+
+    def recover(self):
+        """
+        Check the subscription, resubscribing if necessary, until it is active or we are stopped
+        """
+        while not self.stop_event.is_set() and not self.poll():
+            self.stop_event.wait(self.next_wait())
+
     def run(self):
         """
         Periodically check that the subscription is still active. If the subscription is no longer active, but we can
-        ping the client, resubscribe; otherwise, try again later.
+        ping the client, resubscribe; otherwise, back off and try again later. If push is set, and the broker supports
+        it, wait for the broker to tell us that the subscription was removed rather than polling.
         """
-        while not self.stop_event.wait(self.interval_seconds):
-            if not self.subscription():
-                if self.probe_tunnel_url():
-                    logger.info('Subscription is no longer active, but client is awake. Resubscribing.')
-                    self.subscribe()
-                else:
-                    logger.warning('Subscription is no longer active, and client is not responding. '
-                                   f'Will try again in {self.interval_seconds} seconds')
+        if self.push and self.watch():
+            return
+        while not self.stop_event.wait(self.next_wait()):
+            self.poll()
 
     def stop(self):
         self.stop_event.set()
+        if self.stream:
+            # Unblock the push channel by shutting down its socket. Closing the response would wait for the read in
+            # progress on the subscription thread.
+            connection = getattr(self.stream.raw, 'connection', None)
+            sock = getattr(connection, 'sock', None)
+            if sock:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
         self.unsubscribe()
+        self.executor.shutdown(wait=False)
+        self.session.close()
         logger.info(f'Stopped subscription for {self.bucket_name}/{self.rule_name}')
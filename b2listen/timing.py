@@ -0,0 +1,83 @@
+import datetime
+import functools
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict
+
+
+class PhaseTimer:
+    """
+    Record the timing of named phases, and instants ("marks"), relative to the start of the run, for a
+    machine-readable report. Phases may overlap, for example, when they run on different threads.
+    """
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.started_at = datetime.datetime.now(datetime.timezone.utc)
+        self.lock = threading.Lock()
+        self.phases = []
+        self.marks = {}
+        self.info: Dict[str, Any] = {}
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.origin
+
+    @contextmanager
+    def phase(self, name: str):
+        start = self.elapsed()
+        try:
+            yield
+        finally:
+            end = self.elapsed()
+            with self.lock:
+                self.phases.append({
+                    'name': name,
+                    'start': round(start, 6),
+                    'duration': round(end - start, 6),
+                    'thread': threading.current_thread().name,
+                })
+
+    def timed(self, func):
+        """
+        Decorator to record each call of a function as a phase with the function's name
+        """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.phase(func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def mark(self, name: str):
+        """
+        Record the first time that something happened
+        """
+        with self.lock:
+            self.marks.setdefault(name, round(self.elapsed(), 6))
+
+    def report(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'started_at': self.started_at.isoformat(),
+                'total': round(self.elapsed(), 6),
+                **self.info,
+                'marks': dict(self.marks),
+                'phases': sorted(self.phases, key=lambda phase: phase['start']),
+            }
+
+    def write(self, path: str):
+        """
+        Write the report as JSON to path, or to stdout if path is '-'
+        """
+        report = json.dumps(self.report(), indent=2)
+        if path == '-':
+            print(report, file=sys.stdout)
+        else:
+            with open(path, 'w') as f:
+                f.write(report + '\n')
+
+
+# Timer for this run of b2listen
+timer = PhaseTimer()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Measure how long b2listen takes to import, and check that it does not import heavy third-party libraries that only
+some commands need.
+
+Usage::
+    python benchmarks/import_time.py [--runs N] [--budget-ms MS] [--top N]
+
+Runs `python -X importtime -c "import b2listen.b2listen"` in a fresh interpreter --runs times, reporting the median
+cumulative import time of b2listen.b2listen and its slowest imports. Also times `python -m b2listen version` end to
+end. Exits with status 1 if any of LAZY_MODULES is imported at startup, or if the median import time exceeds
+--budget-ms.
+"""
+import argparse
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+MODULE = 'b2listen.b2listen'
+
+# Libraries, and slow standard library modules, that must only be imported by the commands that use them
+LAZY_MODULES = ['b2sdk', 'requests', 'urllib3', 'psutil', 'dotenv',
+                'http.server', 'http.client', 'ssl', 'gzip', 'sqlite3']
+
+IMPORTTIME_REGEX = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def import_times():
+    """
+    :return: list of (module, self microseconds, cumulative microseconds, depth) for a fresh import of MODULE
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {MODULE}'],
+                            capture_output=True, text=True, check=True)
+    times = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_REGEX.match(line)
+        if match:
+            times.append((match.group(4), int(match.group(1)), int(match.group(2)), len(match.group(3))))
+    return times
+
+
+def time_command(args):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-m', 'b2listen', *args], capture_output=True, check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure b2listen import time')
+    parser.add_argument('--runs', type=int, default=5, help='Number of runs (default: 5)')
+    parser.add_argument('--budget-ms', type=float, default=None,
+                        help='Fail if the median import time exceeds this many milliseconds')
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest imports to show (default: 10)')
+    args = parser.parse_args()
+
+    totals = []
+    runs = []
+    for _ in range(args.runs):
+        times = import_times()
+        runs.append(times)
+        totals.append(next(cumulative for module, _, cumulative, _ in times if module == MODULE))
+    median_ms = statistics.median(totals) / 1000
+
+    # Slowest imports by self time in the median run
+    times = runs[totals.index(sorted(totals)[len(totals) // 2])]
+    print(f'{MODULE} import time: median {median_ms:.1f} ms over {args.runs} runs '
+          f'(min {min(totals) / 1000:.1f} ms, max {max(totals) / 1000:.1f} ms)')
+    print(f'\nSlowest {args.top} imports (self time):')
+    for module, self_us, cumulative_us, _ in sorted(times, key=lambda t: t[1], reverse=True)[:args.top]:
+        print(f'  {self_us / 1000:8.1f} ms  {cumulative_us / 1000:8.1f} ms cumulative  {module}')
+
+    version_times = [time_command(['version']) for _ in range(args.runs)]
+    print(f'\n"b2listen version" wall time: median {statistics.median(version_times) * 1000:.1f} ms')
+
+    failed = False
+    imported = {module for module, _, _, _ in times}
+    eager = [lazy for lazy in LAZY_MODULES if lazy in imported]
+    if eager:
+        print(f'\nFAIL: {", ".join(eager)} imported at startup; import them where they are used')
+        failed = True
+    if args.budget_ms is not None and median_ms > args.budget_ms:
+        print(f'\nFAIL: median import time {median_ms:.1f} ms exceeds budget of {args.budget_ms:.1f} ms')
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
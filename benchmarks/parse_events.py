@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Measure how long b2listen takes to parse event notification messages.
+
+Usage::
+    python benchmarks/parse_events.py [--runs N] [--sizes N [N ...]]
+
+For realistic messages of each of --sizes events (default: 1, 100 and 1000), reports the median time per message,
+over --runs runs, to:
+
+* parse the message with the standard library's json module, and with b2listen.events, which uses orjson if it is
+  installed
+* read the event IDs, as the dedup index does, without parsing the message, and by parsing it
+* read the event IDs, object names and event types of the events, as the event router does
+* encode the events as a new message, as the dedup index, router and forwarder do when they modify a message
+"""
+import argparse
+import json
+import statistics
+import time
+
+from b2listen import events
+from b2listen.loadgen import make_payload
+
+DEFAULT_SIZES = [1, 100, 1000]
+# Each run parses about this many events, so that small messages are timed over many iterations
+EVENTS_PER_RUN = 20_000
+
+
+def stdlib_parse(body: bytes):
+    return json.loads(body)['events']
+
+
+def stdlib_event_ids(body: bytes):
+    return [event['eventId'] for event in json.loads(body)['events']]
+
+
+def stdlib_route_fields(body: bytes):
+    return [(event['eventId'], event['objectName'], event['eventType']) for event in json.loads(body)['events']]
+
+
+def stdlib_encode(body: bytes):
+    return bytes(json.dumps({'events': json.loads(body)['events']}), 'utf-8')
+
+
+def events_parse(body: bytes):
+    return events.EventMessage(body).events
+
+
+def events_event_ids(body: bytes):
+    return events.EventMessage(body).event_ids()
+
+
+def events_parsed_event_ids(body: bytes):
+    return [event.event_id for event in events.EventMessage(body).events]
+
+
+def events_route_fields(body: bytes):
+    return [(event.event_id, event.object_name, event.event_type) for event in events.EventMessage(body).events]
+
+
+def events_encode(body: bytes):
+    message = events.EventMessage(body)
+    return message.with_events(message.events)
+
+
+BENCHMARKS = [
+    ('parse', 'json', stdlib_parse),
+    ('parse', events.JSON_BACKEND, events_parse),
+    ('event IDs', 'json', stdlib_event_ids),
+    ('event IDs', events.JSON_BACKEND, events_parsed_event_ids),
+    ('event IDs', 'scan', events_event_ids),
+    ('route fields', 'json', stdlib_route_fields),
+    ('route fields', events.JSON_BACKEND, events_route_fields),
+    ('encode', 'json', stdlib_encode),
+    ('encode', events.JSON_BACKEND, events_encode),
+]
+
+
+def time_per_message(function, body: bytes, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function(body)
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure event notification message parsing time')
+    parser.add_argument('--runs', type=int, default=5, help='Number of runs (default: 5)')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help=f'Numbers of events per message (default: {" ".join(map(str, DEFAULT_SIZES))})')
+    args = parser.parse_args()
+
+    print(f'JSON backend: {events.JSON_BACKEND}')
+    for size in args.sizes:
+        body = make_payload(size)
+        iterations = max(1, EVENTS_PER_RUN // size)
+        print(f'\n{size} events per message ({len(body)} bytes), median of {args.runs} runs of {iterations} messages:')
+        baselines = {}
+        for operation, method, function in BENCHMARKS:
+            median = statistics.median(time_per_message(function, body, iterations) for _ in range(args.runs))
+            baseline = baselines.setdefault(operation, median)
+            print(f'  {operation:<14} {method:<8} {median * 1_000_000:10.1f} µs  {baseline / median:5.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import pytest
+
+from b2listen.dedup import DedupIndex, EventsInFlight
+from b2listen.events import EventMessage, encode_events
+from b2listen.loadgen import make_payload
+
+
+def test_new_message_passes_through_unparsed():
+    dedup = DedupIndex()
+    body = make_payload(3)
+    filtered, new_ids = dedup.filter(body)
+    assert filtered is body
+    assert new_ids == EventMessage(body).event_ids()
+
+
+def test_delivered_events_are_dropped():
+    dedup = DedupIndex()
+    body = make_payload(2)
+    dedup.commit(dedup.filter(body)[1])
+    assert dedup.filter(body) == (None, [])
+
+
+def test_only_duplicate_events_are_removed():
+    dedup = DedupIndex()
+    old = make_payload(2)
+    dedup.commit(dedup.filter(old)[1])
+    new = EventMessage(make_payload(1)).events
+    body = encode_events(EventMessage(old).events + new)
+
+    filtered, new_ids = dedup.filter(body)
+    assert new_ids == [new[0].event_id]
+    assert [event.event_id for event in EventMessage(filtered).events] == new_ids
+
+
+def test_events_in_flight_are_refused_until_released():
+    dedup = DedupIndex()
+    body = make_payload(2)
+    new_ids = dedup.filter(body)[1]
+    with pytest.raises(EventsInFlight):
+        dedup.filter(body)
+    # Delivery failed, so B2's retry is delivered rather than dropped
+    dedup.release(new_ids)
+    assert dedup.filter(body) == (body, new_ids)
+
+
+def test_capacity_evicts_least_recently_seen():
+    dedup = DedupIndex(capacity=2)
+    dedup.commit(['a', 'b', 'c'])
+    assert dedup.claim(['a', 'b', 'c']) == [False, True, True]
+    assert dedup.stats()['evictions'] == 1
+
+
+def test_bloom_filter_does_not_change_results():
+    dedup = DedupIndex(capacity=10, bloom=True)
+    dedup.commit([str(i) for i in range(10)])
+    assert dedup.claim([str(i) for i in range(5, 15)]) == [True] * 5 + [False] * 5
+
+
+def test_messages_without_events_pass_through():
+    dedup = DedupIndex()
+    body = b'{"probe": true}'
+    assert dedup.filter(body) == (body, [])
@@ -0,0 +1,156 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Tuple
+
+import pytest
+
+from b2listen.events import EventMessage
+from b2listen.forwarder import Forwarder, ForwardingError
+from b2listen.loadgen import make_payload
+from b2listen.signature import EVENT_NOTIFICATION_SIGNATURE_HEADER, create_message_signature, \
+    verify_message_signature
+
+SECRET = 'abcdefghijklmnopqrstuvwxyz012345'
+OTHER_SECRET = '543210zyxwvutsrqponmlkjihgfedcba'
+
+
+class LocalService(ThreadingHTTPServer):
+    """
+    Stand-in for the local service, recording the requests it receives
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('localhost', 0), LocalServiceHandler)
+        self.requests: List[Tuple[str, dict, bytes]] = []
+        self.status = 200
+
+    @property
+    def url(self) -> str:
+        return f'http://localhost:{self.server_address[1]}'
+
+
+class LocalServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):  # noqa
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((self.path, {name.lower(): value for name, value in self.headers.items()}, body))
+        self.send_response(self.server.status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):  # noqa
+        pass
+
+
+@pytest.fixture
+def service():
+    service = LocalService()
+    thread = threading.Thread(target=service.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    yield service
+    service.shutdown()
+    service.server_close()
+
+
+@pytest.fixture
+def make_forwarder(service):
+    forwarders = []
+
+    def make(**kwargs) -> Forwarder:
+        forwarder = Forwarder(service.url, **kwargs)
+        forwarders.append(forwarder)
+        return forwarder
+
+    yield make
+    for forwarder in forwarders:
+        forwarder.close()
+
+
+def signed(body: bytes) -> List[Tuple[str, str]]:
+    return [(EVENT_NOTIFICATION_SIGNATURE_HEADER, create_message_signature(OTHER_SECRET, body)),
+            ('Content-Type', 'application/json'), ('Connection', 'keep-alive')]
+
+
+def deliver_concurrently(forwarder: Forwarder, bodies: List[bytes]) -> float:
+    """
+    :return: the time taken to deliver the messages, each from its own thread
+    """
+    threads = [threading.Thread(target=forwarder.deliver, args=('/events', signed(body), body)) for body in bodies]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.monotonic() - start
+
+
+def event_ids(body: bytes) -> List[str]:
+    return EventMessage(body).event_ids()
+
+
+def test_message_is_forwarded_unchanged(service, make_forwarder):
+    forwarder = make_forwarder(signing_secret=SECRET)
+    body = make_payload(2)
+    forwarder.deliver('/events', signed(body), body)
+    [(path, headers, forwarded)] = service.requests
+    assert (path, forwarded) == ('/events', body)
+    # Without coalescing, the original signature still matches
+    assert verify_message_signature(OTHER_SECRET, forwarded, headers[EVENT_NOTIFICATION_SIGNATURE_HEADER])
+    assert headers['content-type'] == 'application/json'
+
+
+def test_error_status_is_raised(service, make_forwarder):
+    forwarder = make_forwarder()
+    service.status = 500
+    with pytest.raises(ForwardingError):
+        forwarder.deliver('/events', [], make_payload(1))
+
+
+def test_full_batch_is_sent_at_once(service, make_forwarder):
+    forwarder = make_forwarder(max_batch_events=4, max_linger=10, signing_secret=SECRET)
+    bodies = [make_payload(2), make_payload(2)]
+    assert deliver_concurrently(forwarder, bodies) < 1
+    [(path, headers, body)] = service.requests
+    assert path == '/events'
+    assert sorted(event_ids(body)) == sorted(event_ids(bodies[0]) + event_ids(bodies[1]))
+    # The coalesced message is signed again with the forwarder's secret
+    assert verify_message_signature(SECRET, body, headers[EVENT_NOTIFICATION_SIGNATURE_HEADER])
+
+
+def test_coalesced_message_is_unsigned_without_secret(service, make_forwarder):
+    forwarder = make_forwarder(max_batch_events=2, max_linger=10)
+    deliver_concurrently(forwarder, [make_payload(1), make_payload(1)])
+    [(_, headers, _)] = service.requests
+    assert EVENT_NOTIFICATION_SIGNATURE_HEADER not in headers
+
+
+def test_batch_that_would_overflow_is_sent_first(service, make_forwarder):
+    forwarder = make_forwarder(max_batch_events=3, max_linger=0.2)
+    deliver_concurrently(forwarder, [make_payload(2), make_payload(2)])
+    assert sorted(len(event_ids(body)) for _, _, body in service.requests) == [2, 2]
+
+
+def test_partial_batch_is_sent_after_linger(service, make_forwarder):
+    forwarder = make_forwarder(max_batch_events=100, max_linger=0.2)
+    elapsed = deliver_concurrently(forwarder, [make_payload(1)])
+    assert 0.2 <= elapsed < 2
+    assert len(service.requests) == 1
+
+
+def test_batch_is_sent_once_every_caller_is_waiting(service, make_forwarder):
+    forwarder = make_forwarder(max_batch_events=100, max_linger=10, max_callers=3)
+    bodies = [make_payload(1) for _ in range(3)]
+    # Without max_callers, the batch would wait out max_linger
+    assert deliver_concurrently(forwarder, bodies) < 1
+    [(_, _, body)] = service.requests
+    assert len(event_ids(body)) == 3
+
+
+def test_messages_without_events_are_not_coalesced(service, make_forwarder):
+    forwarder = make_forwarder(max_batch_events=100, max_linger=10)
+    probe = b'{"events":[]}'
+    forwarder.deliver('/events', [], probe)
+    assert [body for _, _, body in service.requests] == [probe]
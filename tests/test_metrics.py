@@ -0,0 +1,36 @@
+import threading
+
+from b2listen.metrics import Counter, Histogram
+
+THREADS = 2000
+
+
+def run_threads(target):
+    threads = [threading.Thread(target=target) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_cells_of_exited_threads_are_retired():
+    counter = Counter('requests_total', 'Requests')
+    run_threads(counter.inc)
+    assert counter.value() == THREADS
+    assert len(counter.cells.cells) <= 1
+
+    # A running thread's updates are counted along with the retired totals
+    counter.inc()
+    assert counter.value() == THREADS + 1
+    assert len(counter.cells.cells) == 1
+
+
+def test_histogram_totals_survive_thread_exit():
+    histogram = Histogram('seconds', 'Seconds', [1, 10])
+    run_threads(lambda: histogram.observe(5))
+    samples = {(suffix, labels.get('le')): value for suffix, labels, value in histogram.samples()}
+    assert samples[('_bucket', '1')] == 0
+    assert samples[('_bucket', '10')] == THREADS
+    assert samples[('_count', None)] == THREADS
+    assert samples[('_sum', None)] == 5 * THREADS
+    assert not histogram.cells.cells
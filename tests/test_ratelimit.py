@@ -0,0 +1,56 @@
+import pytest
+
+from b2listen import ratelimit
+from b2listen.ratelimit import PathLimit, RateLimiter, TokenBucket, parse_path_limit, parse_processing_latency
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Control the time seen by the token buckets
+    """
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_bucket_admits_burst_then_refills(clock):
+    bucket = TokenBucket(rate=2, burst=3)
+    assert [bucket.take() for _ in range(3)] == [0, 0, 0]
+    assert bucket.take() == pytest.approx(0.5)
+    clock[0] += 0.5
+    assert bucket.take() == 0
+
+
+def test_longest_path_limit_applies(clock):
+    limiter = RateLimiter(path_limits=[PathLimit('/a', 100, 100), PathLimit('/a/b', 1, 1)])
+    assert limiter.acquire('/a/b/c') == 0
+    assert limiter.acquire('/a/b/c') > 0
+    assert limiter.acquire('/a/c') == 0
+    assert limiter.acquire('/other') == 0
+
+
+def test_token_is_returned_when_another_bucket_rejects(clock):
+    limiter = RateLimiter(rate=1, burst=1, path_limits=[PathLimit('/a', 1, 1)])
+    assert limiter.acquire('/a') == 0
+    # The global bucket rejects this request, so the path bucket for /b must not be charged for it
+    assert limiter.acquire('/b') > 0
+    clock[0] += 1
+    assert limiter.acquire('/b') == 0
+
+
+def test_parse_path_limit():
+    assert parse_path_limit(['/a', '10']) == PathLimit('/a', 10, 10)
+    assert parse_path_limit(['/a', '0.5', '3']) == PathLimit('/a', 0.5, 3)
+    for values in (['/a'], ['/a', 'x'], ['/a', '0'], ['/a', '1', '0'], ['/a', '1', '2', '3']):
+        with pytest.raises(ValueError):
+            parse_path_limit(values)
+
+
+def test_parse_processing_latency():
+    latency = parse_processing_latency('uniform:0.1,0.2')
+    assert 0.1 <= latency.sample() <= 0.2
+    assert parse_processing_latency('constant:0.5').sample() == 0.5
+    for spec in ('gamma:1', 'normal:1', 'exponential:0', 'constant:-1', 'constant:x'):
+        with pytest.raises(ValueError):
+            parse_processing_latency(spec)
@@ -0,0 +1,168 @@
+import copy
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import List
+
+import pytest
+from b2sdk.v2.exception import NonExistentBucket
+
+from b2listen.b2listen import cleanup_buckets, cleanup_sessions
+from b2listen.registry import Session, read_entries
+
+BUCKET = 'my-bucket'
+OTHER_BUCKET = 'other-bucket'
+
+
+def rule(name: str, url: str) -> dict:
+    return {'name': name, 'eventTypes': ['b2:ObjectCreated:*'], 'isEnabled': True, 'objectNamePrefix': name,
+            'targetConfiguration': {'targetType': 'webhook', 'url': url}}
+
+
+class FakeBucket:
+    name = BUCKET
+
+    def __init__(self, rules: List[dict]):
+        self.rules = rules
+        self.writes = 0
+
+    def get_notification_rules(self) -> List[dict]:
+        return copy.deepcopy(self.rules)
+
+    def set_notification_rules(self, rules: List[dict]) -> List[dict]:
+        self.writes += 1
+        self.rules = copy.deepcopy(rules)
+        return copy.deepcopy(rules)
+
+
+def write_entry(runtime_dir: Path, label: str, buckets: List[str], rules: List[dict], pid: int | None = None,
+                create_time: float | None = None) -> Path:
+    """
+    Write the registry entry of a session whose b2listen process has exited
+    """
+    path = runtime_dir / f'{label}.json'
+    path.write_text(json.dumps({
+        'label': label, 'mode': 'listen', 'buckets': buckets,
+        # This process, but with a create time that does not match, as if the PID had been reused
+        'owner_pid': os.getpid(), 'owner_create_time': 0.0,
+        'pid': pid, 'create_time': create_time, 'rules': rules,
+    }))
+    return path
+
+
+def test_session_entry_is_kept_until_its_rules_are_cleaned_up(tmp_path):
+    session = Session(str(tmp_path), 'label', 'listen', [BUCKET])
+    session.add_rule(BUCKET, 'created', None)
+    [entry] = read_entries(str(tmp_path))
+    assert entry.label == 'label'
+    assert entry.rules == [{'bucket': BUCKET, 'name': 'created', 'old_url': None}]
+    # This process is still running
+    assert entry.owner_running()
+
+    session.close()
+    assert session.path.exists()
+    session.remove_rules(BUCKET)
+    session.close()
+    assert not session.path.exists()
+
+
+def test_unreadable_entries_are_ignored(tmp_path):
+    (tmp_path / 'broken.json').write_text('{')
+    write_entry(tmp_path, 'good', [BUCKET], [])
+    assert [entry.label for entry in read_entries(str(tmp_path))] == ['good']
+
+
+def test_rules_of_exited_session_are_deleted_and_restored(tmp_path):
+    bucket = FakeBucket([rule('created', 'https://tunnel/'), rule('modified', 'https://tunnel/'),
+                         rule('unrelated', 'https://example.com/')])
+    path = write_entry(tmp_path, 'exited', [BUCKET], [
+        {'bucket': BUCKET, 'name': 'created', 'old_url': None},
+        {'bucket': BUCKET, 'name': 'modified', 'old_url': 'https://service/'},
+        {'bucket': BUCKET, 'name': 'gone', 'old_url': None},
+    ])
+
+    counts = cleanup_sessions(bucket, read_entries(str(tmp_path)))
+    assert counts == {'deleted': 1, 'restored': 1, 'killed': 0, 'skipped': 0}
+    assert bucket.writes == 1
+    assert [(r['name'], r['targetConfiguration']['url']) for r in bucket.rules] == \
+        [('modified', 'https://service/'), ('unrelated', 'https://example.com/')]
+    assert not path.exists()
+
+
+def test_running_session_is_skipped(tmp_path):
+    bucket = FakeBucket([rule('created', 'https://tunnel/')])
+    session = Session(str(tmp_path), 'running', 'listen', [BUCKET])
+    session.add_rule(BUCKET, 'created', None)
+
+    counts = cleanup_sessions(bucket, read_entries(str(tmp_path)))
+    assert counts == {'deleted': 0, 'restored': 0, 'killed': 0, 'skipped': 1}
+    assert bucket.writes == 0
+    assert session.path.exists()
+
+
+def test_rules_in_other_buckets_are_kept(tmp_path):
+    bucket = FakeBucket([rule('created', 'https://tunnel/')])
+    path = write_entry(tmp_path, 'exited', [BUCKET, OTHER_BUCKET], [
+        {'bucket': BUCKET, 'name': 'created', 'old_url': None},
+        {'bucket': OTHER_BUCKET, 'name': 'created', 'old_url': None},
+    ])
+    write_entry(tmp_path, 'elsewhere', [OTHER_BUCKET], [{'bucket': OTHER_BUCKET, 'name': 'x', 'old_url': None}])
+
+    counts = cleanup_sessions(bucket, read_entries(str(tmp_path)))
+    assert counts['deleted'] == 1
+    assert not bucket.rules
+    # The entry remains, for the cleanup of the other bucket
+    assert json.loads(path.read_text())['rules'] == [{'bucket': OTHER_BUCKET, 'name': 'created', 'old_url': None}]
+    assert len(read_entries(str(tmp_path))) == 2
+
+
+@pytest.fixture
+def orphan():
+    """
+    Stand-in for a cloudflared process left running by a session that did not exit cleanly
+    """
+    process = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+    yield process
+    process.kill()
+    process.wait()
+
+
+def test_cloudflared_of_exited_session_is_killed_once(tmp_path, orphan):
+    import psutil
+
+    create_time = psutil.Process(orphan.pid).create_time()
+    write_entry(tmp_path, 'exited', [BUCKET, OTHER_BUCKET], [], pid=orphan.pid, create_time=create_time)
+    entries = read_entries(str(tmp_path))
+
+    assert cleanup_sessions(FakeBucket([]), entries)['killed'] == 1
+    assert orphan.wait(timeout=5) != 0
+    # The cleanup of the session's other bucket shares the entry, so does not try again
+    other_bucket = FakeBucket([])
+    other_bucket.name = OTHER_BUCKET
+    assert cleanup_sessions(other_bucket, entries)['killed'] == 0
+
+
+class FakeApi:
+    def __init__(self, buckets: List[FakeBucket]):
+        self.buckets = {bucket.name: bucket for bucket in buckets}
+
+    def get_bucket_by_name(self, bucket_name: str) -> FakeBucket:
+        if bucket_name not in self.buckets:
+            raise NonExistentBucket(bucket_name)
+        return self.buckets[bucket_name]
+
+
+def test_bucket_errors_are_reported_per_bucket():
+    def clean(bucket: FakeBucket):
+        if bucket.name == OTHER_BUCKET:
+            raise OSError('connection reset')
+        return {'deleted': 1}
+
+    other_bucket = FakeBucket([])
+    other_bucket.name = OTHER_BUCKET
+    results = cleanup_buckets(FakeApi([FakeBucket([])]), {OTHER_BUCKET: other_bucket},
+                              [BUCKET, OTHER_BUCKET, 'missing'], 2, clean)
+    assert results == {BUCKET: {'deleted': 1}, OTHER_BUCKET: 'error: connection reset',
+                       'missing': 'bucket does not exist'}
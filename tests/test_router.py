@@ -0,0 +1,74 @@
+from typing import List, Tuple
+
+import pytest
+
+from b2listen.events import Event, EventMessage, encode_events
+from b2listen.router import EventRouter, Route, parse_route
+from b2listen.signature import EVENT_NOTIFICATION_SIGNATURE_HEADER, verify_message_signature
+
+SECRET = 'abcdefghijklmnopqrstuvwxyz012345'
+
+
+class Target:
+    def __init__(self):
+        self.messages: List[Tuple[str, List[Tuple[str, str]], bytes]] = []
+
+    def deliver(self, path: str, headers: List[Tuple[str, str]], body: bytes):
+        self.messages.append((path, headers, body))
+
+
+def event(event_id: str, object_name: str, event_type: str) -> Event:
+    return Event({'eventId': event_id, 'objectName': object_name, 'eventType': event_type})
+
+
+def router(routes: List[Route], signing_secret: str | None = None) -> EventRouter:
+    return EventRouter(routes, {route.url: Target() for route in routes}, signing_secret=signing_secret)
+
+
+def test_parse_route():
+    assert parse_route(['http://localhost:8080']) == Route('http://localhost:8080', '', '*')
+    assert parse_route(['http://localhost:8080', 'images/', 'b2:ObjectCreated:*']) == \
+        Route('http://localhost:8080', 'images/', 'b2:ObjectCreated:*')
+    with pytest.raises(ValueError):
+        parse_route(['http://localhost:8080', 'images/', 'b2:ObjectCreated:*', 'extra'])
+
+
+def test_split_by_prefix_and_event_type():
+    events_router = router([Route('a', 'images/', 'b2:ObjectCreated:*'),
+                            Route('b', '', 'b2:ObjectDeleted:*'),
+                            Route('c', 'images/thumbnails/')])
+    events = [
+        event('1', 'images/cat.jpg', 'b2:ObjectCreated:Put'),
+        event('2', 'images/cat.jpg', 'b2:ObjectDeleted:Delete'),
+        event('3', 'images/thumbnails/cat.jpg', 'b2:ObjectCreated:Copy'),
+        event('4', 'logs/today.log', 'b2:ObjectCreated:Put'),
+    ]
+    split = {url: [e.event_id for e in url_events] for url, url_events in events_router.split(events).items()}
+    assert split == {'a': ['1', '3'], 'b': ['2'], 'c': ['3']}
+
+
+def test_whole_message_is_delivered_with_its_signature():
+    events_router = router([Route('a', 'images/'), Route('b', 'logs/')])
+    body = encode_events([event('1', 'images/cat.jpg', 'b2:ObjectCreated:Put')])
+    headers = [(EVENT_NOTIFICATION_SIGNATURE_HEADER, 'v1=original')]
+    events_router.deliver('/', headers, body)
+    assert events_router.targets['a'].messages == [('/', headers, body)]
+    assert events_router.targets['b'].messages == []
+
+
+def test_partial_message_is_signed_again():
+    events_router = router([Route('a', 'images/'), Route('b', 'logs/')], signing_secret=SECRET)
+    body = encode_events([event('1', 'images/cat.jpg', 'b2:ObjectCreated:Put'),
+                          event('2', 'logs/today.log', 'b2:ObjectCreated:Put')])
+    events_router.deliver('/', [(EVENT_NOTIFICATION_SIGNATURE_HEADER, 'v1=original')], body)
+    for url, event_id in (('a', '1'), ('b', '2')):
+        [(_, headers, sub_body)] = events_router.targets[url].messages
+        assert [e.event_id for e in EventMessage(sub_body).events] == [event_id]
+        signature = dict(headers)[EVENT_NOTIFICATION_SIGNATURE_HEADER]
+        assert verify_message_signature(SECRET, sub_body, signature)
+
+
+def test_message_without_events_goes_to_every_target():
+    events_router = router([Route('a', 'images/'), Route('b', 'logs/')])
+    events_router.deliver('/', [], b'{"probe": true}')
+    assert all(target.messages == [('/', [], b'{"probe": true}')] for target in events_router.targets.values())
@@ -0,0 +1,117 @@
+import copy
+from typing import List
+
+import pytest
+from b2sdk.v2.exception import BadRequest
+
+from b2listen.rules import RuleNotFound, RuleSet
+
+
+def rule(name: str, url: str = 'https://example.com/') -> dict:
+    return {'name': name, 'eventTypes': ['b2:ObjectCreated:*'], 'isEnabled': True, 'objectNamePrefix': name,
+            'targetConfiguration': {'targetType': 'webhook', 'url': url}}
+
+
+class FakeBucket:
+    """
+    A bucket's notification rules, with writes that B2 rejects as many times as reject is set to
+    """
+    name = 'my-bucket'
+
+    def __init__(self, rules: List[dict]):
+        self.rules = rules
+        self.reads = 0
+        self.writes = []
+        self.reject = 0
+
+    def get_notification_rules(self) -> List[dict]:
+        self.reads += 1
+        return copy.deepcopy(self.rules)
+
+    def set_notification_rules(self, rules: List[dict]) -> List[dict]:
+        self.writes.append(copy.deepcopy(rules))
+        if self.reject:
+            self.reject -= 1
+            raise BadRequest('Rules overlap', 'bad_request')
+        self.rules = copy.deepcopy(rules)
+        return copy.deepcopy(rules)
+
+
+def names(rules: List[dict]) -> List[str]:
+    return [rule['name'] for rule in rules]
+
+
+def test_several_edits_are_written_at_once():
+    bucket = FakeBucket([rule('a'), rule('b', 'https://old/')])
+    rule_set = RuleSet(bucket)
+    rule_set.create(rule('c'))
+    assert rule_set.modify_url('b', 'https://new/') == 'https://old/'
+    assert rule_set.delete('a')
+    assert not bucket.writes
+
+    rule_set.commit()
+    assert len(bucket.writes) == 1
+    assert names(bucket.rules) == ['b', 'c']
+    assert bucket.rules[0]['targetConfiguration']['url'] == 'https://new/'
+    # Nothing left to write, and the written rules are cached
+    rule_set.commit()
+    assert len(bucket.writes) == 1
+    assert rule_set.get_rules() == bucket.rules
+    assert bucket.reads == 1
+
+
+def test_edits_are_replayed_when_rules_changed_since_they_were_read():
+    bucket = FakeBucket([rule('a')])
+    rule_set = RuleSet(bucket)
+    rule_set.create(rule('b'))
+    # Another session adds a rule, and the write based on the stale rules is rejected
+    bucket.rules.append(rule('other'))
+    bucket.reject = 1
+
+    rule_set.commit()
+    assert len(bucket.writes) == 2
+    assert names(bucket.rules) == ['a', 'other', 'b']
+    assert rule_set.get_rules() == bucket.rules
+
+
+def test_replay_fails_if_modified_rule_was_deleted():
+    bucket = FakeBucket([rule('a'), rule('b')])
+    rule_set = RuleSet(bucket)
+    rule_set.modify_url('a', 'https://new/')
+    # Another session deletes the rule
+    bucket.rules = [rule('b')]
+    bucket.reject = 1
+
+    with pytest.raises(RuleNotFound):
+        rule_set.commit()
+    assert len(bucket.writes) == 1
+    # The pending edits are discarded, leaving the rules as they are in B2
+    assert rule_set.get_rules() == bucket.rules
+    assert not rule_set.operations
+
+
+def test_replay_that_is_rejected_again_is_rolled_back():
+    bucket = FakeBucket([rule('a')])
+    rule_set = RuleSet(bucket)
+    rule_set.create(rule('b'))
+    bucket.rules.append(rule('other'))
+    bucket.reject = 2
+
+    with pytest.raises(BadRequest):
+        rule_set.commit()
+    assert len(bucket.writes) == 2
+    assert names(bucket.rules) == ['a', 'other']
+    assert rule_set.get_rules() == bucket.rules
+    assert not rule_set.operations
+
+
+def test_rejected_edits_to_current_rules_are_not_retried():
+    bucket = FakeBucket([rule('a')])
+    rule_set = RuleSet(bucket)
+    rule_set.create(rule('b'))
+    bucket.reject = 1
+
+    with pytest.raises(BadRequest):
+        rule_set.commit()
+    assert len(bucket.writes) == 1
+    assert rule_set.get_rules() == [rule('a')]
@@ -0,0 +1,127 @@
+import http.client
+import socket
+import threading
+import time
+
+import pytest
+
+from b2listen.dedup import DedupIndex
+from b2listen.loadgen import make_payload
+from b2listen.ratelimit import ProcessingLatency
+from b2listen.server import Server
+
+LATENCY = 0.3
+
+
+@pytest.fixture
+def start_server():
+    servers = []
+
+    def start(**kwargs) -> Server:
+        server = Server(port=0, daemon=True, log_requests=False, **kwargs)
+        server.start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.drain(0)
+
+
+def post(server: Server, connection: http.client.HTTPConnection | None = None, body: bytes | None = None) -> int:
+    connection = connection or http.client.HTTPConnection(server.interface, server.port)
+    connection.request('POST', '/', body or make_payload(1))
+    response = connection.getresponse()
+    response.read()
+    return response.status
+
+
+def post_concurrently(server: Server, count: int) -> float:
+    """
+    :return: the time taken to post count messages, each on its own connection
+    """
+    statuses = []
+    threads = [threading.Thread(target=lambda: statuses.append(post(server))) for _ in range(count)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert statuses == [200] * count
+    return time.monotonic() - start
+
+
+def test_threaded_engine_keeps_connections_alive(start_server):
+    server = start_server(engine='threaded')
+    connection = http.client.HTTPConnection(server.interface, server.port)
+    assert post(server, connection) == 200
+    sock = connection.sock
+    assert post(server, connection) == 200
+    assert connection.sock is sock
+
+
+def test_simple_engine_closes_connections(start_server):
+    server = start_server(engine='simple')
+    connection = http.client.HTTPConnection(server.interface, server.port)
+    assert post(server, connection) == 200
+    assert connection.sock is None
+
+
+def test_concurrent_requests_are_limited(start_server):
+    server = start_server(engine='threaded', concurrency=2,
+                          processing_latency=ProcessingLatency('constant', (LATENCY,)))
+    # Four requests, two at a time
+    assert post_concurrently(server, 4) >= 2 * LATENCY
+
+
+def test_idle_connections_do_not_hold_request_slots(start_server):
+    server = start_server(engine='threaded', concurrency=2,
+                          processing_latency=ProcessingLatency('constant', (LATENCY,)))
+    idle = [http.client.HTTPConnection(server.interface, server.port) for _ in range(4)]
+    for connection in idle:
+        connection.request('GET', '/')
+        connection.getresponse().read()
+    # Both slots are free, so two requests are handled at once
+    assert post_concurrently(server, 2) < 2 * LATENCY
+
+
+class FailingTarget:
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.delivered = []
+
+    def deliver(self, path, headers, body):
+        if self.failures:
+            self.failures -= 1
+            raise OSError('local service is down')
+        self.delivered.append(body)
+
+
+def test_message_that_was_not_delivered_is_not_a_duplicate(start_server):
+    target = FailingTarget(failures=1)
+    dedup = DedupIndex()
+    server = start_server(target=target, dedup=dedup)
+    body = make_payload(2)
+    assert post(server, body=body) == 503
+    assert dedup.stats()['in_flight'] == 0
+    # B2 retries the message
+    assert post(server, body=body) == 200
+    assert target.delivered == [body]
+    # and, once it has been delivered, retries are dropped
+    assert post(server, body=body) == 200
+    assert target.delivered == [body]
+
+
+def test_drain_does_not_wait_for_stuck_connection(start_server):
+    server = start_server(engine='simple')
+    # A connection that never finishes its request holds the simple engine's only thread
+    stuck = socket.create_connection((server.interface, server.port))
+    try:
+        stuck.sendall(b'POST / HTTP/1.0\r\n')
+        # Give the server time to accept the connection and start reading the request
+        time.sleep(0.2)
+        start = time.monotonic()
+        assert server.drain(0.2)['abandoned_messages'] == 0
+        assert time.monotonic() - start < 3
+    finally:
+        stuck.close()
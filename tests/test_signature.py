@@ -0,0 +1,22 @@
+from b2listen.signature import create_message_signature, verify_message_signature
+
+SECRET = 'abcdefghijklmnopqrstuvwxyz012345'
+BODY = b'{"events":[]}'
+
+
+def test_signature_is_hmac_sha256_of_body():
+    # Computed with: echo -n '{"events":[]}' | openssl dgst -sha256 -hmac abcdefghijklmnopqrstuvwxyz012345
+    assert create_message_signature(SECRET, BODY) == \
+        'v1=c3ab7128f34241f6038f17e98ee7aceb531233915cf351a8e9905244a70db47d'
+
+
+def test_valid_signature_is_verified():
+    assert verify_message_signature(SECRET, BODY, create_message_signature(SECRET, BODY))
+    assert verify_message_signature(SECRET, BODY, create_message_signature(SECRET, BODY).upper())
+
+
+def test_invalid_signatures_are_rejected():
+    assert not verify_message_signature(SECRET, BODY, None)
+    assert not verify_message_signature(SECRET, BODY, '')
+    assert not verify_message_signature(SECRET, BODY + b' ', create_message_signature(SECRET, BODY))
+    assert not verify_message_signature(SECRET[::-1], BODY, create_message_signature(SECRET, BODY))
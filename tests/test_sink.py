@@ -0,0 +1,97 @@
+import datetime
+import subprocess
+import sys
+import time
+
+import pytest
+
+from b2listen.events import Event, encode_events, loads
+from b2listen.sink import EventSink, NdjsonSink, SqliteSink, query
+
+BASE_TIMESTAMP = int(datetime.datetime(2024, 7, 22, 16, 0, tzinfo=datetime.timezone.utc).timestamp() * 1000)
+
+
+def event(event_id: str, object_name: str, event_type: str, minutes: int) -> Event:
+    return Event({'eventId': event_id, 'objectName': object_name, 'eventType': event_type,
+                  'eventTimestamp': BASE_TIMESTAMP + minutes * 60_000, 'objectSize': 1})
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / 'events.db')
+    sink = SqliteSink(path, batch_size=2)
+    sink.record('/', encode_events([
+        event('1', 'images/cat.jpg', 'b2:ObjectCreated:Upload', 0),
+        event('2', 'images/dog.jpg', 'b2:ObjectDeleted:Delete', 1),
+    ]))
+    sink.record('/', encode_events([
+        event('3', 'logs/today.log', 'b2:ObjectCreated:Copy', 2),
+        event('4', 'images', 'b2:ObjectCreated:Upload', 3),
+    ]))
+    # The probe message has no events
+    sink.record('/', b'{"probe": true}')
+    sink.close()
+    return path
+
+
+def event_ids(events):
+    return [e.event_id for e in events]
+
+
+def test_query_all_in_timestamp_order(database):
+    assert event_ids(query(database)) == ['1', '2', '3', '4']
+
+
+def test_query_by_prefix(database):
+    assert event_ids(query(database, object_prefix='images/')) == ['1', '2']
+
+
+def test_query_by_event_type_pattern(database):
+    assert event_ids(query(database, event_type='b2:ObjectCreated:*')) == ['1', '3', '4']
+
+
+def test_query_by_time_and_limit(database):
+    since = datetime.datetime.fromtimestamp((BASE_TIMESTAMP + 60_000) / 1000, datetime.timezone.utc)
+    until = datetime.datetime.fromtimestamp((BASE_TIMESTAMP + 3 * 60_000) / 1000, datetime.timezone.utc)
+    assert event_ids(query(database, since=since, until=until)) == ['2', '3']
+    assert event_ids(query(database, limit=1)) == ['1']
+
+
+def test_ndjson_files_rotate(tmp_path):
+    sink = NdjsonSink(str(tmp_path), max_file_size=200, batch_size=1)
+    for i in range(4):
+        sink.record('/images', encode_events([event(str(i), f'images/{i}.jpg', 'b2:ObjectCreated:Upload', i)]))
+        # Files rotate between batches, so wait for each event to be written in a batch of its own
+        deadline = time.monotonic() + 5
+        while sink.events <= i and time.monotonic() < deadline:
+            time.sleep(0.01)
+    sink.close()
+    files = sorted(tmp_path.glob('*.ndjson'))
+    assert len(files) > 1
+    lines = [loads(line) for path in files for line in path.read_bytes().splitlines()]
+    assert [line['event']['eventId'] for line in lines] == ['0', '1', '2', '3']
+    assert all(line['path'] == '/images' for line in lines)
+
+
+def test_sink_must_implement_storage():
+    class Incomplete(EventSink):
+        def _open(self):
+            pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_ndjson_sink_does_not_import_sqlite(tmp_path):
+    # A process of its own, since other tests import sqlite3
+    script = f'''
+import sys
+from b2listen.events import Event, encode_events
+from b2listen.sink import NdjsonSink
+sink = NdjsonSink({str(tmp_path)!r}, batch_size=1)
+sink.record('/', encode_events([Event({{"eventId": "1", "objectName": "a"}})]))
+sink.close()
+assert sink.events == 1
+assert 'sqlite3' not in sys.modules
+'''
+    subprocess.run([sys.executable, '-c', script], check=True)
@@ -0,0 +1,102 @@
+from b2listen.spool import Spool, SEGMENT_SUFFIX
+
+
+def spooled(directory) -> Spool:
+    return Spool(str(directory), fsync_interval=60)
+
+
+def read_all(spool: Spool):
+    records = []
+    while (record := spool.next_record(timeout=0)) is not None:
+        records.append(record)
+        spool.commit(record)
+    return records
+
+
+def test_records_are_read_in_order(tmp_path):
+    spool = spooled(tmp_path)
+    try:
+        for i in range(3):
+            spool.append(f'/path/{i}', [('Content-Type', 'application/json')], b'{"events":[]}%d' % i)
+        records = read_all(spool)
+        assert [record.path for record in records] == ['/path/0', '/path/1', '/path/2']
+        assert records[0].headers == [('Content-Type', 'application/json')]
+        assert records[2].body == b'{"events":[]}2'
+        assert spool.empty()
+    finally:
+        spool.close()
+
+
+def test_uncommitted_records_survive_restart(tmp_path):
+    spool = spooled(tmp_path)
+    spool.append('/', [], b'first')
+    spool.append('/', [], b'second')
+    spool.commit(spool.next_record(timeout=0))
+    spool.close()
+
+    spool = spooled(tmp_path)
+    try:
+        assert [record.body for record in read_all(spool)] == [b'second']
+    finally:
+        spool.close()
+
+
+def test_partially_written_record_is_truncated_on_recovery(tmp_path):
+    spool = spooled(tmp_path)
+    spool.append('/', [], b'complete')
+    spool.close()
+    segment = next(tmp_path.glob(f'*{SEGMENT_SUFFIX}'))
+    size = segment.stat().st_size
+    # A crash while appending a record leaves part of it at the end of the segment
+    with open(segment, 'ab') as f:
+        f.write(b'\x01\x02\x03\x04\x05\x06')
+
+    spool = spooled(tmp_path)
+    try:
+        assert segment.stat().st_size == size
+        assert [record.body for record in read_all(spool)] == [b'complete']
+        spool.append('/', [], b'after recovery')
+        assert [record.body for record in read_all(spool)] == [b'after recovery']
+    finally:
+        spool.close()
+
+
+def test_consumed_segments_are_removed(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=100, fsync_interval=60)
+    try:
+        for i in range(5):
+            spool.append('/', [], b'x' * 80)
+        assert len(list(tmp_path.glob(f'*{SEGMENT_SUFFIX}'))) > 1
+        assert len(read_all(spool)) == 5
+        assert len(list(tmp_path.glob(f'*{SEGMENT_SUFFIX}'))) == 1
+    finally:
+        spool.close()
+
+
+def test_active_segment_is_mapped_once_per_extension(tmp_path):
+    spool = spooled(tmp_path)
+    try:
+        spool.append('/', [], b'first')
+        read_all(spool)
+        mapped = spool._map
+        for i in range(10):
+            spool.append('/', [], b'%d' % i)
+            assert len(read_all(spool)) == 1
+        assert spool._map is mapped
+    finally:
+        spool.close()
+
+
+def test_unused_end_of_segment_is_removed_on_recovery(tmp_path):
+    crashed = spooled(tmp_path)
+    crashed.append('/', [], b'complete')
+    segment = next(tmp_path.glob(f'*{SEGMENT_SUFFIX}'))
+    assert segment.stat().st_size > crashed.end
+
+    spool = spooled(tmp_path)
+    try:
+        assert segment.stat().st_size == crashed.end
+        assert [record.body for record in read_all(spool)] == [b'complete']
+    finally:
+        spool.close()
+        crashed.close()
@@ -0,0 +1,99 @@
+import logging
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from b2listen.broker import Broker, BrokerHandler
+from b2listen.server import Server
+from b2listen.subscription import Subscription
+
+SECRET = 'abcdefghijklmnopqrstuvwxyz012345'
+BUCKET = 'my-bucket'
+RULE = 'my-rule'
+
+
+@pytest.fixture
+def start_broker():
+    servers = []
+
+    def start(push: bool) -> str:
+        BrokerHandler.broker = Broker(SECRET, push=push)
+        httpd = ThreadingHTTPServer(('localhost', 0), BrokerHandler)
+        httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+        servers.append(httpd)
+        return f'http://localhost:{httpd.server_address[1]}'
+
+    yield start
+    for httpd in servers:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+@pytest.fixture
+def tunnel():
+    """
+    Stand-in for the tunnel, so that the subscription's probes find the client awake
+    """
+    server = Server(port=0, daemon=True, log_requests=False)
+    server.start()
+    yield server.url
+    server.drain(0)
+
+
+def wait_for(condition, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def watching(id_: str) -> bool:
+    with BrokerHandler.broker.lock:
+        return bool(BrokerHandler.broker.watchers.get(id_))
+
+
+def subscribe(broker_url: str, tunnel_url: str, interval_seconds: float) -> Subscription:
+    return Subscription(broker_url, tunnel_url, BUCKET, RULE, SECRET, interval_seconds, push=True)
+
+
+def test_removed_subscription_is_recreated_via_push(start_broker, tunnel):
+    broker = start_broker(push=True)
+    # Far longer than the test, so only the push channel can prompt the new subscription
+    subscription = subscribe(broker, tunnel, interval_seconds=60)
+    try:
+        first_id = subscription.id_
+        assert wait_for(lambda: watching(first_id))
+
+        # As when deliveries to the subscriber fail repeatedly
+        BrokerHandler.broker.unsubscribe(first_id)
+
+        assert wait_for(lambda: subscription.id_ != first_id and BrokerHandler.broker.exists(subscription.id_))
+        # and the new subscription is watched in turn
+        assert wait_for(lambda: watching(subscription.id_))
+    finally:
+        subscription.stop()
+    assert not BrokerHandler.broker.subscriptions
+
+
+def test_falls_back_to_polling_without_push(start_broker, tunnel, caplog):
+    caplog.set_level(logging.INFO, logger='subscription')
+    broker = start_broker(push=False)
+    subscription = subscribe(broker, tunnel, interval_seconds=0.2)
+    try:
+        assert wait_for(lambda: 'does not support push notifications' in caplog.text)
+        first_id = subscription.id_
+        removed = time.monotonic()
+        BrokerHandler.broker.unsubscribe(first_id)
+
+        # With no push channel, the removal is found at the next poll
+        assert wait_for(lambda: subscription.id_ != first_id and BrokerHandler.broker.exists(subscription.id_))
+        assert time.monotonic() - removed >= 0.1
+        assert not BrokerHandler.broker.watchers
+    finally:
+        subscription.stop()
+    assert not BrokerHandler.broker.subscriptions